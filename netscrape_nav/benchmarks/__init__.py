@@ -0,0 +1,14 @@
+'''
+SAMARA iGEM Research Assistant
+benchmarks
+
+An offline benchmark suite for the spider. The crawl runs against a local stand-in for the iGEM servers
+(see server.py) serving a recorded or synthetic corpus of wiki pages (see corpus.py), so no network access
+is needed and every run sees exactly the same pages. The results are written as JSON (see bench.py) so they
+can be compared across commits.
+
+Run from the first netscrape_nav folder:
+
+python -m benchmarks run --output results.json
+python -m benchmarks compare base.json results.json
+'''
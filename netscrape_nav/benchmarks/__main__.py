@@ -0,0 +1,122 @@
+'''
+SAMARA iGEM Research Assistant
+__main__.py
+
+The command line of the benchmark suite. Run from the first netscrape_nav folder:
+
+python -m benchmarks run [--corpus DIR] [--teams 100] [--years 2021] [--seeded] [--output results.json] [-s KEY=VALUE]
+    Runs the spider against a corpus (a synthetic one by default) and writes the results as JSON (see bench.py)
+
+python -m benchmarks compare BASE.json NEW.json [--fail-below -5]
+    Compares two results. With --fail-below, exits with an error if pages/sec changed by less than the given
+    percentage (e.g. -5 fails on a slowdown of more than 5%)
+
+python -m benchmarks synthetic DIR [--teams 100] [--years 2021] [--random-seed 0]
+    Generates a synthetic corpus (see corpus.py)
+
+python -m benchmarks record DIR [--years 2021]
+    Crawls the live iGEM wikis and saves every page into a corpus
+'''
+
+import argparse
+import json
+import os
+import sys
+
+from benchmarks.bench import PROJECT_DIR, benchmark, compareResults, runBenchmark
+from benchmarks.corpus import makeSyntheticCorpus
+
+
+def run(args):
+    settings = dict(setting.split('=', 1) for setting in args.set)
+    if args.single:
+        results = runBenchmark(args.corpus, args.seeded, not args.no_trace_allocations, settings)
+    else:
+        results = benchmark(args.corpus, args.teams, args.years.split(','), args.seeded, not args.no_trace_allocations, settings)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+    print(text)
+
+
+def compare(args):
+    with open(args.base, encoding='utf-8') as file:
+        base = json.load(file)
+    with open(args.new, encoding='utf-8') as file:
+        new = json.load(file)
+
+    print(f'{"metric":<28}{"base":>16}{"new":>16}{"change":>10}')
+    for name, old, current, change in compareResults(base, new):
+        print(f'{name:<28}{old:>16.3f}{current:>16.3f}{change:>+9.1f}%')
+
+    if args.fail_below is not None:
+        change = (new['pages_per_second'] - base['pages_per_second']) / base['pages_per_second'] * 100
+        if change < args.fail_below:
+            print(f'pages_per_second changed by {change:+.1f}%, below {args.fail_below:+.1f}%')
+            return 1
+    return 0
+
+
+def synthetic(args):
+    manifest = makeSyntheticCorpus(args.directory, args.teams, args.years.split(','), args.random_seed)
+    print(f'Generated {len(manifest["pages"])} pages in {args.directory}')
+
+
+def record(args):
+    sys.path.insert(0, PROJECT_DIR)
+    os.environ.setdefault('SCRAPY_SETTINGS_MODULE', 'netscrape_nav.settings')
+
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+    from netscrape_nav.spiders.iGEMscraper import iGEMSpider
+
+    settings = get_project_settings()
+    settings.set('BENCHMARK_RECORD_DIR', os.path.abspath(args.directory))
+    settings.set('DOWNLOADER_MIDDLEWARES', {**settings.getdict('DOWNLOADER_MIDDLEWARES'), 'benchmarks.corpus.CorpusRecorder': 900})   # Sees the responses before any other middleware changes them
+
+    process = CrawlerProcess(settings)
+    process.crawl(iGEMSpider, **({'years': args.years} if args.years else {}))
+    process.start()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Offline benchmarks of the iGEM spider')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_run = commands.add_parser('run', help='run the spider against a corpus and measure it')
+    parser_run.add_argument('--corpus', help='the corpus directory (default: generate a synthetic corpus)')
+    parser_run.add_argument('--teams', type=int, default=100, help='teams per year of the synthetic corpus')
+    parser_run.add_argument('--years', default='2021', help='years of the synthetic corpus, separated by commas')
+    parser_run.add_argument('--seeded', action='store_true', help='seed the crawl from the team lists (-a years=...) instead of following links')
+    parser_run.add_argument('--no-trace-allocations', action='store_true', help="skip the second run that traces python memory allocations")
+    parser_run.add_argument('--single', action='store_true', help=argparse.SUPPRESS)  # A single run in this process, used by bench.py (see runPass)
+    parser_run.add_argument('--output', help='the file to write the results to')
+    parser_run.add_argument('-s', '--set', action='append', default=[], metavar='KEY=VALUE', help='override a setting of settings.py')
+    parser_run.set_defaults(function=run)
+
+    parser_compare = commands.add_parser('compare', help='compare the results of two runs')
+    parser_compare.add_argument('base')
+    parser_compare.add_argument('new')
+    parser_compare.add_argument('--fail-below', type=float, help='exit with an error if pages/sec changed by less than this percentage')
+    parser_compare.set_defaults(function=compare)
+
+    parser_synthetic = commands.add_parser('synthetic', help='generate a synthetic corpus')
+    parser_synthetic.add_argument('directory')
+    parser_synthetic.add_argument('--teams', type=int, default=100)
+    parser_synthetic.add_argument('--years', default='2021')
+    parser_synthetic.add_argument('--random-seed', type=int, default=0)
+    parser_synthetic.set_defaults(function=synthetic)
+
+    parser_record = commands.add_parser('record', help='record a corpus from the live iGEM wikis')
+    parser_record.add_argument('directory')
+    parser_record.add_argument('--years', help='crawl the team lists of these years (-a years=...) instead of following links from the 2021 list')
+    parser_record.set_defaults(function=record)
+
+    args = parser.parse_args(argv)
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,397 @@
+'''
+SAMARA iGEM Research Assistant
+bench.py
+
+This file runs the spider against a benchmark corpus (see corpus.py) served by the local stand-in server
+(see server.py) and measures:
+
+    pages_per_second: responses downloaded per second, from the engine starting to the spider closing
+    items_per_second: WikiPages exported per second
+    stages: latency percentiles, in milliseconds, of every stage a page goes through
+        download: the time to the response headers, as measured by scrapy (download_latency)
+        clean: parsing the page and removing scripts, styles, and unwanted tags (parseHTML in extraction.py)
+        extract: reading and normalizing the bodyContent text, after cleaning (getBodytext in extraction.py)
+        filter: the KeystoneXL pipeline, minus the export
+        export: writing the item with the exporter
+    memory: the peak resident set size of the crawl, and the peak and current size of the memory allocated by
+            python code, traced with tracemalloc in a second run (unless --no-trace-allocations is given)
+
+The clean and extract stages are only measured when the extraction runs in the spider (the default). With
+EXTRACTION_OFFLOAD_ENABLED, they run in the worker processes instead and aren't timed.
+
+The results are printed or written as JSON, along with the git commit they were measured on, so results
+from different commits can be compared (see compareResults).
+
+Doesn't run on it's own; is accessed from __main__.py (python -m benchmarks run/compare)
+'''
+
+import functools
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+from scrapy import signals
+from scrapy.crawler import CrawlerProcess
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.project import get_project_settings
+
+from benchmarks.corpus import TEAM_LIST_URL, makeSyntheticCorpus
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))   # The first netscrape_nav folder
+STAGES = ('download', 'clean', 'extract', 'filter', 'export')
+PERCENTILES = (50, 90, 99)
+
+
+class CorpusProxyMiddleware:
+    '''
+    A downloader middleware that sends every request to the benchmark server. https urls are rewritten to
+    http first, as the server is a plain HTTP proxy. Enabled by setting BENCHMARK_PROXY
+    '''
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        proxy = crawler.settings.get('BENCHMARK_PROXY')
+        if not proxy:
+            raise NotConfigured
+        return cls(proxy)
+
+    def process_request(self, request, spider):
+        if request.url.startswith('https://'):
+            return request.replace(url='http://' + request.url[len('https://'):])   # Rescheduled, and comes back here as http
+        request.meta['proxy'] = self.proxy
+
+
+class StageTimer:
+    '''
+    Collects the latency samples of every stage (see the top of this file)
+    '''
+
+    def __init__(self):
+        self.samples = defaultdict(list)    # stage -> seconds
+        self.started = None
+        self.finished = None
+
+    def record(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    def engine_started(self):
+        self.started = time.perf_counter()
+
+    def spider_closed(self, spider):
+        self.finished = time.perf_counter()
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.record('download', latency)
+
+    def summary(self):
+        '''
+        Returns:
+            stages (dict): stage -> count, mean, percentiles, and max of its samples, in milliseconds
+        '''
+        return {stage: summarizeSamples(self.samples[stage]) for stage in STAGES}
+
+
+def summarizeSamples(samples):
+    '''
+    Summarizes the latency samples of a stage
+
+    Arguments:
+        samples [list of float]: latencies in seconds
+
+    Returns:
+        summary (dict): count, total_ms, mean_ms, p50_ms, p90_ms, p99_ms, and max_ms (nearest rank percentiles).
+                        Only the count if there are no samples
+    '''
+
+    if not samples:
+        return {'count': 0}
+
+    samples = sorted(samples)
+    summary = {
+        'count': len(samples),
+        'total_ms': sum(samples) * 1000,
+        'mean_ms': sum(samples) * 1000 / len(samples),
+    }
+    for percentile in PERCENTILES:
+        summary[f'p{percentile}_ms'] = samples[max(0, -(-len(samples) * percentile // 100) - 1)] * 1000
+    summary['max_ms'] = samples[-1] * 1000
+    return summary
+
+
+def instrument(timer):
+    '''
+    Wraps the functions of every stage to record their latency in the timer. Has to be called before the
+    crawl starts
+
+    Arguments:
+        timer (StageTimer): where the samples are recorded
+    '''
+
+    from netscrape_nav import extraction, pipelines
+
+    def timed(function, stage):
+        @functools.wraps(function)
+        def timedFunction(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timer.record(stage, time.perf_counter() - start)
+        return timedFunction
+
+    extraction.parseHTML = timed(extraction.parseHTML, 'clean')     # ParsedPage looks them up in the module when called
+    extraction.getBodytext = timed(extraction.getBodytext, 'extract')
+
+    open_spider = pipelines.KeystoneXL.open_spider
+    @functools.wraps(open_spider)
+    def timedOpenSpider(self, spider):
+        open_spider(self, spider)
+        export_item = self.exporter.export_item
+        def timedExportItem(item):
+            start = time.perf_counter()
+            try:
+                return export_item(item)
+            finally:
+                self.export_time = time.perf_counter() - start
+        self.exporter.export_item = timedExportItem
+    pipelines.KeystoneXL.open_spider = timedOpenSpider
+
+    process_item = pipelines.KeystoneXL.process_item
+    @functools.wraps(process_item)
+    def timedProcessItem(self, item, spider):
+        self.export_time = None
+        start = time.perf_counter()
+        try:
+            return process_item(self, item, spider)
+        finally:
+            elapsed = time.perf_counter() - start
+            if self.export_time is not None:
+                timer.record('export', self.export_time)
+                elapsed -= self.export_time
+            timer.record('filter', elapsed)
+    pipelines.KeystoneXL.process_item = timedProcessItem
+
+
+def gitCommit():
+    '''
+    Gets the commit the benchmark is run on
+
+    Returns:
+        commit (dict): the commit hash and whether the tree has uncommitted changes, or None outside of git
+    '''
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=PROJECT_DIR, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return {'hash': commit, 'dirty': bool(status.strip())}
+
+
+def startServer(corpus):
+    '''
+    Starts the benchmark server (see server.py) in its own process
+
+    Returns:
+        process (Popen): the server process
+        port (int): the port it listens on
+    '''
+
+    process = subprocess.Popen([sys.executable, '-m', 'benchmarks.server', corpus], cwd=PROJECT_DIR, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line:
+        process.wait()
+        raise RuntimeError(f'The benchmark server failed to start (exit code {process.returncode})')
+    return process, int(line)
+
+
+def runBenchmark(corpus, seeded=False, trace_allocations=False, settings=None):
+    '''
+    Runs the spider once against a corpus and measures it, in this process. The twisted reactor can't be
+    restarted, so this can only be called once per process (see benchmark)
+
+    Arguments:
+        corpus (str): the corpus directory
+        seeded (bool): seed the crawl from the team lists (-a years=...) instead of following links
+        trace_allocations (bool): trace python memory allocations. Slows the crawl down a lot
+        settings (dict): settings to override in settings.py
+
+    Returns:
+        results (dict): the measurements, see the top of this file
+    '''
+
+    corpus = os.path.abspath(corpus)
+    with open(os.path.join(corpus, 'manifest.json'), encoding='utf-8') as file:
+        manifest = json.load(file)
+
+    workdir = tempfile.mkdtemp(prefix='samara-bench-')     # Output files, validators.db, concurrency.json... are kept out of the project
+    server, port = startServer(corpus)
+    try:
+        sys.path.insert(0, PROJECT_DIR)
+        os.environ.setdefault('SCRAPY_SETTINGS_MODULE', 'netscrape_nav.settings')
+        os.chdir(workdir)
+
+        project_settings = get_project_settings()
+        project_settings.set('LOG_LEVEL', 'ERROR')    # Dropped pages are logged as warnings
+        project_settings.set('BENCHMARK_PROXY', f'http://127.0.0.1:{port}')
+        project_settings.set('DOWNLOADER_MIDDLEWARES', {**project_settings.getdict('DOWNLOADER_MIDDLEWARES'), 'benchmarks.bench.CorpusProxyMiddleware': 50})    # Before the RobotsTxtMiddleware (100)
+        for key, value in (settings or {}).items():
+            project_settings.set(key, value, priority='cmdline')
+
+        from netscrape_nav.spiders.iGEMscraper import iGEMSpider
+        timer = StageTimer()
+        instrument(timer)
+
+        if seeded:
+            spider_args = {'years': ','.join(manifest['years'])}
+        else:
+            spider_args = {'start_urls': [TEAM_LIST_URL.format(year=year) for year in manifest['years']]}
+
+        process = CrawlerProcess(project_settings)
+        crawler = process.create_crawler(iGEMSpider)
+        crawler.signals.connect(timer.engine_started, signal=signals.engine_started)
+        crawler.signals.connect(timer.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(timer.response_received, signal=signals.response_received)
+
+        if trace_allocations:
+            tracemalloc.start()
+        process.crawl(crawler, **spider_args)
+        process.start()
+        traced = tracemalloc.get_traced_memory() if trace_allocations else (None, None)
+        tracemalloc.stop()
+    finally:
+        server.terminate()
+        server.wait()
+        os.chdir(PROJECT_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    stats = crawler.stats.get_stats()
+    elapsed = timer.finished - timer.started
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024    # Linux reports kilobytes, macOS bytes
+
+    return {
+        'commit': gitCommit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'corpus': {'path': corpus, 'pages': len(manifest['pages']), 'generator': manifest.get('generator')},
+        'seeded': seeded,
+        'settings': settings or {},
+        'elapsed_seconds': elapsed,
+        'pages': stats.get('response_received_count', 0),
+        'items': stats.get('item_scraped_count', 0),
+        'dropped': stats.get('item_dropped_count', 0),
+        'pages_per_second': stats.get('response_received_count', 0) / elapsed,
+        'items_per_second': stats.get('item_scraped_count', 0) / elapsed,
+        'stages': timer.summary(),
+        'memory': {
+            'peak_rss_bytes': peak_rss,
+            'traced_peak_bytes': traced[1],
+            'traced_current_bytes': traced[0],
+            'allocated_blocks': sys.getallocatedblocks(),
+        },
+    }
+
+
+def runPass(corpus, seeded, trace_allocations, settings):
+    '''
+    Runs runBenchmark in a new process (python -m benchmarks run --single)
+
+    Returns:
+        results (dict): the measurements of the run
+    '''
+
+    with tempfile.TemporaryDirectory(prefix='samara-bench-') as directory:
+        output = os.path.join(directory, 'results.json')
+        command = [sys.executable, '-m', 'benchmarks', 'run', '--single', '--corpus', corpus, '--output', output]
+        if seeded:
+            command.append('--seeded')
+        if not trace_allocations:
+            command.append('--no-trace-allocations')
+        for key, value in settings.items():
+            command += ['-s', f'{key}={value}']
+
+        subprocess.run(command, cwd=PROJECT_DIR, check=True, stdout=subprocess.DEVNULL)
+        with open(output, encoding='utf-8') as file:
+            return json.load(file)
+
+
+def benchmark(corpus=None, teams=100, years=('2021', ), seeded=False, trace_allocations=True, settings=None):
+    '''
+    Benchmarks the spider. Tracing allocations slows the crawl down several times over, so the timings and
+    peak RSS come from one run, and the traced allocations from a second run. Each run gets its own
+    process, so neither run's memory is counted in the other's
+
+    Arguments:
+        corpus (str): the corpus directory. A synthetic corpus is generated if not given
+        teams (int): the number of teams per year of the synthetic corpus
+        years [list of str]: the years of the synthetic corpus
+        seeded (bool): seed the crawl from the team lists (-a years=...) instead of following links
+        trace_allocations (bool): make the second run to trace python memory allocations
+        settings (dict): settings to override in settings.py
+
+    Returns:
+        results (dict): the measurements, see the top of this file
+    '''
+
+    settings = settings or {}
+    with tempfile.TemporaryDirectory(prefix='samara-corpus-') as directory:
+        if corpus is None:
+            corpus = directory
+            makeSyntheticCorpus(corpus, teams, years)
+        corpus = os.path.abspath(corpus)
+
+        results = runPass(corpus, seeded, False, settings)
+        if trace_allocations:
+            traced = runPass(corpus, seeded, True, settings)['memory']
+            results['memory']['traced_peak_bytes'] = traced['traced_peak_bytes']
+            results['memory']['traced_current_bytes'] = traced['traced_current_bytes']
+
+    return results
+
+
+def compareResults(base, new):
+    '''
+    Compares the results of two benchmark runs
+
+    Arguments:
+        base (dict): the results to compare against
+        new (dict): the new results
+
+    Returns:
+        rows [list of (str, float, float, float)]: metric, base value, new value, and the change in percent
+    '''
+
+    metrics = [('pages_per_second', lambda results: results['pages_per_second']),
+               ('items_per_second', lambda results: results['items_per_second']),
+               ('elapsed_seconds', lambda results: results['elapsed_seconds'])]
+    for stage in STAGES:
+        for percentile in PERCENTILES:
+            key = f'p{percentile}_ms'
+            metrics.append((f'{stage}.{key}', lambda results, stage=stage, key=key: results['stages'][stage].get(key)))
+    for key in ('peak_rss_bytes', 'traced_peak_bytes'):
+        metrics.append((f'memory.{key}', lambda results, key=key: results['memory'].get(key)))
+
+    rows = []
+    for name, value in metrics:
+        old, current = value(base), value(new)
+        if old is None or current is None:
+            continue
+        rows.append((name, old, current, (current - old) / old * 100 if old else 0.0))
+    return rows
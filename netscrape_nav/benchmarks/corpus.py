@@ -0,0 +1,236 @@
+'''
+SAMARA iGEM Research Assistant
+corpus.py
+
+This file creates and reads the corpora of wiki pages served by the benchmark server (see server.py).
+
+A corpus is a directory holding the pages as files and a manifest.json listing them:
+
+    {
+        "years": ["2021"],
+        "generator": {"teams": 100, ...},           # Only for synthetic corpora
+        "pages": {
+            "https://2021.igem.org/Team:Calgary/Model": {"file": "pages/00001.html", "status": 200},
+            ...
+        }
+    }
+
+Synthetic corpora are generated from a fixed random seed, so the same arguments always give the same pages.
+Recorded corpora are saved from a live crawl by the CorpusRecorder downloader middleware.
+
+Doesn't run on it's own; is accessed from __main__.py (python -m benchmarks synthetic/record)
+'''
+
+import hashlib
+import json
+import os
+import random
+from urllib.parse import urlsplit
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+
+TEAM_LIST_URL = 'https://old.igem.org/Team_List?year={year}&name=Championship&division=igem'   # Same as iGEMSpider.team_list_url
+
+# Words used to fill the synthetic pages
+VOCABULARY = (
+    'model', 'kinetics', 'protein', 'expression', 'promoter', 'plasmid', 'simulation', 'parameter', 'rate',
+    'concentration', 'equation', 'ode', 'steady', 'state', 'degradation', 'binding', 'affinity', 'gene',
+    'circuit', 'toggle', 'repressor', 'activator', 'sensitivity', 'analysis', 'software', 'tool', 'python',
+    'interface', 'database', 'sequence', 'alignment', 'pipeline', 'user', 'design', 'assembly', 'biobrick',
+    'part', 'chassis', 'e.', 'coli', 'yeast', 'growth', 'curve', 'fluorescence', 'assay', 'we', 'our', 'the',
+    'a', 'of', 'and', 'to', 'in', 'is', 'was', 'with', 'for', 'that', 'this', 'by', 'on', 'results', 'data',
+)
+PLACES = (
+    'Calgary', 'Edmonton', 'TU_Delft', 'Heidelberg', 'Paris_Bettencourt', 'Tokyo', 'Stockholm', 'Leiden',
+    'Munich', 'Toronto', 'Peking', 'Shanghai', 'Aachen', 'Bielefeld', 'Waterloo', 'Lethbridge', 'Marburg',
+    'Harvard', 'MIT', 'Stanford', 'Oxford', 'Cambridge', 'Vilnius', 'Warsaw', 'Madrid', 'Lisboa', 'Sydney',
+)
+
+# Subpages linked from every team's main page. Notebook and Description are linked but never fetched by
+# the spider (see follow_deny in iGEMScraper.py), so they aren't generated
+SUBPAGES = ('Project', 'Project/Background/Details', 'Team', 'Attributions', 'Human_Practices', 'Safety', 'Notebook', 'Description')
+
+
+def urlKey(url):
+    '''
+    Gets the key a page is stored under in a corpus. The scheme is ignored, as the benchmark crawl is made
+    over http, and the host is lowercased
+
+    Arguments:
+        url (str): the url of a page
+
+    Returns:
+        key (str): host, path, and query of the url
+    '''
+
+    _, netloc, path, query, _ = urlsplit(url)
+    return netloc.lower() + path + ('?' + query if query else '')
+
+
+def loadCorpus(directory):
+    '''
+    Reads the manifest of a corpus and all of its pages into memory
+
+    Arguments:
+        directory (str): the corpus directory
+
+    Returns:
+        manifest (dict): the manifest, see the top of this file
+        pages (dict): url key (see urlKey) -> (status, body bytes)
+    '''
+
+    with open(os.path.join(directory, 'manifest.json'), encoding='utf-8') as file:
+        manifest = json.load(file)
+
+    pages = {}
+    for url, entry in manifest['pages'].items():
+        with open(os.path.join(directory, entry['file']), 'rb') as file:
+            pages[urlKey(url)] = (entry.get('status', 200), file.read())
+
+    return manifest, pages
+
+
+def writeManifest(directory, manifest):
+    temp_file = os.path.join(directory, 'manifest.json.tmp')
+    with open(temp_file, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(temp_file, os.path.join(directory, 'manifest.json'))
+
+
+def renderPage(title, body, links, rng):
+    '''
+    Renders a page laid out like an iGEM wiki: a head full of styles and scripts, a long menu, the
+    bodyContent div, and a footer
+
+    Arguments:
+        title (str): the title of the page
+        body (str): the HTML inside the bodyContent div
+        links [list of str]: urls linked from the menu
+        rng (Random): the random generator of the corpus
+
+    Returns:
+        page (str): the HTML of the page
+    '''
+
+    styles = ''.join(f'.c{i} {{ margin: {rng.randint(0, 20)}px; color: #{rng.randint(0, 0xffffff):06x}; }}\n' for i in range(40))
+    scripts = ''.join(f'<script>var menu{i} = {json.dumps(rng.sample(VOCABULARY, 8))};</script>' for i in range(6))
+    menu = ''.join(f'<li class="c{i % 40}"><a href="{link}">{link.rsplit("/", 1)[-1]}</a></li>' for i, link in enumerate(links))
+
+    return (f'<!DOCTYPE html><html><head><title>{title}</title><style>{styles}</style>{scripts}</head>'
+            f'<body><div id="top_menu"><ul>{menu}</ul></div>'
+            f'<div id="content"><h1 id="firstHeading">{title}</h1><div id="bodyContent">{body}</div></div>'
+            f'<div id="footer"><p>This wiki is part of the iGEM competition.</p><script>track("{title}");</script></div></body></html>')
+
+
+def renderText(rng, paragraphs):
+    '''
+    Renders paragraphs of filler text with the odd equation, table, and inline script
+
+    Arguments:
+        rng (Random): the random generator of the corpus
+        paragraphs (int): the number of paragraphs
+
+    Returns:
+        body (str): the HTML of the text
+    '''
+
+    body = []
+    for i in range(paragraphs):
+        words = ' '.join(rng.choice(VOCABULARY) for _ in range(rng.randint(40, 160)))
+        if rng.random() < 0.2:
+            words += f' $$k_{i} = \\frac{{dP}}{{dt}}$$ '
+        body.append(f'<p class="c{i % 40}">{words}.</p>')
+        if rng.random() < 0.1:
+            rows = ''.join(f'<tr><td>{rng.choice(VOCABULARY)}</td><td>{rng.random():.4f}</td></tr>' for _ in range(10))
+            body.append(f'<table>{rows}</table><script>plot({i});</script>')
+    return ''.join(body)
+
+
+def makeSyntheticCorpus(directory, teams=100, years=('2021', ), seed=0):
+    '''
+    Generates a corpus of iGEM-style wiki pages: a team list for every year, and a main page, Model and
+    Software pages, and a few other subpages for every team. Like the real wikis, some teams have
+    Modeling instead of a Model page, some have no Software page, and some left template pages in
+
+    Arguments:
+        directory (str): the directory to write the corpus to. Created if it doesn't exist
+        teams (int): the number of teams per year
+        years [list of str]: the years of competition
+        seed (int): the random seed
+
+    Returns:
+        manifest (dict): the manifest of the corpus, also written to manifest.json
+    '''
+
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(directory, 'pages'), exist_ok=True)
+    manifest = {'years': list(years), 'generator': {'teams': teams, 'years': list(years), 'seed': seed}, 'pages': {}}
+
+    def addPage(url, page):
+        name = f'pages/{len(manifest["pages"]):05d}.html'
+        with open(os.path.join(directory, name), 'w', encoding='utf-8') as file:
+            file.write(page)
+        manifest['pages'][url] = {'file': name, 'status': 200}
+
+    for year in years:
+        names = [f'{rng.choice(PLACES)}_{i}' for i in range(teams)]
+        team_urls = [f'https://{year}.igem.org/Team:{name}' for name in names]
+        addPage(TEAM_LIST_URL.format(year=year), renderPage(f'Team List {year}', '<p>Championship teams</p>', team_urls, rng))
+
+        for name, team_url in zip(names, team_urls):
+            model = 'Modeling' if rng.random() < 0.15 else 'Model'
+            software = rng.random() < 0.6
+            pages = [model] + (['Software'] if software else [])
+            links = [f'{team_url}/{subpage}' for subpage in SUBPAGES + tuple(pages)]
+
+            addPage(team_url, renderPage(name, renderText(rng, 5), links, rng))
+            for subpage in SUBPAGES[:-2]:
+                addPage(f'{team_url}/{subpage}', renderPage(f'{name}/{subpage}', renderText(rng, rng.randint(2, 10)), links, rng))
+            for subpage in pages:
+                if rng.random() < 0.1:
+                    body = '<p>This is a template page. Replace it with your own content.</p>'
+                else:
+                    body = renderText(rng, rng.randint(10, 80))
+                addPage(f'{team_url}/{subpage}', renderPage(f'{name}/{subpage}', body, links, rng))
+
+    writeManifest(directory, manifest)
+    return manifest
+
+
+class CorpusRecorder:
+    '''
+    A downloader middleware that saves every response of a live crawl into a corpus. Enabled by setting
+    BENCHMARK_RECORD_DIR (see record in __main__.py)
+
+    Arguments:
+        directory (str): the corpus directory
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, 'pages'), exist_ok=True)
+        self.manifest = {'years': [], 'generator': None, 'pages': {}}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        directory = crawler.settings.get('BENCHMARK_RECORD_DIR')
+        if not directory:
+            raise NotConfigured
+        middleware = cls(directory)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def process_response(self, request, response, spider):
+        if not response.url.endswith('/robots.txt'):
+            name = f'pages/{hashlib.sha1(response.url.encode("utf-8")).hexdigest()[:16]}.html'
+            with open(os.path.join(self.directory, name), 'wb') as file:
+                file.write(response.body)
+            self.manifest['pages'][response.url] = {'file': name, 'status': response.status}
+        return response
+
+    def spider_closed(self, spider):
+        self.manifest['years'] = getattr(spider, 'years', []) or ['2021']   # Without the years argument the spider starts at the 2021 team list
+        writeManifest(self.directory, self.manifest)
+        spider.logger.info('Recorded %d pages to %s' % (len(self.manifest['pages']), self.directory))
@@ -0,0 +1,80 @@
+'''
+SAMARA iGEM Research Assistant
+server.py
+
+This file creates the local stand-in for the iGEM servers used by the benchmark. It serves the pages of a
+corpus (see corpus.py) from memory as an HTTP proxy: the spider sends it requests for the real
+https://2021.igem.org/... urls (rewritten to http by the CorpusProxyMiddleware in bench.py), so the urls,
+team names, and years of the scraped pages are the same as in a live crawl. Pages that aren't in the
+corpus get a 404.
+
+It is started in its own process by bench.py, so serving pages doesn't take time from the crawl being
+measured. Can also be run on it's own:
+
+python -m benchmarks.server CORPUS_DIR --port 8080
+'''
+
+import argparse
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.corpus import loadCorpus, urlKey
+
+
+class CorpusHandler(BaseHTTPRequestHandler):
+    '''
+    Answers every GET request with the matching page of the corpus in server.pages
+    '''
+
+    protocol_version = 'HTTP/1.1'   # Keep-alive, like the real servers
+
+    def do_GET(self):
+        url = self.path if '://' in self.path else f'http://{self.headers.get("Host", "")}{self.path}'    # Proxy requests have the full url
+        status, body = self.server.pages.get(urlKey(url), (404, b'Not Found'))
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):   # Logging every request would slow the server down
+        pass
+
+
+def makeServer(corpus, port=0):
+    '''
+    Creates the server for a corpus
+
+    Arguments:
+        corpus (str): the corpus directory
+        port (int): the port to listen on, 0 picks a free one
+
+    Returns:
+        server (ThreadingHTTPServer): the server, call serve_forever to start it
+    '''
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), CorpusHandler)
+    server.daemon_threads = True
+    _, server.pages = loadCorpus(corpus)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serves a benchmark corpus as an HTTP proxy')
+    parser.add_argument('corpus', help='the corpus directory')
+    parser.add_argument('--port', type=int, default=0, help='the port to listen on (default: any free port)')
+    args = parser.parse_args(argv)
+
+    server = makeServer(args.corpus, args.port)
+    print(server.server_address[1], flush=True)     # bench.py reads the port from the first line
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+'''
+SAMARA iGEM Research Assistant
+archive.py
+
+This file creates the on-disk archive of raw responses, so pages that were already downloaded can be
+extracted and exported again after a change to the extraction or the pipeline, without recrawling
+igem.org (see commands/reprocess.py).
+
+The archive is a directory of pack files and an index:
+
+    archive/pack-00000.pack     zlib compressed response bodies, one after the other
+    archive/index.db            SQLite: where every body is, and the url, status, headers, and callback of every page
+
+Bodies are content addressed: they are stored under the SHA-256 of the body, so a page that didn't change
+between crawls (or the same page under two urls) is only stored once. A new pack is started once the
+current one reaches ARCHIVE_PACK_SIZE bytes. Packs are read through mmap, so a body is decompressed
+straight from the page cache without copying the compressed bytes first.
+
+Doesn't run on it's own; is accessed from middlewares.py when ARCHIVE_ENABLED is set, and from the
+reprocess command
+'''
+
+import glob
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import time
+import zlib
+
+
+class ResponseArchive:
+    '''
+    Stores and reads back raw responses (see the top of this file)
+
+    Arguments:
+        directory (str): the archive directory. It is created if it doesn't exist
+        pack_size (int): the size in bytes after which a new pack file is started
+    '''
+
+    def __init__(self, directory, pack_size=256 * 1024 * 1024):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.pack_size = pack_size
+
+        self.connection = sqlite3.connect(os.path.join(directory, 'index.db'), isolation_level=None)  # Autocommit
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                pack INTEGER,
+                offset INTEGER,
+                length INTEGER
+            )''')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                hash TEXT,
+                status INTEGER,
+                headers TEXT,
+                callback TEXT,
+                fetched REAL
+            )''')
+
+        self.writer = None  # The pack being written to, opened on the first put
+        self.maps = {}      # pack number -> mmap, opened on the first get
+
+    def _packPath(self, pack):
+        return os.path.join(self.directory, f'pack-{pack:05d}.pack')
+
+    def _openWriter(self):
+        packs = sorted(glob.glob(os.path.join(self.directory, 'pack-*.pack')))
+        self.pack = int(os.path.basename(packs[-1])[5:10]) if packs else 0
+        self.writer = open(self._packPath(self.pack), 'ab')
+        if self.writer.tell() >= self.pack_size:
+            self._rollover()
+
+    def _rollover(self):
+        self.writer.close()
+        self.pack += 1
+        self.writer = open(self._packPath(self.pack), 'ab')
+
+    def put(self, url, status, headers, body, callback=None):
+        '''
+        Archives a response. The body is only written if an identical body isn't archived yet
+
+        Arguments:
+            url (str): the url of the page
+            status (int): the HTTP status
+            headers (dict): header name -> list of values
+            body (bytes): the raw body
+            callback (str): the name of the spider callback that parses the page, if any
+        '''
+
+        digest = hashlib.sha256(body).hexdigest()
+        if self.connection.execute('SELECT 1 FROM blobs WHERE hash = ?', (digest, )).fetchone() is None:
+            if self.writer is None:
+                self._openWriter()
+            data = zlib.compress(body, 6)
+            offset = self.writer.tell()
+            self.writer.write(data)
+            self.writer.flush()     # The body has to be in the pack before the index points to it
+            self.connection.execute('INSERT INTO blobs VALUES (?, ?, ?, ?)', (digest, self.pack, offset, len(data)))
+            if self.writer.tell() >= self.pack_size:
+                self._rollover()
+
+        self.connection.execute('''
+            INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (url) DO UPDATE SET hash = excluded.hash, status = excluded.status, headers = excluded.headers,
+                                            callback = excluded.callback, fetched = excluded.fetched
+            ''', (url, digest, status, json.dumps(headers), callback, time.time()))
+
+    def get(self, url):
+        '''
+        Reads an archived response back
+
+        Arguments:
+            url (str): the url of the page
+
+        Returns:
+            response (tuple): (status, headers, body, callback), or None if the page isn't archived
+        '''
+
+        row = self.connection.execute('''
+            SELECT responses.status, responses.headers, responses.callback, blobs.pack, blobs.offset, blobs.length
+            FROM responses JOIN blobs ON responses.hash = blobs.hash WHERE responses.url = ?
+            ''', (url, )).fetchone()
+        if row is None:
+            return None
+
+        status, headers, callback, pack, offset, length = row
+        mapped = self.maps.get(pack)
+        if mapped is None or offset + length > len(mapped):    # Not opened yet, or the pack grew since
+            with open(self._packPath(pack), 'rb') as file:
+                mapped = self.maps[pack] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        with memoryview(mapped)[offset:offset + length] as data:
+            body = zlib.decompress(data)
+        return status, json.loads(headers), body, callback
+
+    def urls(self, callbacks=None):
+        '''
+        Lists the archived pages, in the order they are stored in the packs so they are read sequentially
+
+        Arguments:
+            callbacks [list of str]: only list the pages parsed by these callbacks. Every page with a callback if not given
+
+        Returns:
+            urls [list of str]: the urls of the pages
+        '''
+
+        query = '''SELECT responses.url FROM responses JOIN blobs ON responses.hash = blobs.hash
+                   WHERE responses.callback IS NOT NULL'''
+        if callbacks:
+            query += f' AND responses.callback IN ({", ".join("?" * len(callbacks))})'
+        query += ' ORDER BY blobs.pack, blobs.offset'
+
+        return [url for url, in self.connection.execute(query, list(callbacks or ()))]
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        for mapped in self.maps.values():
+            mapped.close()
+        self.connection.close()
@@ -0,0 +1,296 @@
+'''
+SAMARA iGEM Research Assistant
+checkpoint.py
+
+This file creates the CheckpointExtension, which saves the progress of a crawl every CHECKPOINT_INTERVAL seconds
+so a crawl that dies partway (a network outage, a ban, a restarted container) can be continued with the resume
+command instead of starting over (see commands/resume.py):
+
+scrapy resume tomholland
+
+Every checkpoint is written in one transaction to a SQLite database (CHECKPOINT_FILE) with four tables:
+
+    requests    every request queued or being downloaded, and the team and year it belongs to
+    seen        the fingerprint of every request queued so far (the dupefilter)
+    teams       the pages downloaded and exported for every team and year, so it's known which ones finished
+    state       the spider, its arguments, and how far into the output file the exported pages go
+
+A request only leaves the checkpoint once scrapy's engine is done with it: it was taken off the queue and is
+no longer in progress, which is only once its response went through the downloader middlewares (the extraction
+offload too), the spider, and its pages through the pipeline. Requests ignored on the way (by the robots.txt
+check, for example) are done too. The output file is flushed before the checkpoint is written, so the
+checkpoint and the output always agree. When resuming, the output is cut back to where the checkpoint left it
+and appended to, the seen fingerprints are loaded into the dupefilter, and the saved requests are queued
+again, so no page finished before the checkpoint is downloaded twice. At most CHECKPOINT_INTERVAL seconds of
+the crawl are lost.
+
+Doesn't run on it's own; is accessed from scrapy as an extension when CHECKPOINT_ENABLED is set
+'''
+
+import json
+import os
+import pickle
+import sqlite3
+import time
+from collections import defaultdict
+from itertools import chain
+
+from itemadapter import ItemAdapter
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.request import request_fingerprint, request_from_dict
+
+from netscrape_nav.urls import parseUrl
+
+
+class CheckpointStore:
+    '''
+    The SQLite database holding the checkpoint of a crawl (see the top of this file)
+
+    Arguments:
+        path (str): the path of the database file. It is created if it doesn't exist
+    '''
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, isolation_level=None)   # Autocommit, checkpoints are wrapped in transactions
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS requests (id INTEGER PRIMARY KEY, teamname TEXT, year TEXT, data BLOB)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS seen (fingerprint TEXT PRIMARY KEY) WITHOUT ROWID')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS teams (
+                year TEXT,
+                teamname TEXT,
+                fetched INTEGER,
+                exported INTEGER,
+                PRIMARY KEY (year, teamname)
+            )''')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+
+    def save(self, added, removed, seen, teams, state):
+        '''
+        Writes a checkpoint in one transaction, so a crawl that dies while writing it keeps the one before
+
+        Arguments:
+            added [list of (str, str, bytes)]: the teamname, year, and serialized request of every request queued since the last checkpoint
+            removed [list of int]: the ids of the requests finished since the last checkpoint
+            seen [list of str]: the fingerprints of the requests queued since the last checkpoint
+            teams (dict): (year, teamname) -> [downloaded, exported] pages since the last checkpoint
+            state (dict): the values to save in the state table
+
+        Returns:
+            ids [list of int]: the ids of the added requests, in the same order
+        '''
+
+        with self.connection:
+            self.connection.execute('BEGIN')
+            ids = [self.connection.execute('INSERT INTO requests (teamname, year, data) VALUES (?, ?, ?)', request).lastrowid for request in added]
+            self.connection.executemany('DELETE FROM requests WHERE id = ?', [(id, ) for id in removed])
+            self.connection.executemany('INSERT OR IGNORE INTO seen VALUES (?)', [(fingerprint, ) for fingerprint in seen])
+            self.connection.executemany('''INSERT INTO teams VALUES (?, ?, ?, ?) ON CONFLICT (year, teamname)
+                                           DO UPDATE SET fetched = fetched + excluded.fetched, exported = exported + excluded.exported''',
+                                        [(year, teamname, fetched, exported) for (year, teamname), (fetched, exported) in teams.items()])
+            self.connection.executemany('INSERT OR REPLACE INTO state VALUES (?, ?)', [(key, json.dumps(value)) for key, value in state.items()])
+        return ids
+
+    def requests(self):
+        return self.connection.execute('SELECT id, data FROM requests ORDER BY id').fetchall()
+
+    def fingerprints(self):
+        return [fingerprint for fingerprint, in self.connection.execute('SELECT fingerprint FROM seen')]
+
+    def pending(self):
+        return self.connection.execute('SELECT COUNT(*) FROM requests').fetchone()[0]
+
+    def state(self):
+        return {key: json.loads(value) for key, value in self.connection.execute('SELECT key, value FROM state')}
+
+    def progress(self):
+        '''
+        Gets how far the crawl got for every year
+
+        Returns:
+            years (dict): year -> {'teams': teams seen, 'finished': teams with no requests left, 'pending': requests
+                          left, 'exported': pages exported}. Pages that aren't a team's (team lists) only count
+                          towards pending and exported
+        '''
+
+        rows = self.connection.execute('''
+            SELECT year, teamname, SUM(fetched), SUM(exported), SUM(pending) FROM (
+                SELECT year, teamname, fetched, exported, 0 AS pending FROM teams
+                UNION ALL SELECT year, teamname, 0, 0, 1 FROM requests
+            ) GROUP BY year, teamname ORDER BY year''').fetchall()
+
+        years = {}
+        for year, teamname, fetched, exported, pending in rows:
+            progress = years.setdefault(year, {'teams': 0, 'finished': 0, 'pending': 0, 'exported': 0})
+            progress['pending'] += pending
+            progress['exported'] += exported
+            if teamname:
+                progress['teams'] += 1
+                progress['finished'] += bool(fetched and not pending)
+        return years
+
+    def close(self):
+        self.connection.close()
+
+
+def removeCheckpoint(path):
+    for file in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+class CheckpointExtension:
+    '''
+    A scrapy extension saving the progress of the crawl to a CheckpointStore every CHECKPOINT_INTERVAL seconds, and
+    restoring it when CHECKPOINT_RESUME is set (see the top of this file)
+    '''
+
+    RETRY_DELAY = 0.05  # Seconds between tries while a response is going through the spider
+    RETRIES = 100
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.path = settings.get('CHECKPOINT_FILE', 'checkpoint.db')
+        self.interval = settings.getfloat('CHECKPOINT_INTERVAL', 60)
+        self.resume = settings.getbool('CHECKPOINT_RESUME')
+
+        if not self.resume:     # A new crawl, forget the last one
+            removeCheckpoint(self.path)
+        self.store = CheckpointStore(self.path)
+
+        if self.resume:     # Pages exported after the last checkpoint are downloaded again, so they're cut from the output before the pipeline opens it
+            state = self.store.state()
+            output_file = state.get('output_file')
+            if output_file and os.path.exists(output_file) and os.path.getsize(output_file) > state['output_size']:
+                os.truncate(output_file, state['output_size'])
+
+        self.pending = {}       # Request -> id in the checkpoint, None until it's written. Still in the scheduler's queue
+        self.started = {}       # The same, for requests taken off the queue, done once the engine no longer has them in progress
+        self.removed = []       # ids of the requests finished since the last checkpoint
+        self.seen = []          # Fingerprints queued since the last checkpoint
+        self.teams = defaultdict(lambda: [0, 0])    # (year, teamname) -> [downloaded, exported] since the last checkpoint
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('CHECKPOINT_ENABLED'):
+            raise NotConfigured
+        if crawler.settings.get('SCHEDULER', '').endswith('SharedScheduler'):
+            raise NotConfigured('Distributed crawls keep their own progress in DISTRIBUTED_FRONTIER')   # Resumed with scrapy distribute --resume instead
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(s.request_dropped, signal=signals.request_dropped)
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        return s
+
+    def spider_opened(self, spider):
+        from twisted.internet import task    # Imported here so loading the extension doesn't install a reactor
+
+        self.spider = spider
+        scheduler = self.crawler.engine.slot.scheduler
+        next_request = scheduler.next_request
+
+        def nextRequest():  # Scrapy has no signal for a request taken off the queue
+            request = next_request()
+            if request is not None and request in self.pending:
+                self.started[request] = self.pending.pop(request)
+            return request
+        scheduler.next_request = nextRequest
+
+        if self.resume:
+            df = getattr(scheduler, 'df', None)
+            fingerprints = self.store.fingerprints()
+            if df is not None:
+                df.fingerprints.update(fingerprints)
+
+            requests = self.store.requests()
+            for id, data in requests:
+                request = request_from_dict(pickle.loads(data), spider=spider)
+                request.dont_filter = True  # Its fingerprint was just loaded into the dupefilter
+                self.pending[request] = id
+                self.crawler.engine.crawl(request)
+            spider.logger.info('Resumed %d requests and %d seen pages from the checkpoint %s' % (len(requests), len(fingerprints), self.path))
+
+        self.task = task.LoopingCall(self.checkpoint)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.checkpoint(reason=reason)
+        self.store.close()
+
+    def request_scheduled(self, request, spider):
+        self.pending.setdefault(request, None)
+        if not request.dont_filter:
+            self.seen.append(request_fingerprint(request))  # Cached, so the dupefilter doesn't compute it again
+
+    def request_dropped(self, request, spider):
+        id = self.pending.pop(request, None)
+        if id is not None:
+            self.removed.append(id)
+
+    def item_scraped(self, item, response, spider):
+        page = ItemAdapter(item)
+        self.teams[(page.get('year', ''), page.get('teamname', ''))][1] += 1
+
+    def checkpoint(self, attempt=0, reason=None):
+        '''
+        Saves a checkpoint. Waits for any response going through the spider to finish first, as some of its pages
+        could already be exported while the rest aren't yet. Gives up until the next interval after RETRIES tries
+
+        Arguments:
+            attempt (int): the number of tries so far
+            reason (str): the reason the spider closed, for the last checkpoint of the crawl
+        '''
+
+        from twisted.internet import reactor
+
+        slot = self.crawler.engine.scraper.slot
+        if slot is not None and slot.active:
+            if attempt < self.RETRIES:
+                reactor.callLater(self.RETRY_DELAY, self.checkpoint, attempt + 1)
+            else:
+                self.spider.logger.debug('Skipped a checkpoint, the spider was never idle')
+            return
+
+        inprogress = self.crawler.engine.slot.inprogress    # Being downloaded, extracted, waiting for the spider, or in the spider
+        for request in list(self.started):
+            if request not in inprogress:
+                id = self.started.pop(request)
+                if id is not None:
+                    self.removed.append(id)
+                teamname, year = parseUrl(request.url)
+                self.teams[(year, teamname)][0] += 1
+
+        unwritten = [request for request, id in chain(self.pending.items(), self.started.items()) if id is None]
+        added = [(*parseUrl(request.url), pickle.dumps(request.to_dict(spider=self.spider), protocol=4)) for request in unwritten]
+
+        output_file, output_size = None, 0
+        for pipeline in self.crawler.engine.scraper.itemproc.middlewares:
+            if hasattr(pipeline, 'checkpoint'):
+                output_file, output_size = pipeline.checkpoint()
+                output_file = output_file and os.path.abspath(output_file)    # The resume command could be run from another folder
+
+        state = {'spider': self.spider.name, 'arguments': getattr(self.spider, 'arguments', {}), 'output_file': output_file,
+                 'output_size': output_size, 'reason': reason, 'saved': time.time()}
+        ids = self.store.save(added, self.removed, self.seen, self.teams, state)
+        for request, id in zip(unwritten, ids):
+            if request in self.pending:
+                self.pending[request] = id
+            else:
+                self.started[request] = id
+        self.removed, self.seen = [], []
+        self.teams.clear()
+
+        stats = self.crawler.stats
+        stats.inc_value('checkpoint/saved', spider=self.spider)
+        stats.set_value('checkpoint/pending', len(self.pending) + len(self.started), spider=self.spider)
+        progress = self.store.progress()
+        self.spider.logger.info('Checkpoint saved: %d requests left, %d of %d teams finished'
+                                % (len(self.pending) + len(self.started), sum(year['finished'] for year in progress.values()),
+                                   sum(year['teams'] for year in progress.values())))
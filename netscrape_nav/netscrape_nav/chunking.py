@@ -0,0 +1,221 @@
+'''
+SAMARA iGEM Research Assistant
+chunking.py
+
+This file creates the TextChunker and ChunkShardWriter used by the TokenChunker pipeline (see pipelines.py)
+to split the pagetext of every exported page into overlapping chunks of tokens, ready to be fed to language
+models without splitting and tokenizing the text again.
+
+Pages are tokenized in batches with a local tokenizer file (a tokenizer.json saved by the tokenizers or
+transformers package). The text is split into sentences, and every chunk is as many whole sentences as fit in
+CHUNK_MAX_TOKENS tokens. Each chunk starts with the last sentences of the one before, up to CHUNK_OVERLAP
+tokens, so no sentence loses its context at a chunk boundary. Sentences longer than a whole chunk are cut
+into overlapping windows of tokens. The token ids are those of the whole pagetext, without special tokens,
+so a chunk is always exactly a slice of the tokenized page.
+
+The chunks are written to a directory of shards (CHUNK_OUTPUT_DIR):
+
+    samara.chunks/tokens-00000.npy      the token ids of every chunk, one after the other (uint16 if the
+                                        vocabulary fits, uint32 otherwise)
+    samara.chunks/offsets-00000.npy     int64, chunk i is tokens[offsets[i]:offsets[i + 1]]
+    samara.chunks/chunks-00000.jsonl    the url, pagetype, chunk number, and text of every chunk, in the same order
+    samara.chunks/manifest.json         the tokenizer, chunk settings, and shards, written at the end
+
+The .npy files can be memory mapped with numpy.load(path, mmap_mode='r'). A new shard is started once the
+current one holds CHUNK_SHARD_TOKENS tokens.
+
+Doesn't run on it's own; is accessed from pipelines.py when CHUNK_ENABLED is set
+'''
+
+import glob
+import json
+import os
+import re
+
+import numpy as np
+
+try:    # Optional, only needed if CHUNK_ENABLED is set
+    import tokenizers
+except ImportError:
+    tokenizers = None
+
+
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+(?=\S)')  # The space after the end of a sentence. The pagetext is whitespace-collapsed, so there are no paragraphs left to split on
+
+
+def sentenceStarts(pagetext):
+    '''
+    Finds where every sentence of a page starts
+
+    Arguments:
+        pagetext (str): the text from the body of a wiki page
+
+    Returns:
+        starts [list of int]: the index of the first character of every sentence, starting with 0
+    '''
+
+    return [0] + [match.end() for match in SENTENCE_END.finditer(pagetext)]
+
+
+def chunkBoundaries(boundaries, count, max_tokens, overlap):
+    '''
+    Packs sentences into overlapping chunks of at most max_tokens tokens
+
+    Arguments:
+        boundaries [list of int]: the index of the first token of every sentence, in order, starting with 0
+        count (int): the number of tokens of the page
+        max_tokens (int): the most tokens a chunk can have
+        overlap (int): the most tokens a chunk repeats from the end of the one before
+
+    Returns:
+        chunks [list of (int, int)]: the first token and the token after the last of every chunk
+    '''
+
+    boundaries = np.asarray(boundaries + [count])
+    chunks = []
+    start = 0
+    while start < count:
+        end = int(boundaries[np.searchsorted(boundaries, start + max_tokens, side='right') - 1])   # The last sentence end that fits
+        cut = end <= start
+        if cut:     # The sentence is longer than a whole chunk
+            end = min(start + max_tokens, count)
+        chunks.append((start, end))
+        if end >= count:
+            break
+
+        following = int(boundaries[np.searchsorted(boundaries, end - overlap)])    # The first sentence that fits in the overlap
+        if start < following < end:
+            start = following
+        elif cut:
+            start = max(end - overlap, start + 1)
+        else:
+            start = end
+    return chunks
+
+
+class TextChunker:
+    '''
+    Tokenizes pages and splits them into chunks (see the top of this file)
+
+    Arguments:
+        tokenizer_file (str): the tokenizer.json file of the tokenizer
+        max_tokens (int): the most tokens a chunk can have
+        overlap (int): the most tokens a chunk repeats from the end of the one before
+    '''
+
+    def __init__(self, tokenizer_file, max_tokens=512, overlap=64):
+        self.tokenizer = tokenizers.Tokenizer.from_file(tokenizer_file)
+        self.tokenizer.no_truncation()  # The whole page is tokenized, whatever the file was saved with
+        self.tokenizer.no_padding()
+        self.max_tokens = max_tokens
+        self.overlap = min(overlap, max_tokens - 1)     # Every chunk has to move forward
+        self.dtype = np.uint16 if self.tokenizer.get_vocab_size() <= 65536 else np.uint32
+
+    def chunk(self, pagetexts):
+        '''
+        Tokenizes a batch of pages at once and splits them into chunks
+
+        Arguments:
+            pagetexts [list of str]: the text of every page
+
+        Returns:
+            pages [list of list of (str, ndarray)]: the text and token ids of every chunk of every page
+        '''
+
+        pages = []
+        for pagetext, encoding in zip(pagetexts, self.tokenizer.encode_batch(pagetexts, add_special_tokens=False)):   # Tokenized in parallel by the tokenizers library
+            ids = np.asarray(encoding.ids, dtype=self.dtype)
+            offsets = encoding.offsets
+            if not len(ids):
+                pages.append([])
+                continue
+
+            token_starts = np.fromiter((start for start, _ in offsets), dtype=np.int64, count=len(offsets))
+            boundaries = sorted(set(np.searchsorted(token_starts, sentenceStarts(pagetext)).tolist()) - {len(ids)})
+            chunks = []
+            for start, end in chunkBoundaries(boundaries, len(ids), self.max_tokens, self.overlap):
+                chunks.append((pagetext[offsets[start][0]:offsets[end - 1][1]], ids[start:end]))
+            pages.append(chunks)
+        return pages
+
+
+class ChunkShardWriter:
+    '''
+    Writes chunks to shards of .npy token arrays and JSON lines text (see the top of this file). A shard is kept
+    in memory until it is full, then written to .tmp files that are renamed once complete
+
+    Arguments:
+        directory (str): the directory the shards are written to
+        shard_tokens (int): the number of tokens after which a new shard is started
+        dtype (dtype): the numpy type of the token ids
+    '''
+
+    def __init__(self, directory, shard_tokens=16 * 1024 * 1024, dtype=np.uint32):
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, '*-*.npy')) + glob.glob(os.path.join(directory, 'chunks-*.jsonl')):
+            os.remove(path)     # Shards left by the last run, like opening samara.jl with 'wb' overwrites it
+        self.directory = directory
+        self.shard_tokens = shard_tokens
+        self.dtype = dtype
+
+        self.shards = []    # Number of chunks and tokens of every shard written
+        self._reset()
+
+    def _reset(self):
+        self.arrays = []
+        self.lengths = []
+        self.texts = []
+        self.tokens = 0
+
+    def write(self, url, pagetype, chunks):
+        '''
+        Adds the chunks of a page to the current shard
+
+        Arguments:
+            url (str): the url of the page
+            pagetype (str): the type of the page
+            chunks [list of (str, ndarray)]: the text and token ids of every chunk (see TextChunker.chunk)
+        '''
+
+        for number, (text, ids) in enumerate(chunks):
+            self.arrays.append(ids)
+            self.lengths.append(len(ids))
+            self.texts.append(json.dumps({'url': url, 'pagetype': pagetype, 'chunk': number, 'text': text}, ensure_ascii=False))
+            self.tokens += len(ids)
+
+        if self.tokens >= self.shard_tokens:
+            self.flush()
+
+    def flush(self):
+        if not self.lengths:
+            return
+
+        number = len(self.shards)
+        paths = {name: os.path.join(self.directory, f'{name}-{number:05d}.{extension}')
+                 for name, extension in (('tokens', 'npy'), ('offsets', 'npy'), ('chunks', 'jsonl'))}
+        offsets = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=offsets[1:])
+
+        with open(paths['tokens'] + '.tmp', 'wb') as file:
+            np.save(file, np.concatenate(self.arrays).astype(self.dtype, copy=False))
+        with open(paths['offsets'] + '.tmp', 'wb') as file:
+            np.save(file, offsets)
+        with open(paths['chunks'] + '.tmp', 'w', encoding='utf-8') as file:
+            file.write('\n'.join(self.texts) + '\n')
+        for path in paths.values():
+            os.replace(path + '.tmp', path)     # Only complete shards ever have their final name
+
+        self.shards.append({'shard': number, 'chunks': len(self.lengths), 'tokens': self.tokens})
+        self._reset()
+
+    def close(self, manifest):
+        '''
+        Writes the last shard and the manifest
+
+        Arguments:
+            manifest (dict): the tokenizer and chunk settings, saved in manifest.json along with the shards
+        '''
+
+        self.flush()
+        with open(os.path.join(self.directory, 'manifest.json'), 'w', encoding='utf-8') as file:
+            json.dump(dict(manifest, dtype=np.dtype(self.dtype).name, shards=self.shards), file, indent=2)
@@ -0,0 +1,4 @@
+# Custom scrapy commands of the project, found through COMMANDS_MODULE in settings.py
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/commands.html#custom-project-commands
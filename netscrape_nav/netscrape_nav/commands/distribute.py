@@ -0,0 +1,104 @@
+'''
+SAMARA iGEM Research Assistant
+distribute.py
+
+This file creates the distribute command, which splits a crawl over several worker processes sharing one
+queue and dupefilter (see distributed.py). Run from the first netscrape_nav folder:
+
+scrapy distribute tomholland --workers 4
+
+Every worker is a normal scrapy crawl using the SharedScheduler, crawls the pages of its own share of the
+teams, and exports them to its own file (samara.worker-0.jl, ...), logging to samara.worker-0.log. Once
+every worker is done, their files are merged into SAMARA_OUTPUT_FILE.
+
+If a worker (or the whole command) stops before the crawl is done, running the command again with --resume
+keeps the shared queue and the exported pages, and every worker continues where it stopped. To spread the
+workers over several machines, start them on every machine with --worker-index, pointing DISTRIBUTED_FRONTIER
+at a filesystem they share, then run the command with --merge-only to merge their files:
+
+scrapy distribute tomholland --workers 4 --worker-index 0,1 -s DISTRIBUTED_FRONTIER=/shared/frontier.db
+
+Doesn't run on it's own; is accessed through scrapy when running the command
+'''
+
+import os
+import subprocess
+import sys
+
+from scrapy.commands import BaseRunSpiderCommand
+from scrapy.exceptions import UsageError
+
+from netscrape_nav.distributed import SharedFrontier, mergeShards
+
+
+class Command(BaseRunSpiderCommand):
+
+    requires_project = True
+
+    def syntax(self):
+        return '[options] <spider>'
+
+    def short_desc(self):
+        return 'Run a crawl split over several worker processes sharing one frontier'
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='the number of workers of the whole crawl (default: one per CPU)')
+        parser.add_argument('--worker-index', metavar='LIST', help='only start these workers, comma separated (default: all of them)')
+        parser.add_argument('--resume', action='store_true', help='continue a crawl that stopped, instead of starting over')
+        parser.add_argument('--merge-only', action='store_true', help="don't crawl, only merge the output of the workers")
+
+    def workerFile(self, index, extension):
+        return f'{os.path.splitext(self.settings.get("SAMARA_OUTPUT_FILE", "samara.jl"))[0]}.worker-{index}{extension}'
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        if self.settings.get('EXPORT_FORMAT', 'jl') != 'jl':
+            raise UsageError('The distribute command only works with EXPORT_FORMAT jl', print_help=False)
+
+        frontier_path = self.settings.get('DISTRIBUTED_FRONTIER', 'frontier.db')
+        output_file = self.settings.get('SAMARA_OUTPUT_FILE', 'samara.jl')
+        indices = [int(i) for i in opts.worker_index.split(',')] if opts.worker_index else list(range(opts.workers))
+        if any(not 0 <= i < opts.workers for i in indices):
+            raise UsageError(f'Worker indices go from 0 to {opts.workers - 1}', print_help=False)
+
+        if not opts.merge_only:
+            if not opts.resume:     # Start over: forget the queue and the pages the last crawl exported
+                for path in [frontier_path, frontier_path + '-wal', frontier_path + '-shm'] + [self.workerFile(i, '.jl') for i in indices]:
+                    if os.path.exists(path):
+                        os.remove(path)
+            SharedFrontier(frontier_path).close()   # Created here, so the workers don't all create it at once
+
+            workers = []
+            for i in indices:
+                command = [sys.executable, '-m', 'scrapy', 'crawl', args[0]]
+                for name, value in opts.spargs.items():
+                    command += ['-a', f'{name}={value}']
+                for setting in (opts.set or []):    # NAME=VALUE strings, passed on as they are so -s works like it does for crawl
+                    command += ['-s', setting]
+                command += [
+                    '-s', 'SCHEDULER=netscrape_nav.distributed.SharedScheduler',
+                    '-s', f'DISTRIBUTED_FRONTIER={frontier_path}',
+                    '-s', f'DISTRIBUTED_WORKERS={opts.workers}',
+                    '-s', f'DISTRIBUTED_WORKER_INDEX={i}',
+                    '-s', f'SAMARA_OUTPUT_FILE={self.workerFile(i, ".jl")}',
+                    '-s', 'SAMARA_OUTPUT_APPEND=1',
+                    '-s', f'LOG_FILE={self.workerFile(i, ".log")}',
+                ]
+                workers.append(subprocess.Popen(command))
+            print(f'Started {len(workers)} of {opts.workers} workers, logging to {self.workerFile("N", ".log")}')
+
+            failed = [i for i, worker in zip(indices, workers) if worker.wait() != 0]
+            if failed:
+                print(f'Workers {", ".join(map(str, failed))} failed, see their logs')
+                self.exitcode = 1
+
+        frontier = SharedFrontier(frontier_path)
+        left = frontier.pending()
+        frontier.close()
+        count = mergeShards(output_file, [self.workerFile(i, '.jl') for i in range(opts.workers)])
+        print(f'Merged {count} pages into {output_file}')
+        if left:
+            print(f'{left} pages were not crawled yet, run the command again with --resume to crawl them')
+            self.exitcode = 1
@@ -0,0 +1,146 @@
+'''
+SAMARA iGEM Research Assistant
+reprocess.py
+
+This file creates the reprocess command, which extracts and exports every page in the response archive
+(see archive.py) again without downloading anything. Useful after changing the extraction, the filters, or
+anything else in the pipeline. Run from the first netscrape_nav folder:
+
+scrapy reprocess tomholland --workers 8
+
+The spider callbacks, where the extraction happens, run in parallel in a pool of worker processes that
+each read the archive on their own. The items they yield are sent back and go through the item pipelines
+(KeystoneXL) in this process, in archive order, so the output is written by a single exporter exactly like
+in a crawl. Only the pages archived with a callback are reprocessed.
+
+Doesn't run on it's own; is accessed through scrapy when running the command
+'''
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from itemadapter import ItemAdapter, is_item
+from scrapy import Request
+from scrapy.commands import BaseRunSpiderCommand
+from scrapy.crawler import Crawler
+from scrapy.exceptions import DropItem, UsageError
+from scrapy.http import HtmlResponse
+from scrapy.pipelines import ItemPipelineManager
+from scrapy.settings import Settings
+from scrapy.utils.misc import load_object
+
+from netscrape_nav.archive import ResponseArchive
+from netscrape_nav.items import WikiPage
+
+
+worker = {}     # The spider and archive of a worker process, set by startWorker
+
+
+def startWorker(settings, spidercls, spider_args, archive_dir):
+    '''
+    Initializer of the worker processes. Creates the spider the callbacks are called on and opens the archive
+
+    Arguments:
+        settings (dict): the settings of the command
+        spidercls (str): the import path of the spider class
+        spider_args (dict): the spider arguments (-a)
+        archive_dir (str): the archive directory
+    '''
+
+    crawler = Crawler(load_object(spidercls), Settings(settings))
+    worker['spider'] = crawler._create_spider(**spider_args)
+    worker['archive'] = ResponseArchive(archive_dir)
+
+
+def reprocessPages(urls):
+    '''
+    Runs the spider callbacks on archived pages, in a worker process
+
+    Arguments:
+        urls [list of str]: the urls of the pages
+
+    Returns:
+        results [list of tuple]: (url, items as dicts, error) for every page. error is None if the callback worked
+    '''
+
+    spider, archive = worker['spider'], worker['archive']
+    results = []
+    for url in urls:
+        status, headers, body, callback = archive.get(url)
+        request = Request(url, meta={'extract': True})
+        response = HtmlResponse(url, status=status, headers=headers, body=body, request=request)
+        try:
+            items = [ItemAdapter(item).asdict() for item in getattr(spider, callback)(response) or () if is_item(item)]   # Requests (from parseTeamList) aren't followed
+        except Exception as e:
+            results.append((url, [], repr(e)))
+        else:
+            results.append((url, items, None))
+    return results
+
+
+class Command(BaseRunSpiderCommand):
+
+    requires_project = True
+
+    def syntax(self):
+        return '[options] <spider>'
+
+    def short_desc(self):
+        return 'Extract and export the pages in the response archive again, without a recrawl'
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument('--archive', metavar='DIR', help='the archive directory (default: ARCHIVE_DIR)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='the number of worker processes (default: one per CPU)')
+        parser.add_argument('--chunk-size', type=int, default=64, help='the number of pages sent to a worker at once')
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+
+        archive_dir = opts.archive or self.settings.get('ARCHIVE_DIR', 'archive')
+        if not os.path.exists(os.path.join(archive_dir, 'index.db')):
+            raise UsageError(f'No response archive in {archive_dir}, crawl with ARCHIVE_ENABLED first', print_help=False)
+
+        archive = ResponseArchive(archive_dir)
+        urls = archive.urls()
+        archive.close()
+
+        crawler = self.crawler_process.create_crawler(args[0])
+        spider = crawler.spider = crawler._create_spider(**opts.spargs)
+        stats = crawler.stats
+        stats.open_spider(spider)
+        pipelines = ItemPipelineManager.from_crawler(crawler)
+        pipelines.open_spider(spider)
+
+        def itemDropped(failure):
+            failure.trap(DropItem)
+            stats.inc_value('item_dropped_count', spider=spider)
+            spider.logger.debug('Dropped: %s' % failure.value)
+
+        def itemFailed(failure):
+            stats.inc_value('reprocess/pipeline_errors', spider=spider)
+            spider.logger.error('Error processing an item: %s' % failure.getTraceback())
+
+        start = time.perf_counter()
+        chunks = [urls[i:i + opts.chunk_size] for i in range(0, len(urls), opts.chunk_size)]
+        spidercls = f'{crawler.spidercls.__module__}.{crawler.spidercls.__name__}'
+        with ProcessPoolExecutor(opts.workers, initializer=startWorker, initargs=(self.settings.copy_to_dict(), spidercls, opts.spargs, archive_dir)) as executor:
+            for results in executor.map(reprocessPages, chunks):    # In archive order, so the output is in the same order every time
+                for url, items, error in results:
+                    stats.inc_value('reprocess/pages', spider=spider)
+                    if error is not None:
+                        stats.inc_value('reprocess/callback_errors', spider=spider)
+                        spider.logger.error('Error reprocessing %s: %s' % (url, error))
+                    for item in items:
+                        d = pipelines.process_item(WikiPage(item), spider)
+                        d.addCallbacks(lambda item: stats.inc_value('item_scraped_count', spider=spider), itemDropped)
+                        d.addErrback(itemFailed)
+
+        pipelines.close_spider(spider)
+        elapsed = time.perf_counter() - start
+        stats.set_value('reprocess/seconds', round(elapsed, 3), spider=spider)
+        spider.logger.info('Reprocessed %d pages in %.1fs (%.1f pages/sec) with %d workers'
+                           % (len(urls), elapsed, len(urls) / elapsed if elapsed else 0, opts.workers))
+        stats.close_spider(spider, reason='finished')
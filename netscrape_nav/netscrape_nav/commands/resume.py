@@ -0,0 +1,91 @@
+'''
+SAMARA iGEM Research Assistant
+resume.py
+
+This file creates the resume command, which continues a crawl that stopped from its last checkpoint (see
+checkpoint.py). The crawl has to be run with CHECKPOINT_ENABLED set. Run from the first netscrape_nav folder:
+
+scrapy resume
+
+The spider and its arguments are the ones saved in the checkpoint, unless they are given again. Pages
+finished before the checkpoint aren't downloaded again, and the output file is appended to instead of
+overwritten. To only see how far the crawl got, run:
+
+scrapy resume --status
+
+Doesn't run on it's own; is accessed through scrapy when running the command
+'''
+
+import os
+import time
+
+from scrapy.commands import BaseRunSpiderCommand
+from scrapy.exceptions import UsageError
+
+from netscrape_nav.checkpoint import CheckpointStore
+
+
+class Command(BaseRunSpiderCommand):
+
+    requires_project = True
+
+    def syntax(self):
+        return '[options] [<spider>]'
+
+    def short_desc(self):
+        return 'Continue a crawl that stopped, from its last checkpoint'
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument('--checkpoint', metavar='FILE', help='the checkpoint database (default: CHECKPOINT_FILE)')
+        parser.add_argument('--status', action='store_true', help="only show how far the crawl got, don't resume it")
+
+    def run(self, args, opts):
+        if len(args) > 1:
+            raise UsageError()
+        if self.settings.get('EXPORT_FORMAT', 'jl') != 'jl':
+            raise UsageError('The resume command only works with EXPORT_FORMAT jl', print_help=False)
+
+        path = opts.checkpoint or self.settings.get('CHECKPOINT_FILE', 'checkpoint.db')
+        if not os.path.exists(path):
+            raise UsageError(f'No checkpoint in {path}, crawl with CHECKPOINT_ENABLED first', print_help=False)
+
+        store = CheckpointStore(path)
+        state = store.state()
+        pending = store.pending()
+        started = bool(pending or store.fingerprints())
+        progress = store.progress()
+        store.close()
+
+        saved = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state['saved'])) if 'saved' in state else 'never'
+        print(f'Checkpoint {path}, saved {saved}' + (f' (stopped: {state["reason"]})' if state.get('reason') else ''))
+        for year, counts in progress.items():
+            if not counts['teams'] and not counts['pending']:  # Only team lists, all downloaded
+                continue
+            print(f'    {year or "no year"}: {counts["finished"]} of {counts["teams"]} teams finished, '
+                  f'{counts["pending"]} requests left, {counts["exported"]} pages exported')
+        if opts.status:
+            return
+
+        if state.get('reason') == 'finished' and not pending:
+            print('The crawl already finished, nothing to resume')
+            return
+
+        spider = args[0] if args else state.get('spider')
+        if spider is None:
+            raise UsageError('The checkpoint has no spider saved yet, give its name', print_help=False)
+        spider_args = dict(state.get('arguments') or {}, **opts.spargs)
+
+        self.settings.set('CHECKPOINT_ENABLED', True, priority='cmdline')
+        self.settings.set('CHECKPOINT_FILE', path, priority='cmdline')
+        if started:     # Otherwise the crawl died before its first checkpoint, and starts over
+            self.settings.set('CHECKPOINT_RESUME', True, priority='cmdline')
+            self.settings.set('SAMARA_OUTPUT_APPEND', True, priority='cmdline')
+
+        crawl_defer = self.crawler_process.crawl(spider, **spider_args)
+        if getattr(crawl_defer, 'result', None) is not None and issubclass(crawl_defer.result.type, Exception):
+            self.exitcode = 1
+        else:
+            self.crawler_process.start()
+            if self.crawler_process.bootstrap_failed:
+                self.exitcode = 1
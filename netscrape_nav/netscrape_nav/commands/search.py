@@ -0,0 +1,89 @@
+'''
+SAMARA iGEM Research Assistant
+search.py
+
+This file creates the search command, which searches the full text index of the scraped pages (see search.py
+in the folder above). Run from the first netscrape_nav folder:
+
+scrapy search "ODE solver" --year 2021 --pagetype Software
+
+The index is filled during the crawl if SEARCH_ENABLED is set. To index an output file that was already
+scraped instead, run:
+
+scrapy search --build samara.jl
+
+Doesn't run on it's own; is accessed through scrapy when running the command
+'''
+
+import json
+import os
+import time
+
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from netscrape_nav.search import SearchIndex, quoteQuery
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+    default_settings = {'LOG_ENABLED': False}
+
+    def syntax(self):
+        return '[options] <query>'
+
+    def short_desc(self):
+        return 'Search the scraped pages, ranked with BM25'
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument('--index', metavar='FILE', help='the index database (default: SEARCH_INDEX_FILE)')
+        parser.add_argument('--build', metavar='FILE', help='add the pages of a JSON lines output file to the index, instead of searching')
+        parser.add_argument('--year', action='append', default=[], help='only show pages from this year (may be repeated)')
+        parser.add_argument('--pagetype', action='append', default=[], help='only show pages of this type (may be repeated)')
+        parser.add_argument('--team', action='append', default=[], help='only show pages of this team (may be repeated)')
+        parser.add_argument('--limit', type=int, default=10, help='the most results shown (default: 10)')
+        parser.add_argument('--json', action='store_true', help='print the results as JSON lines')
+
+    def run(self, args, opts):
+        path = opts.index or self.settings.get('SEARCH_INDEX_FILE', 'samara.db')
+
+        if opts.build:
+            index = SearchIndex(path)
+            batch_size = self.settings.getint('SEARCH_BATCH_SIZE', 500)
+            with open(opts.build, 'rb') as file:
+                batch = []
+                for line in file:
+                    batch.append(json.loads(line))
+                    if len(batch) >= batch_size:
+                        index.add(batch)
+                        batch = []
+                index.add(batch)
+            index.optimize()
+            print(f'Indexed {opts.build}, {index.count()} pages in {path}')
+            index.close()
+            return
+
+        if len(args) != 1:
+            raise UsageError()
+        if not quoteQuery(args[0]):
+            raise UsageError(f'Invalid query {args[0]!r}, it has no words to search for', print_help=False)
+        if not os.path.exists(path):
+            raise UsageError(f'No search index in {path}, crawl with SEARCH_ENABLED or run scrapy search --build samara.jl first', print_help=False)
+
+        index = SearchIndex(path)
+        start = time.perf_counter()
+        results = index.search(args[0], opts.year, opts.pagetype, opts.team, opts.limit)
+        elapsed = time.perf_counter() - start
+        index.close()
+
+        if opts.json:
+            for result in results:
+                print(json.dumps(result, ensure_ascii=False))
+            return
+
+        for result in results:
+            print(f'{result["score"]:7.2f}  {result["year"]}  {result["pagetype"]:<10} {result["teamname"]:<24} {result["url"]}')
+            print(f'         {result["snippet"]}')
+        print(f'{len(results)} results in {elapsed * 1000:.1f} ms')
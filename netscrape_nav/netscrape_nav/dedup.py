@@ -0,0 +1,146 @@
+'''
+SAMARA iGEM Research Assistant
+dedup.py
+
+This file creates the NearDuplicateIndex used by the KeystoneXL pipeline (see pipelines.py) to find pages
+that are copies or near copies of a page already exported, like template text left on several pages or
+a Model page copied over to the Software page or to the next year's wiki.
+
+Every page gets a MinHash signature computed from the word shingles (overlapping runs of words) of its
+pagetext. The share of equal values between two signatures estimates how similar the two pages are
+(their Jaccard similarity). To avoid comparing every page to every other page, the signatures are split
+into bands and stored in a locality-sensitive hashing (LSH) index: only pages with at least one identical
+band are compared.
+
+Doesn't run on it's own; is accessed from pipelines.py when DEDUP_ENABLED is set
+'''
+
+import os
+import zlib
+
+import numpy as np
+
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+
+class NearDuplicateIndex:
+    '''
+    An in-memory LSH index of MinHash signatures, optionally saved to a file between runs
+
+    Arguments:
+        threshold (float): the estimated similarity (0 to 1) above which two pages are near duplicates
+        num_perm (int): the number of hash functions, and so values, in a signature
+        bands (int): the number of bands the signatures are split into. More bands find more candidates
+        shingle_size (int): the number of words in a shingle
+    '''
+
+    def __init__(self, threshold=0.8, num_perm=128, bands=32, shingle_size=5):
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+
+        generator = np.random.RandomState(1)    # Fixed seed, so signatures saved by an earlier run can still be compared
+        self.a = generator.randint(1, 1 << 32, size=(num_perm, 1), dtype=np.uint64)
+        self.b = generator.randint(0, 1 << 32, size=(num_perm, 1), dtype=np.uint64)
+
+        self.urls = []          # The url of every indexed page
+        self.signatures = []    # The signature of every indexed page, in the same order
+        self.ids = {}           # url -> position in urls and signatures
+        self.tables = [{} for _ in range(bands)]    # One table per band: band bytes -> positions of the pages with that band
+
+    def signature(self, pagetext):
+        '''
+        Computes the MinHash signature of a page
+
+        Arguments:
+            pagetext (str): the text from the body of a wiki page
+
+        Returns:
+            signature (ndarray): num_perm uint64 values
+        '''
+
+        words = pagetext.split()
+        count = max(1, len(words) - self.shingle_size + 1)
+        shingles = {' '.join(words[i:i + self.shingle_size]) for i in range(count)}
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))  # crc32 is stable between runs, unlike hash()
+
+        # (a * hash + b) % prime for every hash function at once. a, b and the hashes fit in 32 bits, so this can't overflow
+        return ((self.a * hashes + self.b) % MERSENNE_PRIME).min(axis=1)
+
+    def _bands(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def query(self, signature, url=None):
+        '''
+        Finds the most similar indexed page, if it is similar enough to be a near duplicate
+
+        Arguments:
+            signature (ndarray): the signature of the page (see signature)
+            url (str): the url of the page, so it isn't reported as a duplicate of itself
+
+        Returns:
+            url (str): the url of the indexed page it is a near duplicate of, or None
+        '''
+
+        candidates = set()
+        for table, band in zip(self.tables, self._bands(signature)):
+            candidates.update(table.get(band, ()))
+        candidates.discard(self.ids.get(url))
+
+        best, best_similarity = None, self.threshold
+        for candidate in candidates:
+            similarity = np.count_nonzero(self.signatures[candidate] == signature) / self.num_perm
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+
+        return None if best is None else self.urls[best]
+
+    def add(self, url, signature):
+        '''
+        Adds a page to the index, replacing its old signature if it was already indexed
+
+        Arguments:
+            url (str): the url of the page
+            signature (ndarray): the signature of the page (see signature)
+        '''
+
+        position = self.ids.get(url)
+        if position is None:
+            position = self.ids[url] = len(self.urls)
+            self.urls.append(url)
+            self.signatures.append(signature)
+        else:
+            for table, band in zip(self.tables, self._bands(self.signatures[position])):    # Forget the old version of the page
+                table[band].remove(position)
+            self.signatures[position] = signature
+
+        for table, band in zip(self.tables, self._bands(signature)):
+            table.setdefault(band, []).append(position)
+
+    def save(self, path):
+        '''
+        Saves the indexed urls and signatures to a .npz file. The file is written next to the path and renamed
+        over it so it is never left half written
+        '''
+
+        temp_file = path + '.tmp.npz'
+        signatures = np.stack(self.signatures) if self.signatures else np.empty((0, self.num_perm), dtype=np.uint64)
+        np.savez(temp_file, urls=np.array(self.urls, dtype=str), signatures=signatures)
+        os.replace(temp_file, path)
+
+    def load(self, path):
+        '''
+        Adds the urls and signatures saved by an earlier run (see save) to the index
+        '''
+
+        with np.load(path) as saved:
+            if saved['signatures'].shape[1:] != (self.num_perm, ):
+                raise ValueError(f'{path} was saved with a different number of hash functions')
+            for url, signature in zip(saved['urls'], saved['signatures']):
+                self.add(str(url), signature)
@@ -0,0 +1,366 @@
+'''
+SAMARA iGEM Research Assistant
+distributed.py
+
+This file creates the shared frontier used to split one crawl over several worker processes, on one machine
+or on several machines sharing a filesystem (see commands/distribute.py).
+
+The request queue and the dupefilter of every worker live in one SQLite database (DISTRIBUTED_FRONTIER)
+instead of in memory:
+
+    - Every request is stored under its fingerprint, so a page found by two workers is only crawled once
+    - Requests are sharded by team (or by year, DISTRIBUTED_SHARD_BY), and every worker only crawls its own
+      shard (DISTRIBUTED_WORKER_INDEX of DISTRIBUTED_WORKERS). Links found by one worker to another team's
+      pages are queued for the worker that owns that team
+    - A request is only marked done once scrapy's engine is done with it (its pages went through the pipeline,
+      or it was ignored or failed on the way) and the output file was flushed, so a worker that crashes and is
+      started again with the same index picks up where it left off
+    - Every worker reports its heartbeat, and splits DISTRIBUTED_CONCURRENCY (and DOWNLOAD_DELAY) with the
+      other live workers, so all of them combined still send igem.org as many requests as a single crawl
+    - A worker only closes once every other worker is idle too, as any of them could still find pages for it.
+      It waits up to DISTRIBUTED_WORKER_TIMEOUT for workers that haven't started yet
+
+Doesn't run on it's own; is accessed from scrapy as the SCHEDULER when running the distribute command
+'''
+
+import json
+import os
+import pickle
+import sqlite3
+import time
+import zlib
+from collections import deque
+from urllib.parse import urlsplit
+
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from scrapy.utils.request import request_fingerprint, request_from_dict
+
+from netscrape_nav.frontier import TEAM_PAGE
+
+
+def shardKey(url, shard_by='team'):
+    '''
+    Gets what a url is sharded by
+
+    Arguments:
+        url (str): the url of a request
+        shard_by (str): 'team' or 'year'
+
+    Returns:
+        key (str): the host, followed by the team name for team pages if sharding by team
+    '''
+
+    host = urlsplit(url).netloc.lower()     # 2021.igem.org, so the year
+    match = TEAM_PAGE.search(url)
+    if shard_by == 'team' and match is not None:
+        return f'{host}/{match.group(1).casefold()}'
+    return host
+
+
+class SharedFrontier:
+    '''
+    The SQLite database holding the requests of every worker and the state of the workers
+
+    Arguments:
+        path (str): the path of the database file. It is created if it doesn't exist
+        timeout (float): the seconds after which a worker that didn't report a heartbeat is considered dead
+    '''
+
+    PENDING, CLAIMED, DONE = 0, 1, 2
+
+    def __init__(self, path, timeout=60):
+        self.timeout = timeout
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)   # Autocommit, waits for other workers' writes
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS requests (
+                id INTEGER PRIMARY KEY,
+                fingerprint TEXT UNIQUE,
+                shard INTEGER,
+                priority INTEGER,
+                state INTEGER,
+                data BLOB
+            )''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS queue ON requests (shard, state, priority DESC, id)')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS workers (
+                shard INTEGER PRIMARY KEY,
+                heartbeat REAL,
+                idle INTEGER,
+                finished INTEGER
+            )''')
+
+    def push(self, fingerprint, shard, priority, data):
+        '''
+        Queues a request, unless a request with the same fingerprint was ever queued. The worker of the shard
+        is marked as busy, so no worker closes before it crawls the request
+
+        Arguments:
+            fingerprint (str): the fingerprint of the request, None to queue it even if it was seen before
+            shard (int): the shard of the request
+            priority (int): the scrapy priority of the request, higher is crawled sooner
+            data (bytes): the serialized request
+
+        Returns:
+            queued (bool): False if the request was a duplicate
+        '''
+
+        with self.connection:   # One transaction
+            self.connection.execute('BEGIN IMMEDIATE')
+            cursor = self.connection.execute('INSERT OR IGNORE INTO requests (fingerprint, shard, priority, state, data) VALUES (?, ?, ?, ?, ?)',
+                                             (fingerprint, shard, priority, self.PENDING, data))
+            if cursor.rowcount:
+                self.connection.execute('UPDATE workers SET idle = 0 WHERE shard = ?', (shard, ))
+        return bool(cursor.rowcount)
+
+    def claim(self, shard, count):
+        '''
+        Takes the next requests of a shard off the queue, highest priority first
+
+        Returns:
+            requests [list of (int, bytes)]: the id and serialized request of every claimed request
+        '''
+
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            rows = self.connection.execute('SELECT id, data FROM requests WHERE shard = ? AND state = ? ORDER BY priority DESC, id LIMIT ?',
+                                           (shard, self.PENDING, count)).fetchall()
+            self.connection.executemany('UPDATE requests SET state = ? WHERE id = ?', [(self.CLAIMED, id) for id, _ in rows])
+        return rows
+
+    def done(self, ids):
+        self.connection.executemany('UPDATE requests SET state = ?, data = NULL WHERE id = ?', [(self.DONE, id) for id in ids])
+
+    def release(self, shard):
+        '''
+        Puts the claimed requests of a shard back in the queue. Called when a worker starts, as the requests its
+        last run claimed but never finished were lost when it stopped
+
+        Returns:
+            count (int): the number of requests put back
+        '''
+
+        return self.connection.execute('UPDATE requests SET state = ? WHERE shard = ? AND state = ?', (self.PENDING, shard, self.CLAIMED)).rowcount
+
+    def pending(self, shard=None):
+        '''
+        Returns:
+            count (int): the number of queued requests of a shard, or of every shard
+        '''
+
+        if shard is None:
+            return self.connection.execute('SELECT COUNT(*) FROM requests WHERE state != ?', (self.DONE, )).fetchone()[0]
+        return self.connection.execute('SELECT COUNT(*) FROM requests WHERE shard = ? AND state = ?', (shard, self.PENDING)).fetchone()[0]
+
+    def register(self, shard):
+        self.connection.execute('INSERT OR REPLACE INTO workers VALUES (?, ?, 0, 0)', (shard, time.time()))
+
+    def heartbeat(self, shard):
+        self.connection.execute('UPDATE workers SET heartbeat = ? WHERE shard = ?', (time.time(), shard))
+
+    def idle(self, shard, finished=False):
+        '''
+        Marks a worker as idle: it has nothing queued or in flight. Only another worker queueing a request for its
+        shard marks it busy again (see push)
+        '''
+        self.connection.execute('UPDATE workers SET heartbeat = ?, idle = 1, finished = ? WHERE shard = ?', (time.time(), int(finished), shard))
+
+    def liveWorkers(self):
+        '''
+        Returns:
+            count (int): the number of workers running right now
+        '''
+
+        return self.connection.execute('SELECT COUNT(*) FROM workers WHERE finished = 0 AND heartbeat > ?', (time.time() - self.timeout, )).fetchone()[0]
+
+    def busyWorkers(self, shard):
+        '''
+        Arguments:
+            shard (int): the shard of the worker asking, left out of the count
+
+        Returns:
+            registered (int): the number of workers that ever started, the asking one included
+            busy (int): the number of other live workers that aren't idle
+        '''
+
+        registered = self.connection.execute('SELECT COUNT(*) FROM workers').fetchone()[0]
+        busy = self.connection.execute('SELECT COUNT(*) FROM workers WHERE shard != ? AND finished = 0 AND idle = 0 AND heartbeat > ?',
+                                       (shard, time.time() - self.timeout)).fetchone()[0]
+        return registered, busy
+
+    def close(self):
+        self.connection.close()
+
+
+class SharedScheduler:
+    '''
+    A scrapy scheduler keeping its queue and dupefilter in the SharedFrontier (see the top of this file), used
+    instead of the default scheduler by setting SCHEDULER to netscrape_nav.distributed.SharedScheduler
+
+    Arguments:
+        crawler (Crawler): the crawler of the worker
+    '''
+
+    CLAIM_SIZE = 16     # Requests taken off the shared queue at once
+    HEARTBEAT = 5       # Seconds between heartbeats
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.path = settings.get('DISTRIBUTED_FRONTIER', 'frontier.db')
+        self.workers = settings.getint('DISTRIBUTED_WORKERS', 1)
+        self.shard = settings.getint('DISTRIBUTED_WORKER_INDEX', 0)
+        self.shard_by = settings.get('DISTRIBUTED_SHARD_BY', 'team')
+        self.concurrency = settings.getint('DISTRIBUTED_CONCURRENCY', 30)
+        self.delay = settings.getfloat('DOWNLOAD_DELAY')
+        self.timeout = settings.getfloat('DISTRIBUTED_WORKER_TIMEOUT', 60)
+        self.adaptive = settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED')
+
+        self.claimed = deque()  # (id, request) claimed from the frontier, not handed to the engine yet
+        self.inflight = {}      # Request -> id, for requests handed to the engine, done once it no longer has them in progress
+        self.heartbeat = None
+        self.started = None     # When this worker opened, it only waits this long for workers that never start
+        self.share = None       # This worker's share of DISTRIBUTED_CONCURRENCY, AdaptiveConcurrencyMiddleware stays under it
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_idle, signal=signals.spider_idle)
+        return s
+
+    def open(self, spider):
+        from twisted.internet import task    # Imported here so loading the scheduler doesn't install a reactor
+
+        self.spider = spider
+        self.frontier = SharedFrontier(self.path, self.timeout)
+        released = self.frontier.release(self.shard)
+        self.frontier.register(self.shard)
+        self.started = time.time()
+        spider.logger.info('Worker %d of %d using the shared frontier %s (%d requests resumed)' % (self.shard, self.workers, self.path, released))
+
+        self.heartbeat = task.LoopingCall(self.beat)
+        self.heartbeat.start(self.HEARTBEAT)
+
+    def close(self, reason):
+        if self.heartbeat is not None and self.heartbeat.running:
+            self.heartbeat.stop()
+        self.finish()
+        if self.claimed or self.inflight:   # Closed early (Ctrl-C, CLOSESPIDER_...), leave them for the next run
+            self.frontier.release(self.shard)
+        self.frontier.idle(self.shard, finished=True)
+        self.frontier.close()
+
+    def has_pending_requests(self):
+        return bool(self.claimed) or self.frontier.pending(self.shard) > 0
+
+    def enqueue_request(self, request):
+        if request.dont_filter and 'frontier_id' in request.meta:   # Retries of a request, queued again
+            fingerprint = None
+        else:   # Start requests are dont_filter too, but every worker makes them so they're only queued once
+            fingerprint = request_fingerprint(request)
+
+        shard = zlib.crc32(shardKey(request.url, self.shard_by).encode('utf-8')) % self.workers
+        data = pickle.dumps(request.to_dict(spider=self.spider), protocol=4)
+        queued = self.frontier.push(fingerprint, shard, request.priority, data)
+
+        if queued:
+            self.stats.inc_value('distributed/enqueued', spider=self.spider)
+            if shard != self.shard:
+                self.stats.inc_value('distributed/handed_off', spider=self.spider)
+        else:
+            self.stats.inc_value('dupefilter/filtered', spider=self.spider)
+        return queued
+
+    def next_request(self):
+        if not self.claimed:
+            for id, data in self.frontier.claim(self.shard, self.CLAIM_SIZE):
+                self.claimed.append((id, data))
+            if not self.claimed:
+                return None
+
+        id, data = self.claimed.popleft()
+        request = request_from_dict(pickle.loads(data), spider=self.spider)
+        request.meta['frontier_id'] = id
+        self.inflight[request] = id
+        self.stats.inc_value('distributed/dequeued', spider=self.spider)
+        return request
+
+    def __len__(self):
+        return len(self.claimed) + self.frontier.pending(self.shard)
+
+    def finish(self):
+        '''
+        Marks the requests the engine is done with as done in the frontier, after flushing the output file so
+        their pages can't be lost if the worker crashes after
+        '''
+        inprogress = self.crawler.engine.slot.inprogress    # Being downloaded, extracted, waiting for the spider, or in the spider
+        finished = [self.inflight.pop(request) for request in list(self.inflight) if request not in inprogress]
+        if not finished:
+            return
+
+        for pipeline in self.crawler.engine.scraper.itemproc.middlewares:
+            if hasattr(pipeline, 'checkpoint'):
+                pipeline.checkpoint()
+        self.frontier.done(finished)
+
+    def spider_idle(self, spider):
+        '''
+        Keeps the worker open while another worker could still find pages for it
+        '''
+        self.finish()
+        self.frontier.idle(self.shard)
+
+        registered, busy = self.frontier.busyWorkers(self.shard)    # Checked before the queue, so requests queued by a worker that just went idle are seen
+        starting = registered < self.workers and time.time() - self.started < self.timeout   # Past the timeout, workers that never started count as dead
+        if starting or busy or self.frontier.pending(self.shard):
+            raise DontCloseSpider
+
+    def beat(self):
+        '''
+        Reports the heartbeat of the worker, marks the finished requests done, and splits the politeness budget
+        with the other live workers
+        '''
+        self.finish()
+        self.frontier.heartbeat(self.shard)
+
+        live = max(1, self.frontier.liveWorkers())
+        self.share = share = max(1, self.concurrency // live)
+        downloader = self.crawler.engine.downloader
+        downloader.domain_concurrency = share   # Used for new downloader slots
+        for slot in downloader.slots.values():
+            slot.concurrency = min(slot.concurrency, share) if self.adaptive else share    # AdaptiveConcurrencyMiddleware still backs off below the share
+            slot.delay = self.delay * live
+
+
+def mergeShards(output_file, shard_files):
+    '''
+    Merges the JSON lines output of every worker into one file. A page exported more than once (by a worker
+    that crashed and resumed) is only kept once, the last time it was exported. The merged file is written
+    next to the output file and renamed over it, so it is never left half written
+
+    Arguments:
+        output_file (str): the merged output file
+        shard_files [list of str]: the output files of the workers
+
+    Returns:
+        count (int): the number of pages in the merged file
+    '''
+
+    pages = {}
+    for shard_file in shard_files:
+        if not os.path.exists(shard_file):
+            continue
+        with open(shard_file, 'rb') as file:
+            for line in file:
+                page = json.loads(line)
+                pages.pop((page['url'], page['pagetype']), None)    # Moves it to the end, like it was exported last
+                pages[(page['url'], page['pagetype'])] = line
+
+    temp_file = output_file + '.tmp'
+    with open(temp_file, 'wb') as merged:
+        merged.writelines(pages.values())
+    os.replace(temp_file, output_file)
+    return len(pages)
@@ -0,0 +1,203 @@
+'''
+SAMARA iGEM Research Assistant
+exporters.py
+
+This file creates the ShardedExporter, used by the KeystoneXL pipeline (see pipelines.py) when EXPORT_FORMAT
+is set to anything other than 'jl'. Instead of one big samara.jl, the pages are written in batches to a
+directory of shards split by year and pagetype:
+
+    samara/year=2021/pagetype=Model/part-00000.jsonl.gz
+
+The year=/pagetype= folder names are the layout pyarrow and pandas expect for partitioned datasets. A
+shard is written to a .tmp file and only renamed to its final name once it is complete, so anything
+reading the directory never sees a half written file. A new part is started once a shard reaches
+EXPORT_SHARD_SIZE bytes.
+
+Formats:
+    jsonl.gz: gzip compressed JSON lines
+    jsonl.zst: zstandard compressed JSON lines (needs the zstandard package)
+    parquet: Parquet, one row group per batch, without the year and pagetype columns (needs the pyarrow package)
+    bin: uncompressed length-prefixed records, each one a 4 byte little-endian length followed by the
+         UTF-8 JSON of the page. Simple to memory map and walk without parsing every record
+
+Doesn't run on it's own; is accessed from pipelines.py when running the command
+'''
+
+import glob
+import gzip
+import json
+import os
+import struct
+
+from itemadapter import ItemAdapter
+from scrapy.exceptions import NotConfigured
+from scrapy.exporters import BaseItemExporter
+
+from netscrape_nav.items import WikiPage
+
+try:    # Optional, only needed for the jsonl.zst and parquet formats
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class JsonLinesShard:
+    '''
+    Writes batches of pages as compressed JSON lines
+
+    Arguments:
+        path (str): the file to write to
+        compression (str): 'gz' or 'zst'
+    '''
+
+    def __init__(self, path, compression):
+        self.raw = open(path, 'wb')
+        if compression == 'gz':
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=6)
+        else:
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.raw)
+
+    def write(self, pages):
+        self.stream.write(b''.join(json.dumps(page, ensure_ascii=False).encode('utf-8') + b'\n' for page in pages))
+
+    def size(self):
+        return self.raw.tell()  # Compressed bytes written so far
+
+    def close(self):
+        self.stream.close()
+        if not self.raw.closed:
+            self.raw.close()
+
+
+class BinaryShard:
+    '''
+    Writes batches of pages as length-prefixed JSON records (see the top of this file)
+
+    Arguments:
+        path (str): the file to write to
+    '''
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+
+    def write(self, pages):
+        records = []
+        for page in pages:
+            record = json.dumps(page, ensure_ascii=False).encode('utf-8')
+            records.append(struct.pack('<I', len(record)))
+            records.append(record)
+        self.file.write(b''.join(records))
+
+    def size(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetShard:
+    '''
+    Writes batches of pages as row groups of a Parquet file. The year and pagetype columns are left out, as
+    they are already in the folder names and pyarrow adds them back when reading the directory as a dataset
+
+    Arguments:
+        path (str): the file to write to
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.schema = pyarrow.schema([(field, pyarrow.string()) for field in WikiPage.fields if field not in ('year', 'pagetype')])   # Every field, null where a page doesn't have it (duplicate_of)
+        self.writer = pyarrow.parquet.ParquetWriter(self.path, self.schema, compression='zstd')
+
+    def write(self, pages):
+        self.writer.write_table(pyarrow.Table.from_pylist(pages, schema=self.schema))   # Keys not in the schema (year, pagetype) are left out
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def close(self):
+        self.writer.close()
+
+
+SHARD_TYPES = {
+    'jsonl.gz': lambda path: JsonLinesShard(path, 'gz'),
+    'jsonl.zst': lambda path: JsonLinesShard(path, 'zst'),
+    'parquet': ParquetShard,
+    'bin': BinaryShard,
+}
+
+
+class ShardedExporter(BaseItemExporter):
+    '''
+    A scrapy item exporter that buffers items and writes them in batches to shards split by year and pagetype
+    (see the top of this file)
+
+    Arguments:
+        directory (str): the directory the shards are written to
+        format (str): one of the keys of SHARD_TYPES
+        batch_size (int): the number of items buffered per shard before they are written
+        shard_size (int): the size in bytes after which a shard is closed and a new part is started
+    '''
+
+    def __init__(self, directory, format='jsonl.gz', batch_size=500, shard_size=128 * 1024 * 1024, **kwargs):
+        super().__init__(dont_fail=True, **kwargs)
+        if format not in SHARD_TYPES:
+            raise NotConfigured(f'Unknown EXPORT_FORMAT {format}, expected one of jl, {", ".join(SHARD_TYPES)}')
+        if format == 'jsonl.zst' and zstandard is None:
+            raise NotConfigured('EXPORT_FORMAT jsonl.zst needs the zstandard package (pip install zstandard)')
+        if format == 'parquet' and pyarrow is None:
+            raise NotConfigured('EXPORT_FORMAT parquet needs the pyarrow package (pip install pyarrow)')
+        self.directory = directory
+        self.format = format
+        self.batch_size = batch_size
+        self.shard_size = shard_size
+        self.shards = {}    # (year, pagetype) -> {'buffer', 'part', 'writer', 'path'}
+
+    def start_exporting(self):
+        for path in glob.glob(os.path.join(self.directory, 'year=*', 'pagetype=*', f'part-*.{self.format}')):
+            os.remove(path)     # Shards left by the last run, like opening samara.jl with 'wb' overwrites it
+
+    def export_item(self, item):
+        page = ItemAdapter(item).asdict()
+        key = (str(page.get('year')), str(page.get('pagetype')))
+        shard = self.shards.get(key)
+        if shard is None:
+            shard = self.shards[key] = {'buffer': [], 'part': 0, 'writer': None, 'path': None}
+
+        shard['buffer'].append(page)
+        if len(shard['buffer']) >= self.batch_size:
+            self._flush(key, shard)
+
+    def finish_exporting(self):
+        for key, shard in self.shards.items():
+            if shard['buffer']:
+                self._flush(key, shard)
+            self._finalize(shard)
+
+    def _flush(self, key, shard):
+        if shard['writer'] is None:
+            year, pagetype = key
+            folder = os.path.join(self.directory, f'year={year}', f'pagetype={pagetype}')
+            os.makedirs(folder, exist_ok=True)
+            shard['path'] = os.path.join(folder, f'part-{shard["part"]:05d}.{self.format}')
+            shard['writer'] = SHARD_TYPES[self.format](shard['path'] + '.tmp')
+
+        shard['writer'].write(shard['buffer'])
+        shard['buffer'] = []
+
+        if shard['writer'].size() >= self.shard_size:   # Roll over to a new part
+            self._finalize(shard)
+            shard['part'] += 1
+
+    def _finalize(self, shard):
+        if shard['writer'] is None:
+            return
+        shard['writer'].close()
+        os.replace(shard['path'] + '.tmp', shard['path'])  # Only complete shards ever have their final name
+        shard['writer'] = None
@@ -0,0 +1,149 @@
+'''
+SAMARA iGEM Research Assistant
+extraction.py
+
+This file contains the HTML cleaning and text extraction engine used to turn the raw HTML of a wiki
+page into the pagetext stored in a WikiPage item (see items.py).
+
+The page is parsed once into an lxml tree, cleaned in place, pruned in a single pass, and the text is
+pulled straight from the tree. There is no round trip through an HTML string and a second parser.
+
+Doesn't run on it's own; is accessed from iGEMScraper.py when running the command
+'''
+
+from functools import cached_property
+
+from lxml import etree, html
+from lxml.html.clean import Cleaner
+from w3lib.encoding import html_to_unicode
+
+
+CLEANER = Cleaner(style=True, javascript=True, scripts=True)   # Created once and reused for every page instead of once per page
+
+# Removes exactly the same elements and text as CLEANER, but leaves attributes alone. Rewriting links and
+# stripping unsafe attributes is most of the cleaning cost and never changes the extracted text
+TEXT_CLEANER = Cleaner(style=True, javascript=False, scripts=True, safe_attrs_only=False)
+
+TAGS_TO_REMOVE = ('nav', 'footer', 'header', 'h1', 'h2', 'h3', 'ul', 'li', 'table')    # Tags that never hold useful body text
+
+BODY_TEXT = etree.XPath("descendant-or-self::div[@id = 'bodyContent']/descendant-or-self::text()")    # Same XPath parsel builds from the old 'div#bodyContent *::text' CSS selector
+
+CHARS_TO_REMOVE = (r'\\n', r'\n', r'\t', r'\\t')   # List of newline and tab chars that I observed during testing that needed to be removed
+
+
+def parseHTML(page_html, cleaner=CLEANER):
+    '''
+    Parses the HTML of a scraped page into an lxml tree and cleans it, removing any Javascript, style,
+    scripts, and the tags listed in TAGS_TO_REMOVE
+
+    Arguments:
+        page_html (str): the full HTML content of the scraped page
+        cleaner (Cleaner): the lxml Cleaner to run on the page. Use TEXT_CLEANER if only the text is needed
+
+    Returns:
+        page (HtmlElement): the cleaned root element of the page
+    '''
+
+    page = html.fromstring(page_html)   # Turns the HTML string into an lxml HTML Element
+
+    cleaner(page)   # Cleans the page in place. Cleaner.clean_html would deep copy the whole tree first
+
+    etree.strip_elements(page, *TAGS_TO_REMOVE, with_tail=True)    # Removes every unwanted tag in one pass over the tree, along with its tail text like node.getparent().remove(node) did.
+                                                                    # This has to run after the cleaner, as dropped tags (head, form, unknown tags...) can move text around
+
+    return page
+
+def normalizeText(pagetext):
+    '''
+    Cleans the text of a wiki page from quotes, newlines, tabs, and excessive whitespace
+
+    Arguments:
+        pagetext (str): the raw text joined from the body of a wiki page
+
+    Returns:
+        pagetext (str): the normalized text
+    '''
+
+    pagetext = pagetext.replace('"', "'")   # Replaces the '"' characters with ''' in order to avoid premature closing of the string in the export file.
+
+    for char in CHARS_TO_REMOVE:    # Iterates through CHARS_TO_REMOVE and removes the chars from the pagetext
+        pagetext = pagetext.replace(char, '')
+
+    return ' '.join(pagetext.split())  # Cleans weird spacing and newlines
+
+def getBodytext(page):
+    '''
+    Gets the normalized text content of the bodyContent div from a cleaned page tree
+
+    Arguments:
+        page (HtmlElement): the cleaned root element of the page (see parseHTML)
+
+    Returns:
+        pagetext (str): the text from the body of a wiki page
+    '''
+
+    return normalizeText(' '.join(BODY_TEXT(page)))
+
+def extractPagetext(page_html):
+    '''
+    Runs the full extraction on the HTML of a scraped page: parse and clean it once, then pull the
+    body text out of the tree
+
+    Arguments:
+        page_html (str): the full HTML content of the scraped page
+
+    Returns:
+        pagetext (str): the text from the body of a wiki page
+    '''
+
+    return getBodytext(parseHTML(page_html, TEXT_CLEANER))
+
+def extractPagebody(body, encoding):
+    '''
+    Runs the full extraction on the raw bytes of a scraped page. Used by the ExtractionOffloadMiddleware
+    (see middlewares.py) so worker processes only get sent the response body instead of a decoded copy
+
+    Arguments:
+        body (bytes): the raw body of the scraped page
+        encoding (str): the encoding of the page, as detected by scrapy (response.encoding)
+
+    Returns:
+        pagetext (str): the text from the body of a wiki page
+    '''
+
+    page_html = html_to_unicode(f'charset={encoding}', body)[1]    # Decodes the body the exact same way scrapy's response.text does
+
+    return extractPagetext(page_html)
+
+
+class ParsedPage:
+    '''
+    The extracted forms of a scraped page, shared by every page type the page is scraped as. Each one is only
+    computed the first time it is used, so the page is parsed and cleaned at most once, and never if its
+    pagetext was already extracted in a worker process (see ExtractionOffloadMiddleware in middlewares.py)
+
+    Arguments:
+        response (Response): the response given by the Scrapy request
+    '''
+
+    def __init__(self, response):
+        self.response = response
+
+    @cached_property
+    def tree(self):
+        page_html = html_to_unicode(f'charset={self.response.encoding}', self.response.body)[1]   # The same as response.text, without the response keeping a copy
+        return parseHTML(page_html, TEXT_CLEANER)  # The cleaned root element of the page
+
+    @cached_property
+    def pagetext(self):
+        offloaded = self.response.meta.get('pagetext')  # Only set if EXTRACTION_OFFLOAD_ENABLED is on
+        return offloaded if offloaded is not None else getBodytext(self.tree)
+
+    def release(self):
+        '''
+        Frees the cleaned tree and lets go of the response as soon as the pagetext is extracted. The response
+        itself is kept alive by scrapy until every item of the page is exported, so the page is decoded for the
+        tree without going through response.text, which would keep a full copy of the page cached on it
+        '''
+        self.__dict__.pop('tree', None)
+        self.response = None    # Only the cached pagetext can be read after this
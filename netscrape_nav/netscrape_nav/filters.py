@@ -0,0 +1,128 @@
+'''
+SAMARA iGEM Research Assistant
+filters.py
+
+This file creates the FilterEngine used by the KeystoneXL pipeline (see pipelines.py) to drop invalid pages
+and clean up the pagetext of the rest.
+
+The rules come from settings.py (FILTER_DROP_RULES, FILTER_REWRITE_RULES, FILTER_MIN_LENGTH), or from the
+YAML or JSON file in FILTER_RULES_FILE:
+
+    drop:
+      - No Page Text                    # A plain string, dropped if found anywhere in the pagetext
+      - name: Empty notebook            # Or a regular expression, with the name reported when it fires
+        regex: 'Notebook\\s+Coming soon'
+    rewrite:
+      - name: equations
+        regex: '\\$\\$.+?\\$\\$'
+        replace: ''
+    min_length: 100
+
+All the drop rules are compiled into one regular expression, so a page is scanned once no matter how many
+rules there are. The rewrite rules are also combined into one expression and applied in a single pass.
+Replacements are plain strings; backreferences like \\1 are not supported.
+
+Doesn't run on it's own; is accessed from pipelines.py when running the command
+'''
+
+import re
+
+import yaml
+
+
+def compileRules(rules, prefix):
+    '''
+    Combines a list of rules into a single regular expression with one named group per rule
+
+    Arguments:
+        rules [list of (str, str)]: (name, regular expression) pairs
+        prefix (str): the prefix of the group names
+
+    Returns:
+        pattern (Pattern): the combined expression, or None if there are no rules
+        names (dict): group name -> rule name
+    '''
+
+    if not rules:
+        return None, {}
+
+    names = {f'{prefix}{i}': name for i, (name, _) in enumerate(rules)}
+    pattern = re.compile('|'.join(f'(?P<{prefix}{i}>{regex})' for i, (_, regex) in enumerate(rules)))
+    return pattern, names
+
+
+class FilterEngine:
+    '''
+    Applies the drop and rewrite rules to the pagetext of a page
+
+    Arguments:
+        drop_rules [list]: strings to drop pages on, or dicts with a name and a regex
+        rewrite_rules [list]: dicts with a name, a regex, and the string to replace it with
+        min_length (int): the shortest pagetext a page can have without being dropped (checked by the pipeline)
+    '''
+
+    def __init__(self, drop_rules=(), rewrite_rules=(), min_length=0):
+        drop = []
+        for rule in drop_rules:
+            if isinstance(rule, str):
+                drop.append((rule, re.escape(rule)))
+            else:
+                drop.append((rule.get('name', rule['regex']), rule['regex']))
+        self.drop, self.drop_names = compileRules(drop, 'd')
+
+        self.rewrite, self.rewrite_names = compileRules([(rule.get('name', rule['regex']), rule['regex']) for rule in rewrite_rules], 'r')
+        self.replacements = {group: rewrite_rules[int(group[1:])].get('replace', '') for group in self.rewrite_names}
+
+        self.min_length = min_length
+
+    @classmethod
+    def fromSettings(cls, settings):
+        '''
+        Creates the engine from settings.py, or from FILTER_RULES_FILE if it is set
+        '''
+
+        rules = {
+            'drop': settings.getlist('FILTER_DROP_RULES'),
+            'rewrite': settings.getlist('FILTER_REWRITE_RULES'),
+            'min_length': settings.getint('FILTER_MIN_LENGTH'),
+        }
+
+        path = settings.get('FILTER_RULES_FILE')
+        if path:
+            with open(path, encoding='utf-8') as file:
+                rules.update(yaml.safe_load(file) or {})    # JSON files are valid YAML too
+
+        return cls(rules['drop'], rules['rewrite'], rules['min_length'])
+
+    def check(self, pagetext):
+        '''
+        Checks a page against the drop rules
+
+        Arguments:
+            pagetext (str): the text from the body of a wiki page
+
+        Returns:
+            rule (str): the name of the rule the page is dropped for, or None if no rule matched
+        '''
+
+        if self.drop is None:
+            return None
+
+        match = self.drop.search(pagetext)
+        return None if match is None else self.drop_names[match.lastgroup]
+
+    def apply(self, pagetext):
+        '''
+        Applies every rewrite rule to a page in a single pass
+
+        Arguments:
+            pagetext (str): the text from the body of a wiki page
+
+        Returns:
+            pagetext (str): the rewritten text
+        '''
+
+        if self.rewrite is None:
+            return pagetext
+
+        return self.rewrite.sub(lambda match: self.replacements[match.lastgroup], pagetext)
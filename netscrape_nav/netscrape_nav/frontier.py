@@ -0,0 +1,129 @@
+'''
+SAMARA iGEM Research Assistant
+frontier.py
+
+This file creates the UrlClassifier used by the spider to decide which of the links found on a page are
+worth following to discover more Model and Software pages.
+
+Instead of running every allow and deny pattern separately on every link, they are combined into a
+single compiled regular expression. Links are also canonicalized and deduplicated before a request is
+ever built for them, and links that point too deep into a team's wiki are skipped.
+
+Doesn't run on it's own; is accessed from iGEMScraper.py when running the command
+'''
+
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+TEAM_PAGE = re.compile(r'Team:([^/?#]+)((?:/[^/?#]*)*)')    # Team:Name followed by any number of /Subpages
+
+
+class UrlClassifier:
+    '''
+    Decides which links to follow, keeping track of what was pruned and why so it can be reported at the
+    end of the crawl.
+
+    Arguments:
+        allow [list of str]: regular expressions, a link must match at least one of them to be followed
+        deny [list of str]: regular expressions, a link matching any of them is never followed
+        max_depth (int): how many subpages deep under a team's page (Team:Name/a/b...) links are followed.
+                         Team:Name is depth 0 and Team:Name/Project is depth 1. None to follow them at any depth
+
+    Attributes:
+        followed (int): the number of unique links followed so far
+        pruned (dict): the number of unique links pruned so far, by reason ('denied', 'too_deep', 'duplicate')
+    '''
+
+    def __init__(self, allow, deny, max_depth):
+        # A single pattern: the lookahead fails if any deny pattern is anywhere in the url, otherwise any allow pattern is searched for
+        self.pattern = re.compile('^(?!.*(?:%s)).*?(?:%s)' % ('|'.join(deny) or '(?!)', '|'.join(allow)), re.DOTALL)
+        self.max_depth = max_depth
+
+        self.seen = set()   # Dedupe keys of every link classified so far
+        self.followed = 0
+        self.pruned = {'denied': 0, 'too_deep': 0, 'duplicate': 0}
+
+    def canonicalize(self, url):
+        '''
+        Rewrites the different forms of the same wiki url into one. The scheme and host are lowercased, the
+        fragment is dropped, and index.php?title=Team:Name urls become /Team:Name
+
+        Arguments:
+            url (str): the url of a link
+
+        Returns:
+            url (str): the canonical url
+        '''
+
+        scheme, netloc, path, query, _ = urlsplit(url)
+
+        if path.endswith('/index.php'):  # MediaWiki serves /index.php?title=Page as /Page
+            params = parse_qsl(query, keep_blank_values=True)
+            title = dict(params).get('title')
+            if title is not None:   # Not ?subtitle= or any other parameter ending in title
+                path = path[:-len('index.php')] + title.replace(' ', '_')
+                query = urlencode([(key, value) for key, value in params if key != 'title'])
+
+        return urlunsplit((scheme.lower(), netloc.lower(), path, query, ''))
+
+    def depth(self, url):
+        '''
+        Gets how many subpages deep a url is under its team's page
+
+        Arguments:
+            url (str): the url of a link
+
+        Returns:
+            depth (int): 0 for Team:Name, 1 for Team:Name/Project, and so on. 0 if the url isn't a team page
+        '''
+
+        match = TEAM_PAGE.search(url)
+        if match is None:
+            return 0
+
+        return sum(1 for subpage in match.group(2).split('/') if subpage)   # Ignores trailing and doubled slashes
+
+    def classify(self, url):
+        '''
+        Decides if a link should be followed
+
+        Arguments:
+            url (str): the url of a link
+
+        Returns:
+            url (str): the canonical url to request, or None if the link was pruned
+        '''
+
+        url = self.canonicalize(url)
+        key = url.rstrip('/').casefold()    # Same page under a different case or with a trailing slash
+
+        if key in self.seen:
+            self.pruned['duplicate'] += 1
+            return None
+        self.seen.add(key)
+
+        if self.pattern.search(url) is None:
+            self.pruned['denied'] += 1
+            return None
+
+        if self.max_depth is not None and self.depth(url) > self.max_depth:
+            self.pruned['too_deep'] += 1
+            return None
+
+        self.followed += 1
+        return url
+
+    def score(self, url):
+        '''
+        Gets the request priority of a followed link. Pages closer to the team's main page are hubs that link
+        to more of the wiki, so they get crawled first
+
+        Arguments:
+            url (str): the url of a followed link
+
+        Returns:
+            priority (int): the scrapy request priority, higher is crawled sooner
+        '''
+
+        return -self.depth(url)
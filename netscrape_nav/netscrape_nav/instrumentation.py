@@ -0,0 +1,346 @@
+'''
+SAMARA iGEM Research Assistant
+instrumentation.py
+
+This file creates the instrumentation used to see where a crawl spends its time. The spider callbacks,
+the KeystoneXL pipeline, and the downloader middlewares record how long every stage takes into
+histograms (see Metrics), and the InstrumentationExtension adds the download latency and the size of
+every page downloaded and exported.
+
+Every stage also keeps a running count and total in the scrapy stats (timing/<stage>/count and
+timing/<stage>/seconds), and its percentiles are added to the stats at the end of the crawl. While the
+crawl runs, the metrics can be watched live:
+
+    METRICS_PORT: serves the stats and histograms as Prometheus text on http://127.0.0.1:<port>/metrics
+    METRICS_DUMP_FILE: writes the stats and histogram percentiles as JSON every METRICS_DUMP_INTERVAL seconds
+
+The peak resident memory of the crawl is also recorded every METRICS_MEMORY_INTERVAL pages (1000 by default),
+in memory/peak_rss_mb and the memory/peak_rss_mb_per_1k_pages list, to check that a crawl stays in its budget.
+
+Doesn't run on it's own; is accessed from iGEMScraper.py, pipelines.py, and middlewares.py when running the command
+'''
+
+import json
+import os
+import re
+import sys
+import time
+from contextlib import contextmanager
+
+from itemadapter import ItemAdapter
+from scrapy import signals
+
+try:    # Not available on Windows, where the peak memory isn't recorded
+    import resource
+except ImportError:
+    resource = None
+
+
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)   # Seconds
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(8))   # 1 KiB to 16 MiB
+PERCENTILES = (50, 90, 99)
+
+
+class Histogram:
+    '''
+    Counts observations into fixed buckets, like a Prometheus histogram, so it takes the same memory no
+    matter how long the crawl runs
+
+    Arguments:
+        buckets [list of float]: the upper bounds of the buckets, in increasing order. A last bucket for
+                                 everything above them is added
+    '''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percentile):
+        '''
+        Estimates a percentile of the observed values by interpolating inside the bucket it falls in
+
+        Arguments:
+            percentile (float): between 0 and 100
+
+        Returns:
+            value (float): the estimate, or None if nothing was observed
+        '''
+
+        if not self.count:
+            return None
+
+        rank = self.count * percentile / 100
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0
+                if i == len(self.buckets):  # Above the last bound, nothing better to report than the bound
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    '''
+    The histograms of every stage of one crawl, kept up to date in the scrapy stats as well. Use
+    getMetrics to get the one of a crawler
+
+    Arguments:
+        stats (StatsCollector): the stats of the crawler
+    '''
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.timings = {}   # stage -> Histogram of seconds
+        self.sizes = {}     # name -> Histogram of bytes
+
+    def observe(self, stage, seconds):
+        histogram = self.timings.get(stage)
+        if histogram is None:
+            histogram = self.timings[stage] = Histogram(TIME_BUCKETS)
+        histogram.observe(seconds)
+        self.stats.inc_value(f'timing/{stage}/count')
+        self.stats.inc_value(f'timing/{stage}/seconds', seconds)
+
+    def observeSize(self, name, size):
+        histogram = self.sizes.get(name)
+        if histogram is None:
+            histogram = self.sizes[name] = Histogram(SIZE_BUCKETS)
+        histogram.observe(size)
+        self.stats.inc_value(f'bytes/{name}', size)
+
+    @contextmanager
+    def time(self, stage):
+        '''
+        Times the code inside the with block as one observation of a stage
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timeIterator(self, stage, iterator):
+        '''
+        Times a generator, like a spider callback, as one observation of a stage. Only the time spent inside
+        the generator counts, not the time the caller takes between items
+
+        Arguments:
+            stage (str): the name of the stage
+            iterator (iterable): the generator to time
+
+        Yields:
+            the items of the generator
+        '''
+        iterator = iter(iterator)
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    value = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield value
+        finally:
+            self.observe(stage, elapsed)
+
+    def percentiles(self):
+        '''
+        Returns:
+            percentiles (dict): stage or size -> p50, p90, and p99 estimates, in milliseconds for the
+                                stages and bytes for the sizes
+        '''
+        summary = {}
+        for stage, histogram in self.timings.items():
+            summary[f'timing/{stage}'] = {f'p{p}_ms': histogram.percentile(p) * 1000 for p in PERCENTILES}
+        for name, histogram in self.sizes.items():
+            summary[f'bytes/{name}'] = {f'p{p}': int(histogram.percentile(p)) for p in PERCENTILES}
+        return summary
+
+    def prometheus(self):
+        '''
+        Renders the stats and the histograms in the Prometheus text format
+
+        Returns:
+            text (str): the metrics page
+        '''
+        lines = []
+        for key, value in sorted(self.stats.get_stats().items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f'samara_{re.sub(r"[^a-zA-Z0-9_]", "_", key)} {value}')
+
+        for metric, label, histograms in (('samara_stage_seconds', 'stage', self.timings), ('samara_page_bytes', 'direction', self.sizes)):
+            lines.append(f'# TYPE {metric} histogram')
+            for name, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf', ), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{{label}="{name}"}} {histogram.sum}')
+                lines.append(f'{metric}_count{{{label}="{name}"}} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def getMetrics(crawler):
+    '''
+    Gets the Metrics of a crawler, creating them the first time
+
+    Arguments:
+        crawler (Crawler): the crawler of the spider
+
+    Returns:
+        metrics (Metrics): the metrics shared by every component of the crawl
+    '''
+
+    metrics = getattr(crawler, 'metrics', None)
+    if metrics is None:
+        metrics = crawler.metrics = Metrics(crawler.stats)
+    return metrics
+
+
+def timedCallback(callback):
+    '''
+    Decorator for spider callbacks, timing them as the callback/<name> stage
+    '''
+
+    stage = f'callback/{callback.__name__}'
+
+    def timed(self, response, *args, **kwargs):
+        return getMetrics(self.crawler).timeIterator(stage, callback(self, response, *args, **kwargs) or ())
+
+    timed.__name__ = callback.__name__
+    timed.__doc__ = callback.__doc__
+    return timed
+
+
+def peakRSS():
+    '''
+    Returns:
+        peak (int): the peak resident set size of the process in bytes, or None if it can't be read
+    '''
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024    # Linux reports kilobytes, macOS bytes
+
+
+class InstrumentationExtension:
+    '''
+    A scrapy extension recording the download latency and the size of every page downloaded and exported,
+    adding the percentiles of every stage to the stats at the end of the crawl, and serving or dumping the
+    metrics while the crawl runs (see the top of this file)
+    '''
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.metrics = getMetrics(crawler)
+        self.port = crawler.settings.getint('METRICS_PORT')
+        self.dump_file = crawler.settings.get('METRICS_DUMP_FILE')
+        self.dump_interval = crawler.settings.getfloat('METRICS_DUMP_INTERVAL', 10)
+        self.memory_interval = crawler.settings.getint('METRICS_MEMORY_INTERVAL', 1000)
+        self.pages = 0
+        self.listener = None
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.response_received, signal=signals.response_received)
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        return s
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.metrics.observe('download', latency)
+        self.metrics.observeSize('in', len(response.body))
+
+        self.pages += 1
+        if self.memory_interval and self.pages % self.memory_interval == 0:
+            self.recordMemory(spider)
+
+    def recordMemory(self, spider):
+        '''
+        Records the peak memory of the crawl so far, once every METRICS_MEMORY_INTERVAL pages
+        '''
+        peak = peakRSS()
+        if peak is None:
+            return
+        peak = round(peak / 1024 / 1024, 1)
+        stats = self.crawler.stats
+        history = stats.get_value('memory/peak_rss_mb_per_1k_pages', [], spider=spider)
+        stats.set_value('memory/peak_rss_mb_per_1k_pages', history + [peak], spider=spider)
+        stats.set_value('memory/peak_rss_mb', peak, spider=spider)
+        spider.logger.info('Peak memory after %d pages: %.1f MB (+%.1f MB over the last %d)'
+                           % (self.pages, peak, peak - (history[-1] if history else peak), self.memory_interval))
+
+    def item_scraped(self, item, response, spider):
+        self.metrics.observeSize('out', len((ItemAdapter(item).get('pagetext') or '').encode('utf-8')))
+
+    def spider_opened(self, spider):
+        from twisted.internet import reactor, task    # Imported here so loading the extension doesn't install a reactor
+
+        if self.port:
+            from twisted.web import resource, server
+
+            metrics = self.metrics
+
+            class MetricsPage(resource.Resource):
+                isLeaf = True
+
+                def render_GET(self, request):
+                    request.setHeader(b'Content-Type', b'text/plain; version=0.0.4')
+                    return metrics.prometheus().encode('utf-8')
+
+            self.listener = reactor.listenTCP(self.port, server.Site(MetricsPage()), interface='127.0.0.1')
+            spider.logger.info('Serving metrics on http://127.0.0.1:%d/metrics' % self.port)
+
+        if self.dump_file:
+            self.task = task.LoopingCall(self.dump)
+            self.task.start(self.dump_interval, now=False)
+
+    def spider_closed(self, spider):
+        peak = peakRSS()
+        if peak is not None:
+            self.crawler.stats.set_value('memory/peak_rss_mb', round(peak / 1024 / 1024, 1), spider=spider)
+
+        for name, percentiles in self.metrics.percentiles().items():
+            for key, value in percentiles.items():
+                self.crawler.stats.set_value(f'{name}/{key}', round(value, 3), spider=spider)
+
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        if self.dump_file:
+            self.dump()
+        if self.listener is not None:
+            return self.listener.stopListening()
+
+    def dump(self):
+        '''
+        Writes the stats and the percentiles of every stage to METRICS_DUMP_FILE. The file is written next to
+        it and renamed over it, so anything watching it never reads it half written
+        '''
+        temp_file = self.dump_file + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as file:
+            json.dump({'time': time.time(), 'stats': self.crawler.stats.get_stats(), 'percentiles': self.metrics.percentiles()}, file, default=str, indent=1)
+        os.replace(temp_file, self.dump_file)
@@ -12,6 +12,7 @@ further processing and export in pipelines.py
 Doesn't run on it's own; is accessed from iGEMScraper.py when running the command
 '''
 
+import attr
 import scrapy
 
 class WikiPage(scrapy.Item):
@@ -20,11 +21,14 @@ class WikiPage(scrapy.Item):
 
     Fields:
         url (str): the url of the software/modelling page
-        pagetype (str): a string identifying if the page is a software or modelling page
-                        in order to help filter them down the line
+        pagetype (str): a string identifying the type of the page (Model, Software, ... see PAGE_TYPES in
+                        settings.py) in order to help filter them down the line. A page of several types
+                        is yielded once for each
         teamname (str): identifies the team that created the page (see getTeamname)
         year (str): identifies the year of competition of the team (see getYear)
         pagetext (str): the body content of the wiki page (see getPagetext)
+        duplicate_of (str): the url of the page this one is a near duplicate of. Only set if DEDUP_ACTION
+                            is 'tag' (see dedup.py)
 
     '''  
     url = scrapy.Field()
@@ -32,6 +36,24 @@ class WikiPage(scrapy.Item):
     teamname = scrapy.Field()
     year = scrapy.Field()
     pagetext = scrapy.Field()
+    duplicate_of = scrapy.Field()
+
+
+@attr.s(slots=True)
+class CompactWikiPage:
+    '''
+    The same page as a WikiPage, used instead of it if LOW_MEMORY_ENABLED is set. An attrs class with __slots__
+    instead of a scrapy Item, so every page in flight doesn't carry a dict of its fields and is untracked by
+    scrapy's live references. Scrapy and the pipelines handle both the same way through ItemAdapter.
+
+    Fields: the same as WikiPage. duplicate_of is None, and isn't exported, unless it is assigned
+    '''
+    url = attr.ib()
+    pagetype = attr.ib()
+    teamname = attr.ib()
+    year = attr.ib()
+    pagetext = attr.ib()
+    duplicate_of = attr.ib(default=None, init=False)
 
 
 class NetscrapeNavItem(scrapy.Item): # Default item object; can just ignore because it's probably not important
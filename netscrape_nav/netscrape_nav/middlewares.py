@@ -3,11 +3,24 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import HtmlResponse
+from twisted.internet import defer
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from netscrape_nav.archive import ResponseArchive
+from netscrape_nav.extraction import extractPagebody
+from netscrape_nav.instrumentation import getMetrics
+from netscrape_nav.validators import ValidatorStore
+
 
 class NetscrapeNavSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +114,323 @@ class NetscrapeNavDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class ExtractionOffloadMiddleware:
+    '''
+    Runs the text extraction of pages tagged by the spider rules (request.meta['extract']) in a pool of
+    worker processes instead of on the reactor thread, so a large wiki page being cleaned doesn't stall
+    every other download. The result is stored in request.meta['pagetext'] for the spider callbacks.
+
+    The number of pages in the pool at once is bounded by EXTRACTION_OFFLOAD_MAX_INFLIGHT. Pages waiting
+    for a free spot keep their downloader slot, so the downloader backs off on its own when the pool
+    is full instead of piling responses up in memory. The time from the response arriving to the page being
+    extracted, waiting included, is recorded as the offload stage (see instrumentation.py).
+
+    Only enabled if EXTRACTION_OFFLOAD_ENABLED is set in settings.py
+    '''
+
+    def __init__(self, workers, max_inflight, metrics):
+        self.workers = workers
+        self.metrics = metrics
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.semaphore = defer.DeferredSemaphore(max_inflight)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('EXTRACTION_OFFLOAD_ENABLED'):
+            raise NotConfigured
+
+        workers = crawler.settings.getint('EXTRACTION_OFFLOAD_WORKERS') or os.cpu_count()
+        max_inflight = crawler.settings.getint('EXTRACTION_OFFLOAD_MAX_INFLIGHT') or workers * 2
+
+        s = cls(workers, max_inflight, getMetrics(crawler))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_response(self, request, response, spider):
+        if not request.meta.get('extract') or not isinstance(response, HtmlResponse) or response.status != 200:
+            return response     # Pages that aren't scraped (or failed) go straight through
+
+        return self.semaphore.run(self._extract, request, response, spider, time.perf_counter())    # Deferred that fires with the response once the page is extracted
+
+    def _extract(self, request, response, spider, start):
+        from twisted.internet import reactor    # Imported here so loading the middleware doesn't install a reactor
+
+        d = defer.Deferred()
+        future = self.executor.submit(extractPagebody, response.body, response.encoding)
+        future.add_done_callback(lambda future: reactor.callFromThread(self._resolve, d, future, request, response, spider, start))   # Done callbacks run in the executor's thread, so hand the result back to the reactor
+        return d
+
+    def _resolve(self, d, future, request, response, spider, start):
+        self.metrics.observe('offload', time.perf_counter() - start)
+        try:
+            request.meta['pagetext'] = future.result()
+        except Exception as e:  # The spider callback will extract the page itself instead, and raise the error there if it happens again
+            request.meta.pop('pagetext', None)
+            spider.logger.warning('Offloaded extraction of %s failed: %r', request.url, e)
+
+        d.callback(response)
+
+    def spider_opened(self, spider):
+        spider.logger.info('Extraction offloaded to %d worker processes' % self.workers)
+
+    def spider_closed(self, spider):
+        self.executor.shutdown(wait=True)
+
+
+class IncrementalRecrawlMiddleware(NetscrapeNavDownloaderMiddleware):
+    '''
+    Turns the requests for pages that will be scraped (request.meta['extract']) into conditional requests,
+    using the ETag and Last-Modified headers stored in the ValidatorStore during the last run (see validators.py).
+    Pages the server reports as unchanged (304 Not Modified) are dropped before they reach the spider,
+    so they are never extracted or exported again. The headers of the pages that did change are put in
+    request.meta['validators'], and only stored once the page is exported, so a page lost on the way is
+    downloaded in full again next run.
+
+    Only enabled if INCREMENTAL_ENABLED is set in settings.py
+    '''
+
+    def __init__(self, store, stats, metrics):
+        self.store = store
+        self.stats = stats
+        self.metrics = metrics
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('INCREMENTAL_ENABLED'):
+            raise NotConfigured
+
+        s = cls(ValidatorStore(crawler.settings.get('INCREMENTAL_STORE')), crawler.stats, getMetrics(crawler))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_request(self, request, spider):
+        if not request.meta.get('extract'):
+            return None
+
+        with self.metrics.time('incremental/lookup'):
+            validators = self.store.get(request.url)
+        if validators is None:  # Never seen this page, fetch it normally
+            return None
+
+        etag, last_modified, _ = validators
+        if etag:
+            request.headers.setdefault('If-None-Match', etag)
+        if last_modified:
+            request.headers.setdefault('If-Modified-Since', last_modified)
+        return None
+
+    def process_response(self, request, response, spider):
+        if not request.meta.get('extract'):
+            return response
+
+        if response.status == 304:  # The page didn't change since the last run
+            self.stats.inc_value('incremental/unchanged', spider=spider)
+            raise IgnoreRequest(f'Page not modified: {request.url}')
+
+        if response.status == 200:  # Stored by the KeystoneXL pipeline once the page is exported (see pipelines.py)
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if etag or last_modified:
+                request.meta['validators'] = (etag and etag.decode('latin-1'), last_modified and last_modified.decode('latin-1'))
+        return response
+
+    def spider_opened(self, spider):
+        spider.logger.info('Incremental recrawl enabled, skipping unchanged pages')
+
+    def spider_closed(self, spider):
+        self.store.close()
+
+
+class AdaptiveConcurrencyMiddleware:
+    '''
+    Steers the number of concurrent requests sent to each igem.org host based on how the server is doing,
+    instead of a hardcoded CONCURRENT_REQUESTS_PER_DOMAIN. It works like TCP congestion control (AIMD):
+
+    - Every ADAPTIVE_CONCURRENCY_WINDOW responses, if the 90th percentile download latency is under
+      ADAPTIVE_CONCURRENCY_TARGET_LATENCY and few requests failed, the concurrency goes up by one
+    - If the latency is too high or too many requests failed, it is multiplied by ADAPTIVE_CONCURRENCY_BACKOFF
+    - A 429 (Too Many Requests) or 503 (Service Unavailable) backs off right away, at most once per window
+
+    The highest concurrency that was still healthy is saved to ADAPTIVE_CONCURRENCY_STATE at the end of the
+    crawl, and the next crawl starts from it. In a distributed crawl the concurrency never goes above this
+    worker's share of DISTRIBUTED_CONCURRENCY (see distributed.py), so the workers together stay under it.
+
+    Only enabled if ADAPTIVE_CONCURRENCY_ENABLED is set in settings.py
+    '''
+
+    OVERLOAD_STATUSES = (429, 503)
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.start = settings.getint('ADAPTIVE_CONCURRENCY_START', 8)
+        self.minimum = settings.getint('ADAPTIVE_CONCURRENCY_MIN', 1)
+        self.maximum = settings.getint('ADAPTIVE_CONCURRENCY_MAX', 60)
+        self.target_latency = settings.getfloat('ADAPTIVE_CONCURRENCY_TARGET_LATENCY', 2.0)
+        self.window = settings.getint('ADAPTIVE_CONCURRENCY_WINDOW', 20)
+        self.backoff = settings.getfloat('ADAPTIVE_CONCURRENCY_BACKOFF', 0.5)
+        self.max_error_rate = settings.getfloat('ADAPTIVE_CONCURRENCY_MAX_ERROR_RATE', 0.1)
+        self.state_file = settings.get('ADAPTIVE_CONCURRENCY_STATE')
+
+        self.safe_levels = {}   # The highest healthy concurrency of every host, kept between runs
+        if self.state_file and os.path.exists(self.state_file):
+            with open(self.state_file) as file:
+                self.safe_levels = json.load(file)
+
+        self.hosts = {}     # Current concurrency and the latencies and errors of the current window, by downloader slot
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_response(self, request, response, spider):
+        host = self._host(request)
+        host['latencies'].append(request.meta.get('download_latency', 0))
+
+        if response.status in self.OVERLOAD_STATUSES:
+            host['errors'] += 1
+            if not host['backed_off']:  # Back off right away instead of waiting for the end of the window
+                self._decrease(request, host, spider, f'status {response.status}')
+
+        self._update(request, host, spider)
+        return response
+
+    def process_exception(self, request, exception, spider):   # Timeouts, refused connections...
+        host = self._host(request)
+        host['errors'] += 1
+        host['latencies'].append(request.meta.get('download_latency', 0))
+        self._update(request, host, spider)
+
+    def _host(self, request):
+        key = request.meta.get('download_slot')
+        if key not in self.hosts:
+            self.hosts[key] = {
+                'concurrency': float(min(self.maximum, max(self.minimum, self.safe_levels.get(key, self.start)))),
+                'latencies': [],
+                'errors': 0,
+                'backed_off': False,
+            }
+        return self.hosts[key]
+
+    def _update(self, request, host, spider):
+        self._cap(host)     # Before the window is judged, so the safe level is one that was actually used
+        if len(host['latencies']) >= self.window:   # End of the window, decide if the host can take more
+            latencies = sorted(host['latencies'])
+            p90 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))]
+            error_rate = host['errors'] / len(latencies)
+
+            if host['backed_off']:  # Already backed off during this window
+                pass
+            elif error_rate > self.max_error_rate:
+                self._decrease(request, host, spider, f'{error_rate:.0%} errors')
+            elif p90 > self.target_latency:
+                self._decrease(request, host, spider, f'p90 latency {p90:.2f}s')
+            else:
+                key = request.meta.get('download_slot')
+                self.safe_levels[key] = max(self.safe_levels.get(key, 0), int(host['concurrency']))  # Healthy at this level
+                host['concurrency'] = min(self.maximum, host['concurrency'] + 1)
+
+            host['latencies'] = []
+            host['errors'] = 0
+            host['backed_off'] = False
+
+        self._apply(request, host)
+
+    def _decrease(self, request, host, spider, reason):
+        key = request.meta.get('download_slot')
+        host['concurrency'] = max(self.minimum, host['concurrency'] * self.backoff)
+        host['backed_off'] = True
+        if self.safe_levels.get(key, 0) > host['concurrency']:  # The old safe level wasn't safe after all
+            self.safe_levels[key] = int(host['concurrency'])
+
+        self.crawler.stats.inc_value('adaptive_concurrency/backoff', spider=spider)
+        spider.logger.info('Backing off %s to %d concurrent requests (%s)' % (key, host['concurrency'], reason))
+
+    def _cap(self, host):
+        share = getattr(self.crawler.engine.slot.scheduler, 'share', None)    # Only set by the SharedScheduler
+        if share is not None and host['concurrency'] > share:
+            host['concurrency'] = float(share)
+
+    def _apply(self, request, host):
+        self._cap(host)
+        slot = self.crawler.engine.downloader.slots.get(request.meta.get('download_slot'))
+        if slot is not None:
+            slot.concurrency = int(host['concurrency'])
+
+    def spider_opened(self, spider):
+        spider.logger.info('Adaptive concurrency enabled, starting levels: %s' % (self.safe_levels or self.start))
+
+    def spider_closed(self, spider):
+        for key, host in self.hosts.items():
+            self.crawler.stats.set_value(f'adaptive_concurrency/{key}', int(host['concurrency']), spider=spider)
+
+        if self.state_file:
+            with open(self.state_file, 'w') as file:
+                json.dump(self.safe_levels, file, indent=4)
+
+
+class ResponseArchiveMiddleware:
+    '''
+    Saves the raw body of every downloaded page to the ResponseArchive in ARCHIVE_DIR (see archive.py), along
+    with the name of the spider callback that parses it, so the pages can be extracted and exported again
+    later with scrapy reprocess instead of a recrawl.
+
+    Only enabled if ARCHIVE_ENABLED is set in settings.py
+    '''
+
+    def __init__(self, archive, stats):
+        self.archive = archive
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('ARCHIVE_ENABLED'):
+            raise NotConfigured
+
+        archive = ResponseArchive(crawler.settings.get('ARCHIVE_DIR', 'archive'), crawler.settings.getint('ARCHIVE_PACK_SIZE', 256 * 1024 * 1024))
+        s = cls(archive, crawler.stats)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_response(self, request, response, spider):
+        if response.status == 200 and isinstance(response, HtmlResponse):
+            headers = {key.decode('latin-1'): [value.decode('latin-1') for value in values] for key, values in response.headers.items()}
+            self.archive.put(response.url, response.status, headers, response.body, callbackName(request, spider))
+            self.stats.inc_value('archive/stored', spider=spider)
+        return response
+
+    def spider_closed(self, spider):
+        self.archive.close()
+
+
+def callbackName(request, spider):
+    '''
+    Gets the name of the spider callback that will parse a response, following the CrawlSpider rules
+
+    Arguments:
+        request (Request): the request of the response
+        spider (Spider): the spider that made the request
+
+    Returns:
+        name (str): the name of the callback, or None if the page is only used to follow links
+    '''
+
+    rule = request.meta.get('rule')
+    if rule is not None and hasattr(spider, '_rules'):   # Requests made by a CrawlSpider rule go through the spider's _callback first
+        callback = spider._rules[rule].callback
+    else:
+        callback = request.callback
+
+    if callback is None:
+        return None
+    return callback if isinstance(callback, str) else callback.__name__
@@ -0,0 +1,89 @@
+'''
+SAMARA iGEM Research Assistant
+pagetypes.py
+
+This file creates the PageTypeRegistry used by the spider to decide which pages to scrape and what type of
+page they are (the pagetype of a WikiPage item, see items.py).
+
+The page types come from PAGE_TYPES in settings.py, or from the YAML or JSON file in PAGE_TYPES_FILE:
+
+    - name: Model
+      regex: 'Mode\\w+'         # Searched for in the url of every link
+      seed: Model               # The conventional page name, requested directly when seeding from team lists
+    - name: Hardware
+      regex: '/Hardware'
+      seed: Hardware
+
+A url is classified once, when the request for it is made, and tagged with every type it matches in
+request.meta['pagetypes']. The page is then downloaded and extracted once, and one item is yielded per
+type. All the patterns are combined into one regular expression to rule out the links that match no type
+in a single search, so adding page types barely changes the cost of links that aren't scraped.
+
+Doesn't run on it's own; is accessed from iGEMScraper.py when running the command
+'''
+
+import re
+
+import yaml
+
+from netscrape_nav.filters import compileRules
+
+
+class PageTypeRegistry:
+    '''
+    Classifies urls by page type
+
+    Arguments:
+        types [list of dict]: the page types, each with a name, a regex searched for in the url, and optionally
+                              the seed page name
+    '''
+
+    def __init__(self, types):
+        self.names = [page_type['name'] for page_type in types]
+        self.seeds = [page_type['seed'] for page_type in types if page_type.get('seed')]
+        self.patterns = [re.compile(page_type['regex']) for page_type in types]
+        self.any, _ = compileRules([(page_type['name'], page_type['regex']) for page_type in types], 't')
+
+    @classmethod
+    def fromSettings(cls, settings):
+        '''
+        Creates the registry from settings.py, or from PAGE_TYPES_FILE if it is set
+        '''
+
+        types = settings.getlist('PAGE_TYPES')
+
+        path = settings.get('PAGE_TYPES_FILE')
+        if path:
+            with open(path, encoding='utf-8') as file:
+                types = yaml.safe_load(file) or []  # JSON files are valid YAML too
+
+        return cls(types)
+
+    def matches(self, url):
+        '''
+        Checks if a url matches any page type, with a single search
+
+        Arguments:
+            url (str): the url of a link
+
+        Returns:
+            match (bool): True if the page should be scraped
+        '''
+
+        return self.any is not None and self.any.search(url) is not None
+
+    def classify(self, url):
+        '''
+        Gets every page type a url matches
+
+        Arguments:
+            url (str): the url of a link
+
+        Returns:
+            pagetypes [list of str]: the names of the matching types, in the order they are registered
+        '''
+
+        if not self.matches(url):   # Most links aren't scraped, so they're ruled out before trying every type
+            return []
+
+        return [name for name, pattern in zip(self.names, self.patterns) if pattern.search(url) is not None]
@@ -16,9 +16,19 @@ Doesn't run on it's own; is accessed from iGEMScraper.py when running the comman
 '''
 
 from itemadapter import ItemAdapter
-from scrapy.exceptions import DropItem
+from scrapy import signals
+from scrapy.exceptions import DropItem, NotConfigured
 from scrapy.exporters import JsonLinesItemExporter
-import re
+import json
+import os
+
+from netscrape_nav import chunking
+from netscrape_nav.dedup import NearDuplicateIndex
+from netscrape_nav.exporters import ShardedExporter
+from netscrape_nav.filters import FilterEngine
+from netscrape_nav.instrumentation import getMetrics
+from netscrape_nav.search import SearchIndex
+from netscrape_nav.validators import ValidatorStore, hashPagetext
 
 
 class KeystoneXL:
@@ -27,38 +37,315 @@ class KeystoneXL:
     into the file specified in the self.file variable.
     
     Must also be specified in the settings.py file under ITEM_PIPELINES in order to function.
+
+    If INCREMENTAL_ENABLED is set, pages whose pagetext didn't change since the last run are dropped, and
+    the rest are exported to INCREMENTAL_OUTPUT_FILE instead (see validators.py). The pagetext hash and the
+    ETag and Last-Modified headers of a page are only stored once it is exported
+
+    If EXPORT_FORMAT is set to anything other than 'jl', the pages are written in batches to compressed or
+    columnar shards in a directory named after the output file (samara.jl -> samara/, see exporters.py)
+
+    If SAMARA_OUTPUT_APPEND is set, the pages are added to the end of the output file instead of overwriting it,
+    so a distributed crawl worker that is resumed keeps what it exported before (see distributed.py)
+
+    If CHECKPOINT_ENABLED is set, the output file is flushed for every checkpoint of the crawl (see checkpoint.py)
+
+    If DEDUP_ENABLED is set, pages that are near duplicates of a page already exported are dropped, or tagged
+    with the url of that page in duplicate_of if DEDUP_ACTION is 'tag' (see dedup.py)
     '''
 
+    def __init__(self, settings):
+        self.filters = FilterEngine.fromSettings(settings)    # Compiled once, instead of for every item
+        self.output_file = settings.get('SAMARA_OUTPUT_FILE', 'samara.jl')
+        self.append = settings.getbool('SAMARA_OUTPUT_APPEND')
+        self.incremental = settings.getbool('INCREMENTAL_ENABLED')
+        self.delta_file = settings.get('INCREMENTAL_OUTPUT_FILE')
+        self.merge = settings.getbool('INCREMENTAL_MERGE')
+        self.store_path = settings.get('INCREMENTAL_STORE')
+        self.format = settings.get('EXPORT_FORMAT', 'jl')
+        self.batch_size = settings.getint('EXPORT_BATCH_SIZE', 500)
+        self.shard_size = settings.getint('EXPORT_SHARD_SIZE', 128 * 1024 * 1024)
+        self.dedup = settings.getbool('DEDUP_ENABLED')
+        self.dedup_action = settings.get('DEDUP_ACTION', 'drop')
+        self.dedup_file = settings.get('DEDUP_INDEX_FILE')
+        self.dedup_options = {
+            'threshold': settings.getfloat('DEDUP_THRESHOLD', 0.8),
+            'num_perm': settings.getint('DEDUP_NUM_PERM', 128),
+            'bands': settings.getint('DEDUP_BANDS', 32),
+            'shingle_size': settings.getint('DEDUP_SHINGLE_SIZE', 5),
+        }
+
+    @classmethod
+    def from_crawler(cls, crawler):   # Used by scrapy to create the pipeline with access to settings.py
+        s = cls(crawler.settings)
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(s.item_dropped, signal=signals.item_dropped)
+        return s
+
     def open_spider(self, spider): # Runs when the spider starts
-        self.file = open('samara.jl', 'wb') # Opens the file specified. wb is necessary for the JsonLinesItemExporter and will overwrite the file each run
-        self.exporter = JsonLinesItemExporter(self.file, encoding='utf-8')  # Uses the built in JsonLineItemExporter class to export the file
+        self.store = ValidatorStore(self.store_path) if self.incremental else None
+        self.changed = set()    # Urls whose pagetext changed this run, so a page with several pagetypes is exported as each of them
+        self.unchanged = set()  # Urls dropped because their pagetext didn't change, whose headers are stored anyway
+
+        self.index = None
+        if self.dedup:
+            self.index = NearDuplicateIndex(**self.dedup_options)
+            if self.dedup_file and os.path.exists(self.dedup_file):    # Pages exported by earlier runs count too
+                self.index.load(self.dedup_file)
+
+        self.path = path = self.delta_file if self.incremental else self.output_file    # Incremental runs only export the new and changed pages
+        if self.format == 'jl':
+            self.file = open(path, 'ab' if self.append else 'wb') # Opens the file specified. wb is necessary for the JsonLinesItemExporter and will overwrite the file each run, ab adds to it
+            self.exporter = JsonLinesItemExporter(self.file, encoding='utf-8')  # Uses the built in JsonLineItemExporter class to export the file
+        else:
+            self.file = None
+            self.exporter = ShardedExporter(os.path.splitext(path)[0], self.format, self.batch_size, self.shard_size)  # Shards go in samara/ instead of samara.jl
+            if self.append:
+                spider.logger.warning('SAMARA_OUTPUT_APPEND only works with EXPORT_FORMAT jl, the shards in %s are overwritten' % os.path.splitext(path)[0])
+            if self.merge:
+                spider.logger.warning('INCREMENTAL_MERGE only works with EXPORT_FORMAT jl, the changed pages are left in %s' % os.path.splitext(path)[0])
+                self.merge = False
         self.exporter.start_exporting() # Starts the exporter and waits for an item
 
     
     def close_spider(self, spider): # Runs when the spider ends
         self.exporter.finish_exporting()    # Ends the exporter
-        self.file.close()   # Closes the file
+        if self.file is not None:
+            self.file.close()   # Closes the file
+
+        if self.index is not None and self.dedup_file:
+            self.index.save(self.dedup_file)
+
+        if self.store is not None:
+            self.store.close()
+            if self.merge:
+                mergeDelta(self.output_file, self.delta_file)
     
     def process_item(self, item, spider):   # Runs when an item is yielded in iGEMScraper.py
         
         scraped_data = ItemAdapter(item)    # Adapts the item into a dict-like ItemAdapter object to process
+        metrics = getMetrics(spider.crawler)    # Times every step below (see instrumentation.py)
 
-        strings_to_check_for = ['No Page Text', # A list of strings found in false-positive, empty pages
-                            'The requested page title was invalid', 
-                            'This page is used by the judges to evaluate your team',
-                            'This is a template page',
-                            'There is currently no text',
-                            'In order to be considered for the',
-                            ]
-        
-        if any(bad_string in scraped_data['pagetext'] for bad_string in strings_to_check_for) == True:  # Checks if any of the false positive strings exists
-            raise DropItem('Invalid Page Removed!') # If any string exists, drop the item, stop processing, and do not export
-        
-        if len(scraped_data['pagetext']) < 100: # Checks to ensure the page has sufficient content
-            raise DropItem('Page too short')    # If any pagetext too short, drop the item, stop processing, and do not export
-        
-        
-        scraped_data['pagetext'] = re.sub(r'\$\$.+?\$\$', '', scraped_data['pagetext']) # Removes equations from the exported data
+        with metrics.time('pipeline/filter'):
+            rule = self.filters.check(scraped_data['pagetext'])  # Checks if any of the false positive strings exists (see FILTER_DROP_RULES in settings.py)
+            if rule is not None:
+                spider.crawler.stats.inc_value(f'filter/dropped/{rule}', spider=spider)   # Keeps track of which rule fired
+                self.drop(spider, 'invalid_page', f'Invalid Page Removed! ({rule})') # If any string exists, drop the item, stop processing, and do not export
+            
+            if len(scraped_data['pagetext']) < self.filters.min_length: # Checks to ensure the page has sufficient content
+                self.drop(spider, 'too_short', 'Page too short')    # If any pagetext too short, drop the item, stop processing, and do not export
+            
+            
+            scraped_data['pagetext'] = self.filters.apply(scraped_data['pagetext']) # Removes equations (and anything else in FILTER_REWRITE_RULES) from the exported data
         
-        self.exporter.export_item(item) # Exports the item to the file specified
-        return item 
\ No newline at end of file
+        if self.index is not None:  # Checks if the page is a copy of a page already exported
+            with metrics.time('pipeline/dedup'):
+                signature = self.index.signature(scraped_data['pagetext'])
+                duplicate_of = self.index.query(signature, scraped_data['url'])
+                if duplicate_of is None:
+                    self.index.add(scraped_data['url'], signature)
+                elif self.dedup_action == 'tag':
+                    scraped_data['duplicate_of'] = duplicate_of
+                else:
+                    self.drop(spider, 'near_duplicate', f'Near duplicate of {duplicate_of}')
+
+        if self.store is not None:  # Only export pages that changed since the last run
+            with metrics.time('pipeline/incremental'):
+                content_hash = hashPagetext(scraped_data['pagetext'])
+                validators = self.store.get(scraped_data['url'])
+                if validators is not None and validators[2] == content_hash and scraped_data['url'] not in self.changed:
+                    self.unchanged.add(scraped_data['url'])
+                    self.drop(spider, 'unchanged', 'Page unchanged')
+                self.changed.add(scraped_data['url'])
+
+        with metrics.time('pipeline/export'):
+            self.exporter.export_item({key: value for key, value in scraped_data.items() if value is not None})   # Exports the item to the file specified, without the fields that are None (duplicate_of of a CompactWikiPage)
+
+        if self.store is not None:  # Only once the page is exported, so a page that failed to export isn't skipped next run
+            self.store.updateContentHash(scraped_data['url'], content_hash)
+        return item
+
+    def item_scraped(self, item, response, spider):
+        self.storeValidators(ItemAdapter(item)['url'], response)
+
+    def item_dropped(self, item, response, exception, spider):
+        url = ItemAdapter(item).get('url')
+        if url in self.unchanged:   # Exported by an earlier run, the server just sent new headers for it
+            self.storeValidators(url, response)
+
+    def storeValidators(self, url, response):
+        '''
+        Stores the ETag and Last-Modified headers of an exported page, put in request.meta['validators'] by
+        the IncrementalRecrawlMiddleware (see middlewares.py)
+
+        Arguments:
+            url (str): the url of the page
+            response (Response): the response the page was scraped from
+        '''
+
+        validators = response.meta.get('validators') if self.store is not None else None
+        if validators is not None:
+            self.store.updateValidators(url, *validators)
+
+    def checkpoint(self):
+        '''
+        Writes the pages exported so far to disk, for the CheckpointExtension (see checkpoint.py)
+
+        Returns:
+            path (str): the file the pages are exported to, None if they aren't exported to a single file
+            size (int): the size of the file up to the last page exported
+        '''
+
+        if self.file is None:
+            return None, 0
+        if not self.file.closed:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        return self.path, os.path.getsize(self.path)
+
+    def drop(self, spider, reason, message):
+        '''
+        Drops the item being processed, counting it in the dropped/<reason> stat
+
+        Arguments:
+            spider (Spider): the spider that scraped the item
+            reason (str): a short name for why the item is dropped, the same for every item dropped for it
+            message (str): the message of the DropItem exception, logged by scrapy
+        '''
+
+        spider.crawler.stats.inc_value(f'dropped/{reason}', spider=spider)
+        raise DropItem(message)
+
+
+class TokenChunker:
+    '''
+    An optional item pipeline after KeystoneXL, so it only sees the pages that were exported. Splits the pagetext
+    of every page into overlapping chunks of tokens and writes their token ids to .npy shards next to the text,
+    so language models can memory map them instead of tokenizing the pages again (see chunking.py)
+
+    Only enabled if CHUNK_ENABLED is set in settings.py. Needs the tokenizers package and a tokenizer.json file
+    (CHUNK_TOKENIZER_FILE). Pages are buffered and tokenized CHUNK_BATCH_SIZE at a time; the items themselves are
+    passed on right away
+    '''
+
+    def __init__(self, settings):
+        if not settings.getbool('CHUNK_ENABLED'):
+            raise NotConfigured
+        if chunking.tokenizers is None:
+            raise NotConfigured('CHUNK_ENABLED needs the tokenizers package (pip install tokenizers)')
+
+        self.tokenizer_file = settings.get('CHUNK_TOKENIZER_FILE', 'tokenizer.json')
+        self.chunker = chunking.TextChunker(self.tokenizer_file, settings.getint('CHUNK_MAX_TOKENS', 512), settings.getint('CHUNK_OVERLAP', 64))
+        self.directory = settings.get('CHUNK_OUTPUT_DIR', 'samara.chunks')
+        self.shard_tokens = settings.getint('CHUNK_SHARD_TOKENS', 16 * 1024 * 1024)
+        self.batch_size = settings.getint('CHUNK_BATCH_SIZE', 64)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(crawler.settings)
+        pipeline.crawler = crawler
+        return pipeline
+
+    def open_spider(self, spider):
+        self.writer = chunking.ChunkShardWriter(self.directory, self.shard_tokens, self.chunker.dtype)
+        self.buffer = []    # (url, pagetype, pagetext) of the pages not tokenized yet
+
+    def close_spider(self, spider):
+        self.flush(spider)
+        self.writer.close({'tokenizer_file': os.path.abspath(self.tokenizer_file), 'max_tokens': self.chunker.max_tokens, 'overlap': self.chunker.overlap})
+
+    def process_item(self, item, spider):
+        page = ItemAdapter(item)
+        self.buffer.append((page['url'], page['pagetype'], page['pagetext']))
+        if len(self.buffer) >= self.batch_size:
+            self.flush(spider)
+        return item
+
+    def flush(self, spider):
+        if not self.buffer:
+            return
+
+        stats = self.crawler.stats
+        with getMetrics(self.crawler).time('pipeline/chunk'):
+            pages = self.chunker.chunk([pagetext for _, _, pagetext in self.buffer])
+            for (url, pagetype, _), chunks in zip(self.buffer, pages):
+                self.writer.write(url, pagetype, chunks)
+                stats.inc_value('chunk/chunks', len(chunks), spider=spider)
+                stats.inc_value('chunk/tokens', sum(len(ids) for _, ids in chunks), spider=spider)
+        stats.inc_value('chunk/pages', len(self.buffer), spider=spider)
+        self.buffer = []
+
+
+class SearchIndexer:
+    '''
+    An optional item pipeline after KeystoneXL that adds every exported page to the full text SearchIndex, so
+    the pages can be searched with the search command while or after crawling (see search.py)
+
+    Only enabled if SEARCH_ENABLED is set in settings.py. Pages are added SEARCH_BATCH_SIZE at a time, in one
+    transaction each
+    '''
+
+    def __init__(self, settings):
+        if not settings.getbool('SEARCH_ENABLED'):
+            raise NotConfigured
+        self.path = settings.get('SEARCH_INDEX_FILE', 'samara.db')
+        self.batch_size = settings.getint('SEARCH_BATCH_SIZE', 500)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(crawler.settings)
+        pipeline.crawler = crawler
+        return pipeline
+
+    def open_spider(self, spider):
+        self.index = SearchIndex(self.path)
+        self.buffer = []
+
+    def close_spider(self, spider):
+        self.flush(spider)
+        self.index.optimize()
+        self.index.close()
+
+    def process_item(self, item, spider):
+        self.buffer.append(ItemAdapter(item).asdict())
+        if len(self.buffer) >= self.batch_size:
+            self.flush(spider)
+        return item
+
+    def flush(self, spider):
+        if not self.buffer:
+            return
+        with getMetrics(self.crawler).time('pipeline/index'):
+            self.index.add(self.buffer)
+        self.crawler.stats.inc_value('search/indexed', len(self.buffer), spider=spider)
+        self.buffer = []
+
+
+def mergeDelta(output_file, delta_file):
+    '''
+    Merges the pages exported by an incremental run into the full output file. Pages already in the output
+    file (same url and pagetype) are replaced, and new pages are added at the end. The merged file is
+    written next to the output file and renamed over it, so it is never left half written
+
+    Arguments:
+        output_file (str): the full JSON lines output file (SAMARA_OUTPUT_FILE)
+        delta_file (str): the JSON lines file of new and changed pages (INCREMENTAL_OUTPUT_FILE)
+    '''
+
+    delta = {}
+    with open(delta_file, 'rb') as file:
+        for line in file:
+            page = json.loads(line)
+            delta[(page['url'], page['pagetype'])] = line
+
+    temp_file = output_file + '.tmp'
+    with open(temp_file, 'wb') as merged:
+        if os.path.exists(output_file):
+            with open(output_file, 'rb') as file:
+                for line in file:   # Streams through the old output, swapping in the changed pages
+                    page = json.loads(line)
+                    merged.write(delta.pop((page['url'], page['pagetype']), line))
+        for line in delta.values(): # Pages that weren't in the old output
+            merged.write(line)
+
+    os.replace(temp_file, output_file)
@@ -0,0 +1,209 @@
+'''
+SAMARA iGEM Research Assistant
+reclean.py
+
+This file creates a batch tool that cleans the pages of an output file that was already scraped again, with
+the filter rules of today, instead of recrawling them. Pages that fire a drop rule (FILTER_DROP_RULES) or are
+shorter than FILTER_MIN_LENGTH are removed, and the rewrite rules (FILTER_REWRITE_RULES, the $$...$$ equations)
+are applied to the rest, exactly like the KeystoneXL pipeline (see pipelines.py). Run from the first
+netscrape_nav folder:
+
+python -m netscrape_nav.reclean old/samara.jl --output samara.clean.jl
+
+The file is split into byte ranges of about --chunk-size megabytes, cleaned in parallel by one worker process
+per core. Every worker writes its pages to a temporary run file, sorted by url and pagetype, and the runs are
+merged into the output, so the output is sorted by url and pagetype. A page found more than once (the same url
+and pagetype, from appended or merged files) is only kept once, the last time it appears in the file. Pages the
+rules don't change are copied byte for byte.
+
+The output is written next to itself and renamed over it once complete, so it can be the input file too. The
+near duplicate, incremental, chunk, and search stages of the pipeline aren't run.
+
+Doesn't run on it's own; is run as a module from the terminal
+'''
+
+import argparse
+import heapq
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from netscrape_nav.filters import FilterEngine
+from netscrape_nav.refresh import ProjectSettings
+
+
+worker = {}     # The FilterEngine of a worker process, set by startWorker
+
+
+def startWorker(filters):
+    worker['filters'] = filters
+
+
+def byteRanges(path, chunk_size, workers):
+    '''
+    Splits a file into byte ranges to clean in parallel. The ranges don't have to start at the start of a line
+    (see cleanRange)
+
+    Arguments:
+        path (str): the file
+        chunk_size (int): the size of a range in bytes
+        workers (int): the number of worker processes, the file is split into at least this many ranges
+
+    Returns:
+        ranges [list of (int, int)]: the start and end of every range
+    '''
+
+    size = os.path.getsize(path)
+    count = max(workers, -(-size // chunk_size), 1)
+    bounds = [size * i // count for i in range(count + 1)]
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def cleanRange(path, start, end, run_path):
+    '''
+    Cleans the lines of a file that start in a byte range, in a worker process, and writes the pages kept to a
+    run file sorted by url and pagetype. Every line of the run is 'url\\tpagetype\\toffset\\t' followed by the
+    page, so the runs are merged by comparing the lines as they are
+
+    Arguments:
+        path (str): the JSON lines file
+        start (int): the first byte of the range. A line that starts before it belongs to the range before
+        end (int): the byte after the last of the range
+        run_path (str): the run file the pages are written to
+
+    Returns:
+        stats (Counter): the pages read, kept, rewritten, and dropped by every rule
+    '''
+
+    filters = worker['filters']
+    stats = Counter()
+    run = []
+    with open(path, 'rb') as file:
+        if start:
+            file.seek(start - 1)
+            file.readline()     # The rest of the line started in the range before, or only its newline
+        offset = file.tell()
+        while offset < end:
+            line = file.readline()
+            if not line:
+                break
+            if line.strip():
+                stats['pages'] += 1
+                try:
+                    page = json.loads(line)
+                    pagetext = page['pagetext']
+                except (ValueError, KeyError):  # A line cut short by a crawl that was killed
+                    stats['dropped/invalid_line'] += 1
+                    offset = file.tell()
+                    continue
+                rule = filters.check(pagetext)  # The same checks as KeystoneXL (see pipelines.py)
+                if rule is not None:
+                    stats[f'dropped/invalid_page/{rule}'] += 1
+                elif len(pagetext) < filters.min_length:
+                    stats['dropped/too_short'] += 1
+                else:
+                    cleaned = filters.apply(pagetext)
+                    if cleaned != pagetext:
+                        page['pagetext'] = cleaned
+                        line = (json.dumps(page, ensure_ascii=False) + '\n').encode('utf-8')    # The same as JsonLinesItemExporter
+                        stats['rewritten'] += 1
+                    elif not line.endswith(b'\n'):  # The last line of the file
+                        line += b'\n'
+                    run.append(f'{page["url"]}\t{page["pagetype"]}\t{offset:016d}\t'.encode('utf-8') + line)
+            offset = file.tell()
+
+    run.sort()
+    with open(run_path, 'wb') as file:
+        file.writelines(run)
+    stats['kept'] = len(run)
+    return stats
+
+
+def mergeRuns(run_paths, output):
+    '''
+    Merges the sorted runs into the output, keeping only the last copy of every url and pagetype
+
+    Arguments:
+        run_paths [list of str]: the run files (see cleanRange)
+        output (file): the binary file the pages are written to
+
+    Returns:
+        count (int): the number of pages written
+        duplicates (int): the number of copies left out
+    '''
+
+    files = [open(path, 'rb') for path in run_paths]
+    count = duplicates = 0
+    last_key = last_page = None
+    try:
+        for line in heapq.merge(*files):    # Sorted by url, pagetype, then where the page is in the file
+            url_end = line.index(b'\t')
+            pagetype_end = line.index(b'\t', url_end + 1)
+            key = line[:pagetype_end]
+            page = line[line.index(b'\t', pagetype_end + 1) + 1:]
+            if key == last_key:
+                duplicates += 1
+            elif last_page is not None:
+                output.write(last_page)
+                count += 1
+            last_key, last_page = key, page
+        if last_page is not None:
+            output.write(last_page)
+            count += 1
+    finally:
+        for file in files:
+            file.close()
+    return count, duplicates
+
+
+def main(argv=None):
+    settings = ProjectSettings()
+    parser = argparse.ArgumentParser(prog='python -m netscrape_nav.reclean', description='Clean an output file again with the current filter rules')
+    parser.add_argument('input', help='the JSON lines output file of an earlier run')
+    parser.add_argument('--output', help='the file the cleaned pages are written to, can be the input file (default: <input>.clean.jl)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='the number of worker processes (default: one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=64, help='the size in megabytes of the part of the file a worker cleans at once (default: 64)')
+    args = parser.parse_args(argv)
+
+    output_file = args.output or os.path.splitext(args.input)[0] + '.clean.jl'
+    filters = FilterEngine.fromSettings(settings)
+    size = os.path.getsize(args.input)
+    ranges = byteRanges(args.input, args.chunk_size * 1024 * 1024, args.workers)
+
+    start = time.perf_counter()
+    run_dir = tempfile.mkdtemp(prefix='reclean-', dir=os.path.dirname(os.path.abspath(output_file)))
+    try:
+        run_paths = [os.path.join(run_dir, f'run-{i:05d}') for i in range(len(ranges))]
+        stats = Counter()
+        with ProcessPoolExecutor(args.workers, initializer=startWorker, initargs=(filters, )) as executor:
+            for result in executor.map(cleanRange, [args.input] * len(ranges), *zip(*ranges), run_paths):
+                stats.update(result)
+        cleaned = time.perf_counter()
+
+        with open(output_file + '.tmp', 'wb') as output:
+            count, duplicates = mergeRuns(run_paths, output)
+        os.replace(output_file + '.tmp', output_file)  # Only complete output ever has the final name
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    elapsed = time.perf_counter() - start
+
+    megabytes = size / 1024 / 1024
+    print(f'Cleaned {stats["pages"]} pages ({megabytes:.1f} MB) in {elapsed:.2f}s with {args.workers} workers: '
+          f'{megabytes / elapsed if elapsed else 0:.1f} MB/s, {stats["pages"] / elapsed if elapsed else 0:.0f} pages/sec '
+          f'(cleaning {cleaned - start:.2f}s, merging {elapsed - (cleaned - start):.2f}s)')
+    print(f'Wrote {count} pages to {output_file}')
+    for key, value in sorted(stats.items()):
+        if key.startswith('dropped/') or key == 'rewritten':
+            print(f'    {key}: {value}')
+    if duplicates:
+        print(f'    duplicates: {duplicates}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+'''
+SAMARA iGEM Research Assistant
+refresh.py
+
+This file creates a lightweight refresh of a known list of pages, without the scrapy crawl machinery. Instead
+of starting the Twisted reactor, the middlewares, and the CrawlSpider rules to rediscover pages that are
+already known, it downloads the pages straight from a list with asyncio and aiohttp, extracts them with the
+same extraction as the spider, drops them with the same filter rules as the KeystoneXL pipeline, and writes
+them in the same JSON lines format. Run from the first netscrape_nav folder:
+
+python -m netscrape_nav.refresh samara.jl --output samara.refresh.jl
+
+The list is either the output of an earlier run (every url is refreshed as the pagetypes it was exported as),
+or a text file with one url per line (classified with PAGE_TYPES, see pagetypes.py). Downloads share a pool
+of keep-alive connections, with at most --concurrency requests at once. Pages are written as soon as they are
+extracted, so the output isn't in the same order as the list.
+
+robots.txt isn't fetched, redirects are followed, and failed downloads are retried RETRY_TIMES times. The
+incremental, dedup, chunk, and search stages of the pipeline aren't run.
+
+Doesn't run on it's own; is run as a module from the terminal
+'''
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+from w3lib.encoding import html_to_unicode
+
+from netscrape_nav.extraction import extractPagetext
+from netscrape_nav.filters import FilterEngine
+from netscrape_nav.pagetypes import PageTypeRegistry
+from netscrape_nav.urls import parseUrl
+
+
+class ProjectSettings:
+    '''
+    The settings in settings.py (or SCRAPY_SETTINGS_MODULE), read straight from the module instead of through
+    scrapy, as importing scrapy takes most of the startup time. Has the same get methods as scrapy's settings
+    for the settings used here
+    '''
+
+    def __init__(self, module=None):
+        self.module = importlib.import_module(module or os.environ.get('SCRAPY_SETTINGS_MODULE', 'netscrape_nav.settings'))
+
+    def get(self, name, default=None):
+        return getattr(self.module, name, default)
+
+    def getint(self, name, default=0):
+        return int(self.get(name, default))
+
+    def getfloat(self, name, default=0.0):
+        return float(self.get(name, default))
+
+    def getlist(self, name, default=None):
+        value = self.get(name, default or [])
+        return value.split(',') if isinstance(value, str) else list(value)
+
+
+def readPages(path, registry):
+    '''
+    Reads the list of pages to refresh
+
+    Arguments:
+        path (str): the output file of an earlier run, or a text file with one url per line
+        registry (PageTypeRegistry): classifies the urls of a text file
+
+    Returns:
+        pages [list of (str, list of str)]: the url and pagetypes of every page, in the order of the list
+        skipped (int): the number of urls of a text file that matched no page type
+    '''
+
+    pages = {}
+    skipped = 0
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):    # A page exported by an earlier run
+                page = json.loads(line)
+                pagetypes = pages.setdefault(page['url'], [])
+                if page['pagetype'] not in pagetypes:
+                    pagetypes.append(page['pagetype'])
+            elif line not in pages:
+                pagetypes = registry.classify(line)
+                if pagetypes:
+                    pages[line] = pagetypes
+                else:
+                    skipped += 1
+    return list(pages.items()), skipped
+
+
+def extractBody(body, content_type):
+    '''
+    Extracts the pagetext from the raw body of a page, decoding it the same way scrapy does. A module function so
+    it can run in a worker process
+
+    Arguments:
+        body (bytes): the raw body of the page
+        content_type (str): the Content-Type header of the response
+
+    Returns:
+        pagetext (str): the text from the body of a wiki page
+    '''
+
+    return extractPagetext(html_to_unicode(content_type, body)[1])
+
+
+class Refresher:
+    '''
+    Downloads, extracts, filters, and exports a list of pages (see the top of this file)
+
+    Arguments:
+        settings (ProjectSettings): the project settings
+        concurrency (int): the most requests at once
+        workers (int): the number of worker processes extracting pages. 0 extracts them on the event loop
+    '''
+
+    def __init__(self, settings, concurrency, workers=0):
+        self.filters = FilterEngine.fromSettings(settings)
+        self.concurrency = concurrency
+        self.workers = workers
+        self.retries = settings.getint('RETRY_TIMES', 2)
+        self.timeout = settings.getfloat('DOWNLOAD_TIMEOUT', 180)
+        self.user_agent = settings.get('USER_AGENT')
+        self.stats = Counter()
+
+    async def fetch(self, session, url):
+        '''
+        Downloads a page, retrying connection errors, timeouts, and server errors
+
+        Returns:
+            response (tuple): (status, final url, Content-Type header, body)
+        '''
+
+        for attempt in range(self.retries + 1):
+            try:
+                async with session.get(url) as response:
+                    body = await response.read()
+                if response.status >= 500 and attempt < self.retries:
+                    self.stats['retries'] += 1
+                    continue
+                return response.status, str(response.url), response.headers.get('Content-Type', ''), body
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                self.stats['retries'] += 1
+
+    async def refreshPage(self, session, executor, output, url, pagetypes):
+        status, url, content_type, body = await self.fetch(session, url)
+        self.stats['pages'] += 1
+        if not 200 <= status < 300:     # Like scrapy's HttpErrorMiddleware
+            self.stats[f'status/{status}'] += 1
+            return
+
+        if executor is None:
+            pagetext = extractBody(body, content_type)
+        else:
+            pagetext = await asyncio.get_running_loop().run_in_executor(executor, extractBody, body, content_type)
+
+        rule = self.filters.check(pagetext)    # The same checks as KeystoneXL (see pipelines.py), once for every pagetype of the page
+        if rule is not None:
+            self.stats[f'dropped/invalid_page/{rule}'] += len(pagetypes)
+            return
+        if len(pagetext) < self.filters.min_length:
+            self.stats['dropped/too_short'] += len(pagetypes)
+            return
+        pagetext = self.filters.apply(pagetext)
+
+        teamname, year = parseUrl(url)
+        for pagetype in pagetypes:  # Same fields, in the same order, as a WikiPage exported by JsonLinesItemExporter
+            page = {'url': url, 'pagetype': pagetype, 'teamname': teamname, 'year': year, 'pagetext': pagetext}
+            output.write((json.dumps(page, ensure_ascii=False) + '\n').encode('utf-8'))
+            self.stats['exported'] += 1
+
+    async def run(self, pages, output):
+        '''
+        Refreshes every page, with at most self.concurrency pages in flight
+
+        Arguments:
+            pages [list of (str, list of str)]: the url and pagetypes of every page (see readPages)
+            output (file): the binary file the pages are written to
+        '''
+
+        queue = asyncio.Queue(self.concurrency * 2)     # Bounded, so a long list isn't turned into tasks all at once
+        executor = ProcessPoolExecutor(self.workers) if self.workers else None
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)    # Keep-alive connections, reused between pages
+        headers = {'User-Agent': self.user_agent} if self.user_agent else None
+
+        async def worker():
+            while True:
+                page = await queue.get()
+                if page is None:
+                    return
+                try:
+                    await self.refreshPage(session, executor, output, *page)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    print(f'Error refreshing {page[0]}: {e!r}', file=sys.stderr)
+
+        async with aiohttp.ClientSession(connector=connector, headers=headers, trust_env=True,   # trust_env uses http_proxy like scrapy does
+                                         timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+            workers = [asyncio.ensure_future(worker()) for _ in range(self.concurrency)]
+            for page in pages:
+                await queue.put(page)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+
+        if executor is not None:
+            executor.shutdown()
+
+
+def main(argv=None):
+    settings = ProjectSettings()
+    parser = argparse.ArgumentParser(prog='python -m netscrape_nav.refresh', description='Refresh a known list of pages without a crawl')
+    parser.add_argument('pages', help='the output file of an earlier run, or a text file with one url per line')
+    parser.add_argument('--output', default=settings.get('SAMARA_OUTPUT_FILE', 'samara.jl'), help='the file the pages are written to (default: SAMARA_OUTPUT_FILE)')
+    parser.add_argument('--append', action='store_true', help='add the pages to the end of the output file instead of overwriting it')
+    parser.add_argument('--concurrency', type=int, default=30, help="the most requests at once (default: 30, the same as the spider's CONCURRENT_REQUESTS_PER_DOMAIN)")
+    parser.add_argument('--workers', type=int, default=0, help='extract pages in this many worker processes (default: on the event loop)')
+    args = parser.parse_args(argv)
+
+    if args.output == args.pages:
+        parser.error('the output file would overwrite the list of pages, use --output')
+    pages, skipped = readPages(args.pages, PageTypeRegistry.fromSettings(settings))
+
+    refresher = Refresher(settings, args.concurrency, args.workers)
+    start = time.perf_counter()
+    with open(args.output, 'ab' if args.append else 'wb') as output:
+        asyncio.run(refresher.run(pages, output))
+    elapsed = time.perf_counter() - start
+
+    stats = refresher.stats
+    print(f'Refreshed {stats["pages"]} of {len(pages)} pages in {elapsed:.2f}s ({stats["pages"] / elapsed if elapsed else 0:.1f} pages/sec), '
+          f'exported {stats["exported"]} to {args.output}')
+    for key, value in sorted(stats.items()):
+        if key not in ('pages', 'exported'):
+            print(f'    {key}: {value}')
+    if skipped:
+        print(f'    {skipped} urls matched no page type and were skipped')
+    return 1 if stats['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
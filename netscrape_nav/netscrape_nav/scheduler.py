@@ -0,0 +1,54 @@
+'''
+SAMARA iGEM Research Assistant
+scheduler.py
+
+This file creates the SpillingScheduler, the scheduler of the project (SCHEDULER in settings.py). Without
+LOW_MEMORY_ENABLED it is exactly scrapy's default scheduler.
+
+With LOW_MEMORY_ENABLED, requests are kept in memory until LOW_MEMORY_QUEUE_LIMIT of them are queued, and any
+more are spilled to scrapy's disk queues, so the queue of a long crawl that follows every Team: link doesn't
+grow without bound. Requests in memory are crawled first, then the spilled ones are read back. The disk queues
+go in a temporary directory under LOW_MEMORY_SPILL_DIR that is deleted at the end of the crawl, or in JOBDIR
+if it is set, so a paused crawl can still be resumed.
+
+Doesn't run on it's own; is accessed from scrapy as the SCHEDULER when running the command
+'''
+
+import shutil
+import tempfile
+
+from scrapy.core.scheduler import Scheduler
+
+
+class SpillingScheduler(Scheduler):
+    '''
+    Scrapy's scheduler, spilling requests to disk past a limit if LOW_MEMORY_ENABLED is set (see the top of this file)
+    '''
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        scheduler = super().from_crawler(crawler)
+        settings = crawler.settings
+        scheduler.limit = settings.getint('LOW_MEMORY_QUEUE_LIMIT', 10000) if settings.getbool('LOW_MEMORY_ENABLED') else None
+        scheduler.spill_dir = None
+        if scheduler.limit is not None and scheduler.dqdir is None:     # No JOBDIR, so the disk queues go in a temporary directory
+            scheduler.spill_dir = tempfile.mkdtemp(prefix='spill-', dir=settings.get('LOW_MEMORY_SPILL_DIR'))
+            scheduler.dqdir = scheduler._dqdir(scheduler.spill_dir)
+        return scheduler
+
+    def _dqpush(self, request):
+        if self.limit is not None and len(self.mqs) < self.limit:
+            return False    # Kept in memory
+        return super()._dqpush(request)
+
+    def close(self, reason):
+        if self.limit is not None and self.spill_dir is None and self.dqs is not None:  # Saved to JOBDIR, so the requests still in memory have to be too
+            request = self.mqs.pop()
+            while request is not None:
+                super()._dqpush(request)    # Requests that can't be serialized are counted and left out, like scrapy does
+                request = self.mqs.pop()
+
+        result = super().close(reason)
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        return result
@@ -0,0 +1,135 @@
+'''
+SAMARA iGEM Research Assistant
+search.py
+
+This file creates the SearchIndex, a full text index over the scraped pages so they can be searched without
+reading through samara.jl. It is filled as pages are exported by the SearchIndexer pipeline (see pipelines.py)
+or built from an existing output file with the search command (see commands/search.py):
+
+scrapy search "ODE solver" --year 2021 --pagetype Software
+
+The index is a single SQLite database (SEARCH_INDEX_FILE) with two tables:
+
+    pages       the url, pagetype, teamname, and year of every page, indexed for the field filters
+    fulltext    an FTS5 inverted index of the pagetext, with the same rowids as pages
+
+Results are ranked with BM25. Queries use the FTS5 syntax: words are all required by default, and "quoted
+phrases", OR, NOT, and prefix* searches work as expected. A page exported again (same url and pagetype)
+replaces the old one, so incremental runs keep the index up to date.
+
+Doesn't run on it's own; is accessed from pipelines.py when SEARCH_ENABLED is set, and from the search command
+'''
+
+import re
+import sqlite3
+
+
+def quoteQuery(query):
+    '''
+    Turns free text into a valid FTS5 query, for queries that aren't valid FTS5 syntax (like 'E. coli' or
+    'ODE-solver'). Every word is quoted, so they are all required and read literally
+
+    Arguments:
+        query (str): the query as typed
+
+    Returns:
+        query (str): the quoted query
+    '''
+
+    return ' '.join(f'"{word}"' for word in re.findall(r'\w+', query))
+
+
+class SearchIndex:
+    '''
+    Stores and searches the scraped pages (see the top of this file)
+
+    Arguments:
+        path (str): the path of the database file. It is created if it doesn't exist
+    '''
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, isolation_level=None)   # Autocommit, batches are wrapped in transactions
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                id INTEGER PRIMARY KEY,
+                url TEXT,
+                pagetype TEXT,
+                teamname TEXT,
+                year TEXT,
+                UNIQUE (url, pagetype)
+            )''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS pages_year ON pages (year, pagetype)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS pages_team ON pages (teamname COLLATE NOCASE)')
+        self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS fulltext USING fts5 (pagetext, tokenize='porter unicode61')")   # Stemmed, so model also finds models and modelling
+
+    def add(self, pages):
+        '''
+        Adds pages to the index in one transaction, replacing the pages with the same url and pagetype
+
+        Arguments:
+            pages [list of dict]: the WikiPage fields of every page
+        '''
+
+        with self.connection:
+            self.connection.execute('BEGIN')
+            for page in pages:
+                row = self.connection.execute('SELECT id FROM pages WHERE url = ? AND pagetype = ?', (page['url'], page['pagetype'])).fetchone()
+                if row is None:
+                    id = self.connection.execute('INSERT INTO pages (url, pagetype, teamname, year) VALUES (?, ?, ?, ?)',
+                                                 (page['url'], page['pagetype'], page['teamname'], page['year'])).lastrowid
+                else:
+                    id = row[0]
+                    self.connection.execute('UPDATE pages SET teamname = ?, year = ? WHERE id = ?', (page['teamname'], page['year'], id))
+                    self.connection.execute('DELETE FROM fulltext WHERE rowid = ?', (id, ))
+                self.connection.execute('INSERT INTO fulltext (rowid, pagetext) VALUES (?, ?)', (id, page['pagetext']))
+
+    def search(self, query, years=(), pagetypes=(), teams=(), limit=10):
+        '''
+        Searches the index
+
+        Arguments:
+            query (str): the FTS5 query (see the top of this file). Free text that isn't valid FTS5 syntax is quoted
+            years [list of str]: only return pages from these years
+            pagetypes [list of str]: only return pages of these types
+            teams [list of str]: only return pages of these teams (case insensitive)
+            limit (int): the most results returned
+
+        Returns:
+            results [list of dict]: the url, pagetype, teamname, year, score (higher is better), and a snippet
+                                    of the text around the matches of every result, best first
+        '''
+
+        sql = '''SELECT pages.url, pages.pagetype, pages.teamname, pages.year, -bm25(fulltext),
+                        snippet(fulltext, 0, '[', ']', '...', 16)
+                 FROM fulltext JOIN pages ON pages.id = fulltext.rowid WHERE fulltext MATCH ?'''
+        params = []
+        for column, values in (('pages.year', years), ('pages.pagetype', pagetypes), ('pages.teamname', teams)):
+            if values:
+                collate = ' COLLATE NOCASE' if column == 'pages.teamname' else ''
+                sql += f' AND {column}{collate} IN ({", ".join("?" * len(values))})'
+                params += [str(value) for value in values]
+        sql += ' ORDER BY bm25(fulltext) LIMIT ?'
+
+        try:
+            rows = self.connection.execute(sql, [query] + params + [limit]).fetchall()
+        except sqlite3.OperationalError:    # Not valid FTS5 syntax
+            if not quoteQuery(query):   # No words at all, nothing can match
+                return []
+            rows = self.connection.execute(sql, [quoteQuery(query)] + params + [limit]).fetchall()
+
+        return [{'url': url, 'pagetype': pagetype, 'teamname': teamname, 'year': year, 'score': round(score, 4), 'snippet': snippet}
+                for url, pagetype, teamname, year, score, snippet in rows]
+
+    def count(self):
+        return self.connection.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def optimize(self):
+        '''
+        Merges the inverted index into as few segments as possible, for faster queries after a large crawl
+        '''
+        self.connection.execute("INSERT INTO fulltext (fulltext) VALUES ('optimize')")
+
+    def close(self):
+        self.connection.close()
@@ -11,6 +11,7 @@ BOT_NAME = 'netscrape_nav'
 
 SPIDER_MODULES = ['netscrape_nav.spiders']
 NEWSPIDER_MODULE = 'netscrape_nav.spiders'
+COMMANDS_MODULE = 'netscrape_nav.commands'   # scrapy reprocess (see commands/reprocess.py)
 
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
@@ -50,24 +51,198 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
+DOWNLOADER_MIDDLEWARES = {
 #    'netscrape_nav.middlewares.NetscrapeNavDownloaderMiddleware': 543,
-#}
+    'netscrape_nav.middlewares.ExtractionOffloadMiddleware': 540,
+    'netscrape_nav.middlewares.IncrementalRecrawlMiddleware': 545,
+    'netscrape_nav.middlewares.AdaptiveConcurrencyMiddleware': 560,  # Above RetryMiddleware (550) so it sees 429/503 responses and errors before they are retried
+    'netscrape_nav.middlewares.ResponseArchiveMiddleware': 570,
+}
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
+EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+    'netscrape_nav.instrumentation.InstrumentationExtension': 500,
+    'netscrape_nav.checkpoint.CheckpointExtension': 510,
+}
+
+# Per-stage timings, page sizes, and drop reasons are always added to the stats (see instrumentation.py)
+# Serves them as Prometheus text on http://127.0.0.1:<port>/metrics while the crawl runs
+#METRICS_PORT = 9410
+# Writes them as JSON to this file every METRICS_DUMP_INTERVAL seconds while the crawl runs
+#METRICS_DUMP_FILE = 'metrics.json'
+#METRICS_DUMP_INTERVAL = 10
+# Record the peak memory of the crawl every this many pages
+#METRICS_MEMORY_INTERVAL = 1000
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
    'netscrape_nav.pipelines.KeystoneXL': 300,
+   'netscrape_nav.pipelines.TokenChunker': 400,    # Only runs if CHUNK_ENABLED is set
+   'netscrape_nav.pipelines.SearchIndexer': 500,   # Only runs if SEARCH_ENABLED is set
 }
 
 FEED_EXPORT_ENCODING = 'utf-8'
 
+# Pages containing any of these strings are dropped by the KeystoneXL pipeline. A list of strings found in false-positive, empty pages.
+# Regular expressions can be used with {'name': ..., 'regex': ...} (see filters.py)
+FILTER_DROP_RULES = [
+    'No Page Text',
+    'The requested page title was invalid',
+    'This page is used by the judges to evaluate your team',
+    'This is a template page',
+    'There is currently no text',
+    'In order to be considered for the',
+]
+# Text removed (or replaced) from the pagetext of every exported page
+FILTER_REWRITE_RULES = [
+    {'name': 'equations', 'regex': r'\$\$.+?\$\$', 'replace': ''},
+]
+# Pages with less characters than this are dropped
+FILTER_MIN_LENGTH = 100
+# A YAML or JSON file with drop, rewrite, and min_length keys, replacing the rules above
+#FILTER_RULES_FILE = 'filters.yml'
+
+# The types of page the spider scrapes (see pagetypes.py). A link is scraped if its url matches the regex of any type,
+# and the seed is the conventional page name requested directly for every team when the years argument is given.
+# For example, add {'name': 'Hardware', 'regex': r'/Hardware', 'seed': 'Hardware'} to scrape Hardware pages too
+PAGE_TYPES = [
+    {'name': 'Model', 'regex': r'Mode\w+', 'seed': 'Model'},       # Model, Modeling, and Modelling
+    {'name': 'Software', 'regex': r'/Software', 'seed': 'Software'},    # The / avoids teams with software in the name
+]
+# A YAML or JSON file with a list of page types, replacing PAGE_TYPES
+#PAGE_TYPES_FILE = 'pagetypes.yml'
+
+# The file the KeystoneXL pipeline exports the scraped pages to
+SAMARA_OUTPUT_FILE = 'samara.jl'
+# Add the pages to the end of the output file instead of overwriting it (only for EXPORT_FORMAT 'jl')
+#SAMARA_OUTPUT_APPEND = True
+# The export format. 'jl' writes a single JSON lines file. 'jsonl.gz', 'jsonl.zst', 'parquet', and 'bin' write
+# batches of pages to shards split by year and pagetype in a directory named after SAMARA_OUTPUT_FILE (see exporters.py)
+EXPORT_FORMAT = 'jl'
+# The number of pages buffered per shard before they are written, and the size in bytes at which a new shard part is started
+EXPORT_BATCH_SIZE = 500
+EXPORT_SHARD_SIZE = 134217728
+
+# How many subpages deep under a team's page (Team:Name/a/b...) the spider follows links to find Model and Software pages.
+# Team:Name is depth 0 and Team:Name/Project is depth 1. Links are followed at any depth if it isn't set; 1 skips the
+# deeper pages, which saves a lot of requests but can miss pages only linked from them
+#FRONTIER_MAX_DEPTH = 1
+
+
+# Run the page text extraction in a pool of worker processes instead of on the reactor thread (disabled by default)
+#EXTRACTION_OFFLOAD_ENABLED = True
+# The number of worker processes (defaults to the number of CPUs)
+#EXTRACTION_OFFLOAD_WORKERS = 4
+# The maximum number of pages being extracted or waiting for a worker at once (defaults to twice the number of workers)
+#EXTRACTION_OFFLOAD_MAX_INFLIGHT = 8
+
+
+# Only fetch and export pages that changed since the last run (disabled by default)
+#INCREMENTAL_ENABLED = True
+# The database holding the ETag, Last-Modified, and pagetext hash of every page seen so far
+INCREMENTAL_STORE = 'validators.db'
+# The file the new and changed pages are exported to, instead of SAMARA_OUTPUT_FILE
+INCREMENTAL_OUTPUT_FILE = 'samara.delta.jl'
+# Merge the new and changed pages into SAMARA_OUTPUT_FILE at the end of the run
+#INCREMENTAL_MERGE = True
+
+# Save the raw body of every downloaded page, so they can be extracted and exported again with
+# scrapy reprocess tomholland instead of a recrawl (see archive.py)
+#ARCHIVE_ENABLED = True
+ARCHIVE_DIR = 'archive'
+# A new pack file is started once the current one reaches this size (256 MiB)
+ARCHIVE_PACK_SIZE = 268435456
+
+
+# Distributed crawls, run with scrapy distribute tomholland --workers 4 (see distributed.py and commands/distribute.py).
+# The command sets SCHEDULER, DISTRIBUTED_WORKERS, and DISTRIBUTED_WORKER_INDEX for every worker it starts
+# The SQLite database holding the shared queue and dupefilter. Has to be on a filesystem every worker can reach
+DISTRIBUTED_FRONTIER = 'frontier.db'
+# Split the pages between the workers by 'team' or by 'year'
+DISTRIBUTED_SHARD_BY = 'team'
+# The requests at once to igem.org of all workers combined, split between the live workers. DOWNLOAD_DELAY is
+# multiplied by the number of live workers the same way
+DISTRIBUTED_CONCURRENCY = 30
+# The seconds without a heartbeat after which a worker is considered dead, so the others stop waiting for it. A
+# worker that never starts is considered dead this long after the others started
+DISTRIBUTED_WORKER_TIMEOUT = 60
+
+
+# Save the progress of the crawl every CHECKPOINT_INTERVAL seconds, so a crawl that dies partway can be continued with
+# scrapy resume instead of starting over (disabled by default). See checkpoint.py and commands/resume.py
+#CHECKPOINT_ENABLED = True
+# The SQLite database holding the queued requests, the dupefilter, and the teams and years finished so far
+CHECKPOINT_FILE = 'checkpoint.db'
+CHECKPOINT_INTERVAL = 60
+
+# Run the crawl in a smaller, fixed amount of memory (disabled by default): pages are yielded as CompactWikiPage
+# items (see items.py), and requests past LOW_MEMORY_QUEUE_LIMIT are spilled to disk (see scheduler.py)
+#LOW_MEMORY_ENABLED = True
+SCHEDULER = 'netscrape_nav.scheduler.SpillingScheduler'     # The same as scrapy's default scheduler unless LOW_MEMORY_ENABLED is set
+# The requests kept in memory before the rest are spilled to disk, and the directory they are spilled to (a temporary directory by default, or JOBDIR if set)
+LOW_MEMORY_QUEUE_LIMIT = 10000
+#LOW_MEMORY_SPILL_DIR = '/tmp'
+# Scrapy's memory usage extension closes the crawl if it ever uses more than this, in megabytes
+#MEMUSAGE_LIMIT_MB = 512
+
+
+# Split the pagetext of every exported page into overlapping chunks of tokens, and write their token ids to .npy
+# shards for language models (disabled by default, needs the tokenizers package). See chunking.py
+#CHUNK_ENABLED = True
+# A tokenizer.json file, saved with tokenizer.save() (tokenizers) or save_pretrained() (transformers)
+CHUNK_TOKENIZER_FILE = 'tokenizer.json'
+# The most tokens in a chunk, and the most tokens a chunk repeats from the end of the one before
+CHUNK_MAX_TOKENS = 512
+CHUNK_OVERLAP = 64
+# The number of pages tokenized at once
+CHUNK_BATCH_SIZE = 64
+# The directory the shards are written to, and the number of tokens after which a new shard is started
+CHUNK_OUTPUT_DIR = 'samara.chunks'
+CHUNK_SHARD_TOKENS = 16777216
+
+
+# Add every exported page to a full text index, searchable with scrapy search "query" (disabled by default). See search.py
+#SEARCH_ENABLED = True
+# The SQLite database holding the index, and the number of pages added to it at once
+SEARCH_INDEX_FILE = 'samara.db'
+SEARCH_BATCH_SIZE = 500
+
+
+# Drop pages that are near duplicates of a page already exported (disabled by default). See dedup.py
+#DEDUP_ENABLED = True
+# 'drop' to drop near duplicates, or 'tag' to export them with the url of the original page in duplicate_of
+#DEDUP_ACTION = 'drop'
+# The estimated share of shared word shingles above which two pages are near duplicates
+#DEDUP_THRESHOLD = 0.8
+# The number of MinHash values per page, the number of LSH bands they are split into, and the words per shingle
+#DEDUP_NUM_PERM = 128
+#DEDUP_BANDS = 32
+#DEDUP_SHINGLE_SIZE = 5
+# Keep the pages seen in this file between runs, so copies across years are found too (not kept by default)
+#DEDUP_INDEX_FILE = 'dedup.npz'
+
+
+# Adjust the concurrent requests to each host based on latency and errors, instead of using a fixed
+# CONCURRENT_REQUESTS_PER_DOMAIN (disabled by default). See AdaptiveConcurrencyMiddleware in middlewares.py
+#ADAPTIVE_CONCURRENCY_ENABLED = True
+# The concurrency used for hosts without a saved safe level
+#ADAPTIVE_CONCURRENCY_START = 8
+# The lowest and highest concurrency per host. CONCURRENT_REQUESTS still caps the total
+#ADAPTIVE_CONCURRENCY_MIN = 1
+#ADAPTIVE_CONCURRENCY_MAX = 60
+# The 90th percentile download latency (in seconds) above which the server is considered overloaded
+#ADAPTIVE_CONCURRENCY_TARGET_LATENCY = 2.0
+# The share of failed requests (errors, 429, 503) above which the server is considered overloaded
+#ADAPTIVE_CONCURRENCY_MAX_ERROR_RATE = 0.1
+# The number of responses between each adjustment, and the factor applied when backing off
+#ADAPTIVE_CONCURRENCY_WINDOW = 20
+#ADAPTIVE_CONCURRENCY_BACKOFF = 0.5
+# The file the learned safe concurrency of each host is saved to between runs
+ADAPTIVE_CONCURRENCY_STATE = 'concurrency.json'
+
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -10,6 +10,11 @@ cd ./netscrape_nav
 
 scrapy crawl tomholland --logfile scraper.log
 
+To skip the link following and go straight to the Model and Software pages of every team on the team
+list of one or more years, add the years argument:
+
+scrapy crawl tomholland -a years=2019,2020,2021 --logfile scraper.log
+
 Created by Ahmed Almousawi for the 2022 iGEM Calgary Team
 For inquiries or questions, email igemcalgary@ucalgary.ca or ahmed.almousawi1@ucalgary.ca
 
@@ -17,57 +22,31 @@ Requried Packages:
 scrapy
 re
 lxml
-parsel
 '''
 
+from scrapy import Request
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import HtmlResponse
 from scrapy.spiders import Rule, CrawlSpider
 from scrapy.linkextractors import LinkExtractor
-import re
+from scrapy.spidermiddlewares.httperror import HttpError
+import os
 from lxml import html
-from lxml.html.clean import Cleaner
-from parsel import Selector
-from netscrape_nav.items import WikiPage
-
-
-def getTeamname(url):
-    '''
-    Extracts the Team name from the url of an iGEM wiki page
-    
-    Arguments:
-        url (str): the url of a wiki page
-
-    Returns:
-        teamname (str): the name of the team that created the page
-    '''
-    
-    teamname = re.search('Team:(.+?)/', url).group()    # Extracts the teamname from the url
-    teamname = teamname.replace('Team:', '')    # Cleans the fluff from the extracted name
-    teamname = teamname.replace('/', '')        # Remove the / at the end
-    teamname = teamname.replace('_', ' ')       # Replace '_' with a ' '
+from netscrape_nav.extraction import ParsedPage, getBodytext, parseHTML
+from netscrape_nav.frontier import TEAM_PAGE, UrlClassifier
+from netscrape_nav.instrumentation import getMetrics, timedCallback
+from netscrape_nav.items import CompactWikiPage, WikiPage
+from netscrape_nav.pagetypes import PageTypeRegistry
+from netscrape_nav.urls import getTeamname, getYear, parseUrl   # getTeamname and getYear used to live here, kept importable from this module
 
-    return teamname
-
-def getYear(url):
-    '''
-    Extracts the year from the url of an iGEM wiki page
-    
-    Arguments:
-        url (str): the url of a wiki page
-
-    Returns:
-        year (str): the year of competition for the team 
-    '''
-    
-    year = re.search('//(.+?).igem', url).group()   # Extracts the year from the URL
-    year = year.replace('//', '')                   # Removes the '//'
-    year = year.replace('.igem', '')                # Removes the '.igem'
-
-    return year
 
 def cleanHTML(page_html):
     '''
     Processes and cleans the HTML from the scraped page, removing any Javascript, style, or scripts
     
+    Kept for anything that still needs the cleaned HTML as a string. The spider itself uses
+    ParsedPage, which never leaves the lxml tree (see extraction.py)
+
     Arguments:
         page_html (str): the full HTML content of the scraped page
 
@@ -75,16 +54,7 @@ def cleanHTML(page_html):
         clean_page (str): the processed version of the page with JS, style, and scripts removed 
     '''
     
-    page = html.fromstring(page_html)   # Turns the HTML string into an lxml HTML Element in order to use the Cleaner object
-
-    cleaner = Cleaner(style=True, javascript=True, scripts=True)   # Creates an lxml Cleaner class to remove JS, styles, and scripts
-
-    clean_page = cleaner.clean_html(page)   # Cleans the page according to the parameters above
-
-    tags_to_remove = ['nav', 'footer', 'header', 'h1', 'h2', 'h3', 'ul', 'li', 'table']
-    for tag in tags_to_remove:  # Adapted from https://stackoverflow.com/a/63386884
-        for node in clean_page.xpath(f'.//{tag}'):
-            node.getparent().remove(node)
+    clean_page = parseHTML(page_html)   # Parses and cleans the page in a single pass (see extraction.py)
 
     clean_page = html.tostring(clean_page, encoding='UTF-8').decode()    # Converts it back into a string in order to use it later on
 
@@ -102,24 +72,7 @@ def getPagetext(clean_page):
         pagetext (str): the raw text from the body of a wiki page
     '''
 
-    selector = Selector(text=clean_page)    # Creates a Selector class to use CSS selectors (scrapy can do some by default but it was buggy)
-    page_body = selector.css('div#bodyContent *::text').getall()    # Gets a list of divs with the id "bodyContent". Most iGEM pages only have one div
-
-    pagetext = ' '.join(str(div) for div in page_body)    # Turns the text in bodyContent into a string
-
-    
-    
-    pagetext = pagetext.replace('"', "'")   # Replaces the '"' characters with ''' in order to avoid premature closing of the string in the export file.
-
-
-    chars_to_remove = [r'\\n', r'\n', r'\t', r'\\t']    # List of newline and tab chars that I observed during testing that needed to be removed
-
-    for char in chars_to_remove:    # Iterates through chars_to_remove and removes the chars from the pagetext
-        pagetext = pagetext.replace(char, '')
-
-    pagetext = ' '.join(pagetext.split())  # Cleans weird spacing and newlines 
-    
-    return pagetext
+    return getBodytext(html.fromstring(clean_page))  # Parses the cleaned string again and reads the bodyContent text from the tree
 
 class iGEMSpider(CrawlSpider):
     '''
@@ -129,31 +82,38 @@ class iGEMSpider(CrawlSpider):
     
     Inputs:
         start_urls [list of str]: the starting url for the scraper to begin
+        years (str): optional spider argument (-a years=2019,2020). If given, the team lists of these years
+                     are used to seed the crawl instead of start_urls (see start_requests)
+        teamlist (str): optional spider argument (-a teamlist=teams.html). Paths to saved copies of team
+                        list pages, separated by commas, used instead of downloading them
 
     Yields:
         WikiPage Item -> file (see initial documentation, items.py, pipelines.py):
             url (str): the url of the software/modelling page
-            pagetype (str): a string identifying if the page is a software or modelling page
+            pagetype (str): the type of the page (Model, Software, ... see PAGE_TYPES in settings.py)
                             in order to help filter them down the line
-            teamname (str): identifies the team that created the page (see getTeamname)
-            year (str): identifies the year of competition of the team (see getYear)
+            teamname (str): identifies the team that created the page (see parseUrl in urls.py)
+            year (str): identifies the year of competition of the team (see parseUrl in urls.py)
             pagetext (str): the body content of the wiki page (see getPagetext)
 
     '''
     name = 'tomholland'     # I'm a comedian
     allowed_domains = ['igem.org']  # You need an allowed domains list to get the CrawlScraper to work and I'd rather not have the bot scrape the entirety of the internet.
+
+    # The links followed by the final rule are the ones with the word Team: in the URL, minus pages that got the crawler in an infinite loop.
+    # We've also excluded pages that we don't want to scrape (to decrease scaping times). If modifying, ensure that the pages you want aren't included in this list.
+    # Theoretically, there is no issue with keeping it if you've created a rule to get the pages above because the rules are checked top-down, but I wouldn't personally risk it.
+    follow_allow = ('Team:', )
+    follow_deny = ('oldid=', 'Login', 'action=history', 'wiki', 'Special', 'Journal', 'Notebook', r'Protocol\w+', 'Safety', 'Results', 'Parts', 'Description', 'Judging', r'Sustainab\w+', 'Sponsers', 'Partnership', 'Education')
+
     rules = (
         
-        # First rule looks for pages with the word Mode + following characters in the URL in order to get pages with Model, Modelling, and Modelling. The pages that match the criteria get callbacked to parse_model_page
-        Rule(LinkExtractor(allow=(r'Mode\w+')), callback='parse_model_page'), 
-        
-        # Second rule looks for pages with the word /Software in the URL in order to to avoid teams with software in the name. The pages that match the criteria get callbacked to parse_soft_page
-        Rule(LinkExtractor(allow=(r'/Software')), callback='parse_soft_page'),
+        # First rule looks for pages matching any of the page types in PAGE_TYPES (see settings.py and pagetypes.py), like Mode + following characters for Model, Modelling, and Modelling pages
+        # or /Software to avoid teams with software in the name. A page matching several types is only requested once, tagged with all of them, and callbacked to parse_page
+        Rule(LinkExtractor(), callback='parse_page', process_links='pageTypeLinks', process_request='tagPageTypes'),
 
-        # Final rule looks for pages with the word Team: in the URL, while denying pages that got the crawler in an infinite loop. There is no callback, allowing the crawler to use these pages to find new links.
-        # We've also excluded pages that we don't want to scrape (to decrease scaping times). If modifying, ensure that the pages you want aren't included in this list.
-        # Theoretically, there is no issue with keeping it if you've created a rule to get the pages above because the rules are checked top-down, but I wouldn't personally risk it.
-        Rule(LinkExtractor(allow=('Team:', ), deny=('oldid=', 'Login', 'action=history', 'wiki', 'Special', 'Journal', 'Notebook', r'Protocol\w+', 'Safety', 'Results', 'Parts', 'Description', 'Judging', r'Sustainab\w+', 'Sponsers', 'Partnership', 'Education'))),
+        # Final rule follows the links accepted by pruneLinks (see follow_allow and follow_deny above, and frontier.py). There is no callback, allowing the crawler to use these pages to find new links.
+        Rule(LinkExtractor(), process_links='pruneLinks', process_request='prioritizeRequest'),
     )
 
     custom_settings = { 
@@ -167,61 +127,211 @@ class iGEMSpider(CrawlSpider):
         'https://old.igem.org/Team_List?year=2021&name=Championship&division=igem'
     ]
 
-    def parse_model_page(self, response):
+    team_list_url = 'https://old.igem.org/Team_List?year={year}&name=Championship&division=igem'   # Used to seed the crawl when the years argument is given
+
+    def __init__(self, years=None, teamlist=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.years = [year.strip() for year in years.split(',')] if years else []
+        self.teamlists = [path.strip() for path in teamlist.split(',')] if teamlist else []
+        self.arguments = {name: value for name, value in (('years', years), ('teamlist', teamlist)) if value}   # Saved by the checkpoint, so a resumed crawl is started the same way (see checkpoint.py)
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        max_depth = crawler.settings.get('FRONTIER_MAX_DEPTH')    # No limit by default
+        max_depth = int(max_depth) if max_depth is not None else None
+        spider.url_classifier = UrlClassifier(cls.follow_allow, cls.follow_deny, max_depth)  # Needs settings.py, so it can't be made in __init__
+        spider.page_types = PageTypeRegistry.fromSettings(crawler.settings)
+        spider.low_memory = crawler.settings.getbool('LOW_MEMORY_ENABLED')
+        return spider
+
+    def start_requests(self):
         '''
-        Function called when a page matches rule 1 of the CrawlSpider rules
-        Parses the model page.
-        
+        Starts the crawl. By default the spider starts at start_urls and follows links from there. If the years
+        or teamlist arguments are given, it reads the team lists instead and requests the conventional pages of
+        every page type of every team directly (see parseTeamList)
+
+        Yields:
+            Request: the first requests of the crawl
+        '''
+        if self.settings.getbool('CHECKPOINT_RESUME'):  # The requests left by the crawl are queued from the checkpoint instead (see checkpoint.py)
+            return
+
+        if not self.years and not self.teamlists:
+            yield from super().start_requests()
+            return
+
+        for path in self.teamlists: # Offline copies of team lists don't need a request
+            with open(path, 'rb') as file:
+                response = HtmlResponse(url='file://' + os.path.abspath(path), body=file.read())
+            yield from self.parseTeamList(response)
+
+        for year in self.years:
+            yield Request(self.team_list_url.format(year=year), callback=self.parseTeamList)
+
+    @timedCallback
+    def parseTeamList(self, response):
+        '''
+        Callback for team list pages. Builds the urls of every team's Model and Software pages (the seed of every
+        page type in PAGE_TYPES) from the team links on the list, instead of finding them by following links
+
         Arguments:
-            response (Response): the response given by the Scrapy request
+            response (Response): the team list page
 
         Yields:
-            WikiPage Item -> file (see initial documentation, items.py, pipelines.py):
-                url (str): the url of the software/modelling page
-                pagetype (str): a string identifying if the page is a software or modelling page
-                                in order to help filter them down the line
-                teamname (str): identifies the team that created the page (see getTeamname)
-                year (str): identifies the year of competition of the team (see getYear)
-                pagetext (str): the body content of the wiki page (see getPagetext)
-        '''
-        page = WikiPage()   # Use scrapy item objects to more accurately follow established standards 
-                            # For more info, see the items.py file or the scrapy documentation
-        
-        page['url'] = str(response.url)
-        page['pagetype'] = 'Model'
-        page['teamname'] = getTeamname(page['url'])
-        page['year'] = getYear(page['url'])
-        clean_html = cleanHTML(str(response.text))
-        page['pagetext'] = getPagetext(clean_html)
-
-        yield page
-    def parse_soft_page(self, response):
-        '''
-        Function called when a page matches rule 2 of the CrawlSpider rules
-        Parses the software page
+            Request: a request for every seed page of every team
+        '''
+        teams = set()
+        for link in LinkExtractor(allow=(r'Team:', )).extract_links(response):
+            match = TEAM_PAGE.search(link.url)
+            team_url = link.url[:match.start()] + match.group()[:len('Team:') + len(match.group(1))]  # https://2021.igem.org/Team:Name, without any subpages
+            if team_url in teams:
+                continue
+            teams.add(team_url)
+
+            for page in self.page_types.seeds:
+                url = f'{team_url}/{page}'
+                yield Request(url, callback=self.parse_page, errback=self.seedFailed, meta={'extract': True, 'pagetypes': self.page_types.classify(url), 'team_url': team_url})
+
+        self.logger.info('Seeded %d teams from %s' % (len(teams), response.url))
+        self.crawler.stats.inc_value('seed/teams', len(teams), spider=self)
+
+    def seedFailed(self, failure):
+        '''
+        Errback for the seed pages. Teams that didn't name their page the conventional way get a 404, so their
+        main page is crawled instead, finding the page by following links with the rules like a normal crawl
+
+        Arguments:
+            failure (Failure): the error of the seed page request
+
+        Yields:
+            Request: a request for the team's main page, if the seed page doesn't exist
+        '''
+        if failure.check(HttpError) and failure.value.response.status == 404:
+            self.crawler.stats.inc_value('seed/fallback', spider=self)
+            yield Request(failure.request.meta['team_url'])   # No callback, so the CrawlSpider rules are used. The dupefilter drops the second one if both pages 404
+        elif failure.check(IgnoreRequest) and not failure.check(HttpError):     # Unchanged since the last run (see IncrementalRecrawlMiddleware), or not allowed by robots.txt
+            return
+        else:
+            self.logger.error(repr(failure))
+
+    def pruneLinks(self, links):
+        '''
+        Called with the links found by the final rule on every page. Keeps only the links worth following
+        (see UrlClassifier in frontier.py), rewritten to their canonical url
+
+        Arguments:
+            links [list of Link]: the links extracted from the page
+
+        Returns:
+            links [list of Link]: the links to follow
+        '''
+        followed = []
+        for link in links:
+            link.url = self.url_classifier.classify(link.url)
+            if link.url is not None:
+                followed.append(link)
+        return followed
+
+    def prioritizeRequest(self, request, response):
+        '''
+        Called on every request made by the final rule. Crawls pages closer to a team's main page first,
+        as they link to more of the wiki
+
+        Arguments:
+            request (Request): the request created from the followed link
+            response (Response): the response the link was found on
+
+        Returns:
+            request (Request): the same request, with its priority set
+        '''
+        request.priority = self.url_classifier.score(request.url)
+        return request
+
+    def pageTypeLinks(self, links):
+        '''
+        Called with the links found by the first rule on every page. Keeps only the links to pages of one of the
+        page types (see pagetypes.py)
+
+        Arguments:
+            links [list of Link]: the links extracted from the page
+
+        Returns:
+            links [list of Link]: the links to scrape
+        '''
+        return [link for link in links if self.page_types.matches(link.url)]
+
+    def tagPageTypes(self, request, response):
+        '''
+        Called on every request made by the first rule. Tags the request with every page type its url matches,
+        and marks it as a page that will be scraped so the downloader middlewares know to extract it (see
+        middlewares.py)
+
+        Arguments:
+            request (Request): the request created from the matching link
+            response (Response): the response the link was found on
+
+        Returns:
+            request (Request): the same request, tagged with meta['pagetypes'] and meta['extract']
+        '''
+        request.meta['pagetypes'] = self.page_types.classify(request.url)
+        request.meta['extract'] = True
+        return request
+
+    @timedCallback
+    def parse_page(self, response):
+        '''
+        Function called for every page of one or more page types, from the first rule of the CrawlSpider rules or
+        from the seed pages. The page is extracted once and a WikiPage is yielded for each of its types
         
         Arguments:
             response (Response): the response given by the Scrapy request
 
         Yields:
             WikiPage Item -> file (see initial documentation, items.py, pipelines.py):
-                    url (str): the url of the software/modelling page
-                    pagetype (str): a string identifying if the page is a software or modelling page
-                                    in order to help filter them down the line
-                    teamname (str): identifies the team that created the page (see getTeamname)
-                    year (str): identifies the year of competition of the team (see getYear)
-                    pagetext (str): the body content of the wiki page (see getPagetext)
-        '''
-        page = WikiPage()   # Use scrapy item objects to more accurately follow existing convention 
-                            # For more info, see the items.py file or review the scrapy documentation
-        
-        page['url'] = str(response.url)
-        page['pagetype'] = 'Software'
-        page['teamname'] = getTeamname(page['url'])
-        page['year'] = getYear(page['url'])
-        clean_html = cleanHTML(str(response.text))
-        page['pagetext'] = getPagetext(clean_html)
-
-        yield page
-
+                url (str): the url of the page
+                pagetype (str): the type of the page (see PAGE_TYPES in settings.py)
+                teamname (str): identifies the team that created the page (see parseUrl in urls.py)
+                year (str): identifies the year of competition of the team (see parseUrl in urls.py)
+                pagetext (str): the body content of the wiki page (see ParsedPage in extraction.py)
+        '''
+        pagetypes = response.meta.get('pagetypes')
+        if pagetypes is None:   # Pages from the response archive aren't tagged (see commands/reprocess.py)
+            pagetypes = self.page_types.classify(response.url)
+        if not pagetypes:
+            return
+
+        url = str(response.url)
+        teamname, year = parseUrl(url)  # '' for whatever isn't in the url, instead of losing the page
+        parsed = ParsedPage(response)
+        with getMetrics(self.crawler).time('extract'):  # Only the time spent in the spider, see the offload stage for offloaded pages
+            pagetext = parsed.pagetext  # Parsed and cleaned only if it wasn't offloaded
+        parsed.release()    # The response is kept until its items are exported, but its HTML as a string isn't needed anymore
+
+        for pagetype in pagetypes:
+            if self.low_memory:     # See CompactWikiPage in items.py
+                yield CompactWikiPage(url, pagetype, teamname, year, pagetext)
+                continue
+
+            page = WikiPage()   # Use scrapy item objects to more accurately follow established standards 
+                                # For more info, see the items.py file or the scrapy documentation
+            page['url'] = url
+            page['pagetype'] = pagetype
+            page['teamname'] = teamname
+            page['year'] = year
+            page['pagetext'] = pagetext
+
+            yield page
+
+    def closed(self, reason):
+        '''
+        Called when the spider finishes. Reports how many requests the UrlClassifier saved by pruning links.
+        Duplicates aren't counted as saved, scrapy's dupefilter would have dropped them anyway
+        '''
+        pruned = self.url_classifier.pruned
+        for prune_reason, count in pruned.items():
+            self.crawler.stats.set_value(f'frontier/pruned/{prune_reason}', count, spider=self)
+        self.crawler.stats.set_value('frontier/followed', self.url_classifier.followed, spider=self)
 
+        self.logger.info('Frontier pruning followed %d links and saved %d requests (%d denied, %d too deep, %d duplicates skipped)'
+                         % (self.url_classifier.followed, pruned['denied'] + pruned['too_deep'], pruned['denied'], pruned['too_deep'], pruned['duplicate']))
@@ -0,0 +1,109 @@
+'''
+SAMARA iGEM Research Assistant
+urls.py
+
+This file holds parseUrl, which reads the team name and year from the url of a wiki page. It is kept apart
+from the spider so tools that don't run a crawl (see refresh.py) can use it without importing scrapy.
+
+Every form of wiki url is read with a single precompiled pattern:
+
+    https://2021.igem.org/Team:Name/Model                       team Name, year 2021
+    https://2021.igem.org/Team:Name                             no trailing slash
+    https://2021.igem.org/wiki/index.php?title=Team:Name        MediaWiki's own form of the same page
+    https://old.igem.org/Team:Name, https://igem.org/Team:Name  no year in the host, so the year is ''
+    https://2022.igem.wiki/team-name/model                      the newer wikis, with the team as the first folder
+
+Team names are percent-decoded (Team:T%C3%BCbingen is Tübingen) and underscores become spaces. A url that
+isn't a wiki page gets '' for whatever can't be read from it instead of raising, so a page that was
+downloaded is never lost to its url. The team name and year only depend on the start of the url, so results
+are cached by that prefix and every other page of the same team reuses them.
+
+Doesn't run on it's own; is accessed from iGEMScraper.py and refresh.py when running the command
+'''
+
+import re
+from collections import namedtuple
+from functools import lru_cache
+from urllib.parse import unquote
+
+
+WIKI_URL = re.compile(r'''
+    ^(?:[a-z][a-z0-9+.-]*:)?(?://)?             # https://, or no scheme at all
+    (?:(?P<year>\d{4})\.|[^/?#]*?\.)?           # 2021. in the host, or old., www., and so on
+    igem\.(?:
+        org(?::\d+)?/(?:[^?#]*\?(?:[^#]*&)?title=)?Team:(?P<team>[^/?#&]+)    # /Team:Name or ?title=Team:Name
+        |wiki(?::\d+)?/(?P<slug>[^/?#]+)                                        # /team-name
+        |(?:org|wiki)\b                                                         # any other page of a wiki
+    )''', re.IGNORECASE | re.VERBOSE)
+
+WikiUrl = namedtuple('WikiUrl', ['teamname', 'year'])   # '' for whatever can't be read from the url
+
+
+def urlPrefix(url):
+    '''
+    Cuts a url down to the part its team name and year are read from, the cache key of parseUrl
+
+    Arguments:
+        url (str): the url of a wiki page
+
+    Returns:
+        prefix (str): the url up to the end of the team's folder, or the whole url without its fragment if it
+                      has a query (the team might be in ?title=)
+    '''
+
+    url = url.partition('#')[0]
+    if '?' in url:
+        return url
+    return '/'.join(url.split('/', 4)[:4])  # https:, '', host, Team:Name
+
+
+@lru_cache(maxsize=8192)
+def parsePrefix(prefix):
+    match = WIKI_URL.match(prefix)
+    if match is None:
+        return WikiUrl('', '')
+
+    teamname = unquote(match.group('team') or match.group('slug') or '')
+    teamname = teamname.replace('_', ' ')       # Replace '_' with a ' '
+    return WikiUrl(teamname, match.group('year') or '')
+
+
+def parseUrl(url):
+    '''
+    Extracts the team name and year from the url of an iGEM wiki page (see the top of this file)
+
+    Arguments:
+        url (str): the url of a wiki page
+
+    Returns:
+        url (WikiUrl): the teamname (str) and year (str) of the page, '' if they can't be read from the url
+    '''
+
+    return parsePrefix(urlPrefix(url))
+
+
+def getTeamname(url):
+    '''
+    Extracts the Team name from the url of an iGEM wiki page
+
+    Arguments:
+        url (str): the url of a wiki page
+
+    Returns:
+        teamname (str): the name of the team that created the page
+    '''
+
+    return parseUrl(url).teamname
+
+def getYear(url):
+    '''
+    Extracts the year from the url of an iGEM wiki page
+
+    Arguments:
+        url (str): the url of a wiki page
+
+    Returns:
+        year (str): the year of competition for the team
+    '''
+
+    return parseUrl(url).year
@@ -0,0 +1,90 @@
+'''
+SAMARA iGEM Research Assistant
+validators.py
+
+This file creates the on-disk store used for incremental recrawls. For every scraped page it keeps the
+HTTP validators sent by the server (ETag and Last-Modified) and a hash of the exported pagetext, so
+the next run can ask the server if the page changed and skip it if it didn't.
+
+Doesn't run on it's own; is accessed from middlewares.py and pipelines.py when INCREMENTAL_ENABLED is set
+'''
+
+import hashlib
+import sqlite3
+import time
+
+
+def hashPagetext(pagetext):
+    '''
+    Hashes the pagetext of a WikiPage to tell if the content of a page changed between runs
+
+    Arguments:
+        pagetext (str): the text from the body of a wiki page
+
+    Returns:
+        content_hash (str): the hex digest of the pagetext
+    '''
+
+    return hashlib.sha1(pagetext.encode('utf-8')).hexdigest()
+
+
+class ValidatorStore:
+    '''
+    A small SQLite database keyed by url, holding the ETag, Last-Modified, and pagetext hash of every
+    page seen so far.
+
+    Every write is committed right away (WAL mode keeps that cheap), which lets the downloader middleware
+    and the item pipeline each keep their own connection to the same file.
+
+    Arguments:
+        path (str): the path of the database file. It is created if it doesn't exist
+    '''
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, isolation_level=None)   # Autocommit
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                content_hash TEXT,
+                updated REAL
+            )''')
+
+    def get(self, url):
+        '''
+        Gets the stored validators of a page
+
+        Arguments:
+            url (str): the url of the page
+
+        Returns:
+            validators (tuple): (etag, last_modified, content_hash), or None if the page was never seen
+        '''
+
+        return self.connection.execute('SELECT etag, last_modified, content_hash FROM pages WHERE url = ?', (url, )).fetchone()
+
+    def updateValidators(self, url, etag, last_modified):
+        '''
+        Stores the ETag and Last-Modified headers the server sent for a page
+        '''
+
+        self.connection.execute('''
+            INSERT INTO pages (url, etag, last_modified, updated) VALUES (?, ?, ?, ?)
+            ON CONFLICT (url) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified, updated = excluded.updated
+            ''', (url, etag, last_modified, time.time()))
+
+    def updateContentHash(self, url, content_hash):
+        '''
+        Stores the hash of the pagetext exported for a page (see hashPagetext)
+        '''
+
+        self.connection.execute('''
+            INSERT INTO pages (url, content_hash, updated) VALUES (?, ?, ?)
+            ON CONFLICT (url) DO UPDATE SET content_hash = excluded.content_hash, updated = excluded.updated
+            ''', (url, content_hash, time.time()))
+
+    def close(self):
+        self.connection.close()